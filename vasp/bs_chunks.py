@@ -0,0 +1,116 @@
+"""
+Fan-out of HSE line-mode band structures over several VASP runs.
+
+A hybrid functional has no non-self-consistent mode, so an HSE band structure
+is a self-consistent run on the weighted mesh with the k-points of the path
+appended at zero weight. One run carries the whole path and its cost grows
+with the line density. split_zero_weight keeps the weighted mesh and one
+contiguous chunk of the zero-weight points, so n runs of about 1/n of the
+path can run in parallel:
+
+    chunk i of n:   weighted mesh + zero-weight points [start_i, stop_i)
+
+Every chunk is parsed as a line-mode band structure (the drone drops the
+weighted points of hybrid runs), and merge_band_structures stitches the
+chunks back together in k-point order.
+"""
+
+import numpy as np
+
+from pymatgen.electronic_structure.bandstructure import BandStructureSymmLine
+from pymatgen.io.vasp.inputs import Kpoints
+
+from atomate.utils.utils import get_logger
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+
+def split_zero_weight(kpts, weights, labels, chunk, n_chunks):
+    """
+    All weighted k-points plus chunk number chunk of n_chunks contiguous,
+    nearly equal parts of the zero-weight k-points.
+
+    Args:
+        kpts ([[float]]): explicit k-points.
+        weights ([float])
+        labels ([str]): labels or None per k-point.
+        chunk (int): 0-based.
+        n_chunks (int)
+
+    Returns:
+        ([[float]], [float], [str], dict): the k-points, weights and labels of
+        the chunk and the chunk info: chunk, n_chunks, n_zero_weight and the
+        range [start, stop) of the chunk in the zero-weight points.
+    """
+    if not 0 <= chunk < n_chunks:
+        raise ValueError("chunk {} out of range 0..{}".format(chunk, n_chunks - 1))
+    labels = list(labels) if labels else [None] * len(kpts)
+    zero = np.where(np.asarray(weights, dtype=float) == 0)[0]
+    if len(zero) < n_chunks:
+        raise ValueError("{} zero-weight k-points cannot be split in {} chunks".format(len(zero), n_chunks))
+    bounds = np.linspace(0, len(zero), n_chunks + 1).astype(int)
+    start, stop = int(bounds[chunk]), int(bounds[chunk + 1])
+    keep = np.ones(len(kpts), dtype=bool)
+    keep[zero] = False
+    keep[zero[start:stop]] = True
+    idx = np.where(keep)[0]
+    info = {"chunk": chunk, "n_chunks": n_chunks, "start": start, "stop": stop, "n_zero_weight": len(zero)}
+    return [list(kpts[i]) for i in idx], [weights[i] for i in idx], [labels[i] for i in idx], info
+
+
+def chunk_kpoints_file(filename, chunk, n_chunks):
+    """
+    Rewrite an explicit (Reciprocal) KPOINTS file with split_zero_weight.
+
+    Returns:
+        dict: the chunk info.
+    """
+    kpoints = Kpoints.from_file(filename)
+    if kpoints.style != Kpoints.supported_modes.Reciprocal or not kpoints.kpts_weights:
+        raise ValueError("{} has no explicit weighted k-points to split".format(filename))
+    kpts, weights, labels, info = split_zero_weight(kpoints.kpts, kpoints.kpts_weights, kpoints.labels,
+                                                    chunk, n_chunks)
+    Kpoints(comment="{} (chunk {}/{})".format(kpoints.comment, chunk + 1, n_chunks),
+            style=Kpoints.supported_modes.Reciprocal, num_kpts=len(kpts), kpts=kpts,
+            kpts_weights=weights, labels=labels).write_file(filename)
+    return info
+
+
+def merge_band_structures(band_structures, efermi_tol=0.05):
+    """
+    Stitch the band structures of consecutive chunks into one.
+
+    Args:
+        band_structures ([BandStructureSymmLine]): in chunk order.
+        efermi_tol (float): eV; a larger spread of the Fermi levels of the
+            chunks (which share the weighted mesh) is logged.
+
+    Returns:
+        BandStructureSymmLine: with the Fermi level, lattice and structure of
+        the first chunk. Chunks with more bands are cut to the smallest number
+        of bands.
+    """
+    first = band_structures[0]
+    efermis = [bs.efermi for bs in band_structures]
+    if max(efermis) - min(efermis) > efermi_tol:
+        logger.warning("Fermi levels of the chunks differ by {:.3f} eV".format(max(efermis) - min(efermis)))
+    nbands = min(bs.nb_bands for bs in band_structures)
+    if any(bs.nb_bands != nbands for bs in band_structures):
+        logger.warning("Chunks have different numbers of bands, keeping {}".format(nbands))
+
+    kpts, labels_dict = [], {}
+    for bs in band_structures:
+        for k in bs.kpoints:
+            kpts.append(k.frac_coords)
+            if k.label:
+                labels_dict[k.label] = k.frac_coords
+    eigenvals = {spin: np.hstack([bs.bands[spin][:nbands] for bs in band_structures]) for spin in first.bands}
+    projections = None
+    if all(bs.projections for bs in band_structures):
+        projections = {spin: np.concatenate([bs.projections[spin][:nbands] for bs in band_structures], axis=1)
+                       for spin in first.projections}
+    return BandStructureSymmLine(kpts, eigenvals, first.lattice_rec, first.efermi, labels_dict,
+                                 coords_are_cartesian=False, structure=first.structure, projections=projections)
@@ -0,0 +1,491 @@
+"""
+Database helpers on top of atomate's VaspCalcDb.
+
+"""
+
+import copy
+import datetime
+import hashlib
+import io
+import json
+import os
+import threading
+import zlib
+
+import gridfs
+import numpy as np
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+
+from monty.json import MontyEncoder, MontyDecoder, jsanitize
+
+from atomate.vasp.database import VaspCalcDb
+from atomate.utils.utils import get_logger
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+EIGENVALUE_KEYS = ("eigenvalues", "projected_eigenvalues")
+EIGENVALUE_FORMATS = ("json", "npz")
+# keys of calcs_reversed.0 that VaspCalcDb.insert_task moves to GridFS
+GRIDFS_KEYS = ("dos", "bandstructure", "chgcar", "locpot", "aeccar0", "aeccar1", "aeccar2", "elfcar")
+
+# Indexes each *ToDb task relies on, applied to every collection it writes.
+# A str is a single field index, a tuple a compound index (ascending). A
+# compound index also serves queries on its leading fields, so e.g.
+# task_label alone needs no index of its own.
+TASK_INDEXES = {
+    "VaspToDb": [
+        ("task_label", "charge_state", "nupdown_set"),
+        ("c2db_uid", "task_label"),
+        ("prev_fw_collection", "prev_fw_taskid"),
+        "wf",
+        "kpoints_chunk.group",
+        "charge_state",
+        "dir_name",
+    ],
+    "IRVSPToDb": [
+        ("c2db_uid", "task_label"),
+        ("task_label", "charge_state"),
+        ("prev_fw_collection", "prev_fw_taskid"),
+        "dir_name",
+    ],
+    "PyzfsToDb": [
+        ("task_label", "charge_state"),
+        ("c2db_uid", "task_label"),
+        ("prev_fw_collection", "prev_fw_taskid"),
+        "dir_name",
+    ],
+}
+
+
+def encode_eigenvalues(eigenvalues, fmt="npz", dtype=None):
+    """
+    Serialize an eigenvalue dict ({spin: array}) for GridFS.
+
+    Args:
+        eigenvalues (dict): eigenvalues or projected eigenvalues keyed by spin.
+        fmt (str): "npz" for a binary NumPy archive (one typed, shaped array
+            per spin) or "json" for the legacy MontyEncoder JSON text.
+        dtype (str): cast the arrays before storing, e.g. "float32". Only used
+            by the "npz" format.
+
+    Returns:
+        bytes
+    """
+    if fmt == "json":
+        return json.dumps(eigenvalues, cls=MontyEncoder).encode()
+    if fmt != "npz":
+        raise ValueError("Unknown eigenvalues format: {}".format(fmt))
+    arrays = {}
+    for spin, v in eigenvalues.items():
+        arrays[str(spin)] = np.asarray(v, dtype=dtype) if dtype else np.asarray(v)
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode_eigenvalues(data, fmt="json"):
+    """
+    Inverse of encode_eigenvalues. Blobs written before the format was
+    recorded are JSON.
+
+    Returns:
+        {str: np.array}: arrays keyed by spin ("1", "-1").
+    """
+    if fmt == "npz":
+        with np.load(io.BytesIO(data)) as npz:
+            return {k: npz[k] for k in npz.files}
+    d = json.loads(data.decode() if isinstance(data, bytes) else data, cls=MontyDecoder)
+    return {str(k): np.asarray(v) for k, v in d.items()}
+
+
+class JVaspCalcDb(VaspCalcDb):
+    """
+    VaspCalcDb that stores eigenvalues and projected eigenvalues in GridFS as
+    binary arrays and can read them back as NumPy arrays.
+
+    With deduplicate set, GridFS payloads are content addressed: a payload
+    whose sha256 is already stored in the same GridFS collection is not
+    uploaded again, the existing file gets its metadata.refcount incremented
+    and its id is returned. Use delete_gridfs/delete_task to remove data so
+    shared files are only deleted with their last reference.
+    """
+
+    deduplicate = False
+
+    # (host, db, collection, tasks) already indexed by this process
+    _indexed = set()
+
+    def build_indexes(self, indexes=None, background=True):
+        """
+        Build the atomate task indexes plus the indexes of all *ToDb tasks
+        in TASK_INDEXES.
+        """
+        super(JVaspCalcDb, self).build_indexes(indexes=indexes, background=background)
+        self.ensure_indexes(background=background)
+
+    def ensure_indexes(self, tasks=None, background=True):
+        """
+        Idempotently create the indexes the given *ToDb tasks rely on in the
+        current collection. Existing indexes are left alone and every
+        (collection, tasks) combination is only sent to the server once per
+        process, so this is cheap to call before each insert.
+
+        Args:
+            tasks (str or [str]): keys of TASK_INDEXES. Default: all.
+            background (bool): build new indexes in the background.
+
+        Returns:
+            [str]: names of the indexes (created or already present).
+        """
+        tasks = [tasks] if isinstance(tasks, str) else sorted(tasks or TASK_INDEXES)
+        key = (self.host, self.db_name, self.collection.name, tuple(tasks))
+        if key in JVaspCalcDb._indexed:
+            return []
+
+        specs = [("task_id",)]
+        for task in tasks:
+            for fields in TASK_INDEXES[task]:
+                fields = (fields,) if isinstance(fields, str) else tuple(fields)
+                if fields not in specs:
+                    specs.append(fields)
+
+        names = []
+        for fields in specs:
+            try:
+                names.append(self.collection.create_index([(f, ASCENDING) for f in fields],
+                                                          unique=fields == ("task_id",),
+                                                          background=background))
+            except OperationFailure as err:
+                # e.g. duplicate task_ids in an old collection or an existing
+                # index with the same name but other options
+                logger.warning("Index {} on {} not created: {}".format(fields, self.collection.name, err))
+        JVaspCalcDb._indexed.add(key)
+        return names + self.ensure_gridfs_indexes(background=background)
+
+    def ensure_gridfs_indexes(self, collections=None, background=True):
+        """
+        Idempotently create the metadata.sha256 index deduplicated GridFS
+        inserts look up, once per (GridFS collection, process).
+
+        Args:
+            collections ([str]): GridFS collections. Default: "fs" and the
+                <name>_fs collections of GRIDFS_KEYS and EIGENVALUE_KEYS.
+            background (bool): build new indexes in the background.
+
+        Returns:
+            [str]: names of the indexes (created or already present).
+        """
+        collections = collections or ["fs"] + ["{}_fs".format(k) for k in GRIDFS_KEYS + EIGENVALUE_KEYS]
+        names = []
+        for collection in collections:
+            key = (self.host, self.db_name, collection, ("sha256",))
+            if key in JVaspCalcDb._indexed:
+                continue
+            try:
+                names.append(self.db["{}.files".format(collection)].create_index("metadata.sha256",
+                                                                                 background=background))
+            except OperationFailure as err:
+                logger.warning("Index metadata.sha256 on {} not created: {}".format(collection, err))
+            JVaspCalcDb._indexed.add(key)
+        return names
+
+    def insert_gridfs(self, d, collection="fs", compress=True, oid=None, task_id=None, precompressed=False,
+                      sha256=None):
+        """
+        Same as VaspCalcDb.insert_gridfs, but d may be str or bytes. With
+        precompressed, d is already zlib-compressed (e.g. by a worker process)
+        and is stored as is.
+
+        With deduplicate, payloads are identified by the sha256 of the
+        uncompressed bytes, so the compression level does not matter. Pass
+        sha256 along with precompressed data to save decompressing it here.
+        """
+        oid = oid or ObjectId()
+        if isinstance(d, str):
+            d = d.encode()
+        digest = None
+        if self.deduplicate:
+            digest = sha256 or hashlib.sha256(zlib.decompress(d) if precompressed else d).hexdigest()
+        compression_type = None
+        if precompressed:
+            compression_type = "zlib"
+        elif compress:
+            d = zlib.compress(d, compress)
+            compression_type = "zlib"
+
+        metadata = {"compression": compression_type}
+        if task_id:
+            metadata["task_id"] = task_id
+
+        if self.deduplicate:
+            files = self.db["{}.files".format(collection)]
+            self.ensure_gridfs_indexes([collection])
+            update = {"$inc": {"metadata.refcount": 1}}
+            if task_id:
+                update["$addToSet"] = {"metadata.task_ids": task_id}
+            existing = files.find_one_and_update({"metadata.sha256": digest}, update,
+                                                 projection={"metadata.compression": 1})
+            if existing:
+                logger.info("Reusing GridFS file {} in {}".format(existing["_id"], collection))
+                return existing["_id"], existing["metadata"]["compression"]
+            metadata.update({"sha256": digest, "refcount": 1, "task_ids": [task_id] if task_id else []})
+
+        fs = gridfs.GridFS(self.db, collection)
+        fs_id = fs.put(d, _id=oid, metadata=metadata)
+        return fs_id, compression_type
+
+    def delete_gridfs(self, fs_id, collection="fs"):
+        """
+        Drop one reference to a GridFS file and delete the file once nothing
+        references it. Files written without deduplication have no refcount
+        and are deleted right away.
+
+        Returns:
+            bool: whether the file was deleted.
+        """
+        files = self.db["{}.files".format(collection)]
+        doc = files.find_one_and_update({"_id": fs_id, "metadata.refcount": {"$gt": 1}},
+                                        {"$inc": {"metadata.refcount": -1}})
+        if doc:
+            return False
+        gridfs.GridFS(self.db, collection).delete(fs_id)
+        return True
+
+    def delete_task(self, task_id):
+        """
+        Delete a task document together with its GridFS data
+        (calcs_reversed.0.<name>_fs_id -> <name>_fs), respecting refcounts.
+        """
+        doc = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": {"$slice": 1}})
+        if doc is None:
+            return
+        for calc in doc.get("calcs_reversed", []):
+            for key, fs_id in calc.items():
+                if key.endswith("_fs_id"):
+                    self.delete_gridfs(fs_id, "{}_fs".format(key[:-len("_fs_id")]))
+        self.collection.delete_one({"task_id": task_id})
+
+    def insert_eigenvalues(self, task_id, name, eigenvalues, fmt="npz", dtype=None):
+        """
+        Store eigenvalues/projected eigenvalues of calcs_reversed.0 in GridFS
+        and point the task document to them.
+
+        Args:
+            task_id (int): task_id of the task document.
+            name (str): "eigenvalues" or "projected_eigenvalues".
+            eigenvalues (dict): arrays keyed by spin.
+            fmt (str): "npz" or "json", see encode_eigenvalues.
+            dtype (str): e.g. "float32" to halve the stored size.
+
+        Returns:
+            (ObjectId, int): GridFS id and the number of bytes stored.
+        """
+        data = encode_eigenvalues(eigenvalues, fmt=fmt, dtype=dtype)
+        fs_id, compression_type = self.insert_gridfs(data, "{}_fs".format(name), task_id=task_id)
+        self.collection.update_one(
+            {"task_id": task_id},
+            {"$set": {"calcs_reversed.0.{}_compression".format(name): compression_type,
+                      "calcs_reversed.0.{}_fs_id".format(name): fs_id,
+                      "calcs_reversed.0.{}_format".format(name): fmt}})
+        return fs_id, len(data)
+
+    def insert_task(self, task_doc, use_gridfs=False, eigenvalues_format="json", eigenvalues_dtype=None,
+                    deduplicate=None):
+        """
+        Insert a task document. With use_gridfs, eigenvalues and projected
+        eigenvalues of the last calculation are written to GridFS in
+        eigenvalues_format ("json" or "npz"); everything else is handled by
+        VaspCalcDb.insert_task. deduplicate, if not None, sets
+        self.deduplicate.
+        """
+        if deduplicate is not None:
+            self.deduplicate = deduplicate
+        eigenvals = {}
+        if use_gridfs and "calcs_reversed" in task_doc:
+            output = task_doc["calcs_reversed"][0]["output"]
+            for name in EIGENVALUE_KEYS:
+                if name in output:  # only store idx=0 data
+                    eigenvals[name] = output.pop(name)
+
+        t_id = super(JVaspCalcDb, self).insert_task(task_doc, use_gridfs=use_gridfs)
+
+        for name, data in eigenvals.items():
+            self.insert_eigenvalues(t_id, name, data, fmt=eigenvalues_format, dtype=eigenvalues_dtype)
+        return t_id
+
+    def reserve_task_ids(self, n):
+        """
+        Reserve n consecutive task_ids with a single counter update.
+
+        CalcDb.insert takes the counter after its increment in atomate 0.9.5,
+        but before it in older releases. The counter is therefore advanced by
+        n + 1 and the ids strictly between its old and new value are returned,
+        which no direct insert hands out under either convention.
+
+        Returns:
+            [int]
+        """
+        before = self.db.counter.find_one_and_update(
+            {"_id": "taskid"}, {"$inc": {"c": n + 1}}, upsert=True, return_document=ReturnDocument.BEFORE)
+        before = before["c"] if before else 0
+        return list(range(before + 1, before + n + 1))
+
+    def assign_task_id(self, doc):
+        """
+        The task_id doc will get on insertion: the one of an existing
+        document with the same dir_name, else a newly reserved one. Lets a
+        document that is inserted later (spooled) carry its final task_id.
+
+        Returns:
+            int
+        """
+        existing = self.collection.find_one({"dir_name": doc["dir_name"]}, ["task_id"])
+        doc["task_id"] = existing["task_id"] if existing else self.reserve_task_ids(1)[0]
+        return doc["task_id"]
+
+    def insert_many(self, docs, use_gridfs=False, eigenvalues_format="json", eigenvalues_dtype=None,
+                    deduplicate=None):
+        """
+        Bulk version of insert/insert_task. Documents are matched on dir_name
+        like CalcDb.insert (an existing document keeps its task_id and is
+        updated; of several documents with one dir_name in docs the last one
+        is inserted, as consecutive inserts would leave it), new task_ids are
+        reserved in one counter update, GridFS payloads are uploaded first and
+        their ids written into the documents, and everything is sent in one
+        bulk_write. If the bulk_write fails, the uploaded payloads are deleted
+        again, so a retry does not leave orphans.
+
+        Args:
+            docs ([dict]): task documents, or any documents with a dir_name
+                for plain collections (IRVSP, pyzfs).
+            use_gridfs (bool): move DOS, band structure, volumetric data and
+                eigenvalues of calcs_reversed.0 to GridFS, as insert_task does.
+            eigenvalues_format (str): see insert_task.
+            eigenvalues_dtype (str): see insert_task.
+            deduplicate (bool): see insert_task.
+
+        Returns:
+            [int]: task_ids in the order of docs.
+        """
+        if deduplicate is not None:
+            self.deduplicate = deduplicate
+        if not docs:
+            return []
+        latest = {d["dir_name"]: d for d in docs}
+        existing = {e["dir_name"]: e["task_id"] for e in
+                    self.collection.find({"dir_name": {"$in": list(latest)}}, ["dir_name", "task_id"])}
+        n_new = sum(1 for d in latest.values() if not d.get("task_id") and d["dir_name"] not in existing)
+        new_ids = iter(self.reserve_task_ids(n_new) if n_new else [])
+
+        requests, uploaded = [], []
+        try:
+            for d in latest.values():
+                if d["dir_name"] in existing:
+                    d["task_id"] = existing[d["dir_name"]]
+                elif not d.get("task_id"):
+                    d["task_id"] = next(new_ids)
+                d["last_updated"] = datetime.datetime.utcnow()
+
+                if use_gridfs and "calcs_reversed" in d:
+                    calc = d["calcs_reversed"][0]
+                    for name in GRIDFS_KEYS:
+                        if name in calc:
+                            data = json.dumps(calc.pop(name), cls=MontyEncoder)
+                            fs_id, compression_type = self.insert_gridfs(data, "{}_fs".format(name), task_id=d["task_id"])
+                            uploaded.append((fs_id, "{}_fs".format(name)))
+                            calc["{}_fs_id".format(name)] = fs_id
+                            calc["{}_compression".format(name)] = compression_type
+                    for name in EIGENVALUE_KEYS:
+                        if name in calc["output"]:
+                            data = encode_eigenvalues(calc["output"].pop(name), fmt=eigenvalues_format,
+                                                      dtype=eigenvalues_dtype)
+                            fs_id, compression_type = self.insert_gridfs(data, "{}_fs".format(name), task_id=d["task_id"])
+                            uploaded.append((fs_id, "{}_fs".format(name)))
+                            calc["{}_fs_id".format(name)] = fs_id
+                            calc["{}_compression".format(name)] = compression_type
+                            calc["{}_format".format(name)] = eigenvalues_format
+
+                d = jsanitize(d, allow_bson=True)
+                requests.append(UpdateOne({"dir_name": d["dir_name"]}, {"$set": d}, upsert=True))
+
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            for fs_id, collection in uploaded:
+                self.delete_gridfs(fs_id, collection)
+            raise
+        logger.info("Inserted {} documents into {}".format(len(requests), self.collection.name))
+        return [latest[d["dir_name"]]["task_id"] for d in docs]
+
+    def get_eigenvalues(self, task_id, name="eigenvalues"):
+        """
+        Read eigenvalues or projected eigenvalues of a task from GridFS.
+        Works for both npz and legacy JSON blobs.
+
+        Args:
+            task_id (int): task_id of the task document.
+            name (str): "eigenvalues" or "projected_eigenvalues".
+
+        Returns:
+            {str: np.array}: arrays keyed by spin ("1", "-1").
+        """
+        doc = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": {"$slice": 1}})
+        calc = doc["calcs_reversed"][0]
+        fs = gridfs.GridFS(self.db, "{}_fs".format(name))
+        data = fs.get(calc["{}_fs_id".format(name)]).read()
+        if calc.get("{}_compression".format(name)) == "zlib":
+            data = zlib.decompress(data)
+        return decode_eigenvalues(data, fmt=calc.get("{}_format".format(name), "json"))
+
+
+_db_cache = {}
+_db_cache_pid = os.getpid()
+_db_cache_lock = threading.Lock()
+
+
+def _clear_db_cache():
+    """
+    Forget cached clients without closing them; after a fork they belong to
+    the parent process (MongoClient is not fork-safe).
+    """
+    global _db_cache_pid
+    _db_cache.clear()
+    _db_cache_pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_clear_db_cache)
+
+
+def get_calc_db(db_file, admin=True):
+    """
+    JVaspCalcDb for db_file that reuses one MongoClient per process.
+
+    Clients are cached by the contents of db_file (and admin), so consecutive
+    firetasks of a rocket share one connection pool instead of connecting and
+    authenticating every time. Each call returns a shallow copy, so changing
+    the collection or other attributes of the returned object does not affect
+    other users of the cached client. The cache is dropped in forked child
+    processes.
+
+    Args:
+        db_file (str): path to the db.json with the credentials.
+        admin (bool): use the admin credentials.
+
+    Returns:
+        JVaspCalcDb
+    """
+    with open(db_file, "rb") as f:
+        key = (hashlib.sha256(f.read()).hexdigest(), admin)
+    with _db_cache_lock:
+        if os.getpid() != _db_cache_pid:
+            _clear_db_cache()
+        mmdb = _db_cache.get(key)
+        if mmdb is None:
+            mmdb = JVaspCalcDb.from_db_file(db_file, admin=admin)
+            _db_cache[key] = mmdb
+    return copy.copy(mmdb)
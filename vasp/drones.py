@@ -0,0 +1,322 @@
+"""
+Drones for assimilating VASP runs.
+
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+import types
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+from monty.json import MontyEncoder, MontyDecoder
+
+from pymatgen.electronic_structure.core import Orbital, Spin
+from pymatgen.io.vasp.outputs import Vasprun
+
+from atomate.vasp.drones import VaspDrone
+from atomate.utils.utils import get_logger, get_uri
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+# default directory of parse_cache=True; outside the launch dirs, so the cache
+# is neither transferred with the outputs nor read from copied launch dirs
+PARSE_CACHE_DIR = os.path.join("~", ".cache", "vasp_parse_cache")
+# files VaspDrone reads (incl. the relax1/relax2 and .gz/.orig variants, which
+# share the prefix)
+PARSE_CACHE_FILES = ("vasprun.xml", "OUTCAR", "INCAR", "KPOINTS", "POSCAR", "POTCAR", "CONTCAR",
+                     "transformations.json", "custodian.json")
+# files of which VaspDrone only records the presence (output_file_paths),
+# unless they are parsed as volumetric data or for Bader
+PARSE_CACHE_PRESENCE = ("CHGCAR", "LOCPOT", "AECCAR0", "AECCAR1", "AECCAR2", "ELFCAR", "WAVECAR", "PROCAR",
+                        "OPTIC")
+
+_SET_COMMENT = re.compile(r'<set\s+comment="\s*(\w+)\s*(\d+)\s*"')
+_FIELD = re.compile(r"<field[^>]*>\s*([^<]*?)\s*</field>")
+
+
+class _HeavyBlockFilter:
+    """
+    File-like wrapper around an open vasprun.xml stream. Lines belonging to the
+    <projected> block and to the <partial> block of <dos> are parsed row by row
+    into flat float buffers and never handed to the XML parser, so no DOM is
+    built for them. Everything else is passed through untouched.
+
+    VASP writes one <r> row per line, which is what makes the line-based
+    parsing safe.
+    """
+
+    def __init__(self, stream, parse_projected=True, parse_partial_dos=True):
+        self._stream = stream
+        self._parse_projected = parse_projected
+        self._parse_partial_dos = parse_partial_dos
+        self._pending = ""
+        self._block = None
+        self._in_dos = False
+
+        self.projected = None
+        self.partial_dos = None
+
+    def read(self, size=-1):
+        chunks, n = [self._pending], len(self._pending)
+        while size < 0 or n < size:
+            line = self._stream.readline()
+            if not line:
+                break
+            line = self._filter(line)
+            chunks.append(line)
+            n += len(line)
+        data = "".join(chunks)
+        if size < 0:
+            size = len(data)
+        out, self._pending = data[:size], data[size:]
+        return out
+
+    def _filter(self, line):
+        stripped = line.strip()
+        if self._block == "projected":
+            if stripped.startswith("</projected>"):
+                self._block = None
+            else:
+                self._projected_line(stripped)
+            return ""
+        if self._block == "partial":
+            if stripped.startswith("</partial>"):
+                self._block = None
+            else:
+                self._partial_line(stripped)
+            return ""
+
+        if stripped == "<projected>" and self._parse_projected:
+            self._block = "projected"
+            self.projected = {"fields": [], "spins": defaultdict(lambda: array("d")),
+                              "nkpts": defaultdict(int), "nbands": 0, "spin": None, "skip": False}
+            return ""
+        if stripped.startswith("<dos"):
+            self._in_dos = stripped.startswith("<dos>")
+        elif stripped.startswith("</dos>"):
+            self._in_dos = False
+        elif stripped == "<partial>" and self._in_dos and self._parse_partial_dos:
+            self._block = "partial"
+            self.partial_dos = {"fields": [], "ions": [], "spin": None}
+            return ""
+        return line
+
+    def _projected_line(self, stripped):
+        p = self.projected
+        # the <eigenvalues> copy nested in <projected> is already parsed by Vasprun
+        if stripped.startswith("<eigenvalues"):
+            p["skip"] = True
+        elif stripped.startswith("</eigenvalues>"):
+            p["skip"] = False
+        elif p["skip"]:
+            return
+        elif stripped.startswith("<r>"):
+            p["spins"][p["spin"]].extend(map(float, stripped[3:-4].split()))
+        elif stripped.startswith("<set comment"):
+            kind, idx = _SET_COMMENT.search(stripped).groups()
+            if kind == "spin":
+                p["spin"] = int(idx)
+            elif kind == "kpoint":
+                p["nkpts"][p["spin"]] += 1
+            elif kind == "band" and p["nkpts"][p["spin"]] == 1 and p["spin"] == 1:
+                p["nbands"] += 1
+        elif stripped.startswith("<field"):
+            p["fields"].append(_FIELD.search(stripped).group(1))
+
+    def _partial_line(self, stripped):
+        p = self.partial_dos
+        if stripped.startswith("<r>"):
+            p["ions"][-1][p["spin"]].extend(map(float, stripped[3:-4].split()))
+        elif stripped.startswith("<set comment"):
+            kind, idx = _SET_COMMENT.search(stripped).groups()
+            if kind == "ion":
+                p["ions"].append({})
+            elif kind == "spin":
+                p["spin"] = int(idx)
+                p["ions"][-1][p["spin"]] = array("d")
+        elif stripped.startswith("<field"):
+            p["fields"].append(_FIELD.search(stripped).group(1))
+
+    def get_projected_eigenvalues(self):
+        """
+        Returns:
+            ({Spin: np.array}, np.array or None): projected eigenvalues with
+            shape (nkpts, nbands, nions, norbs) and, for non-collinear runs,
+            the projected magnetisation, exactly as Vasprun lays them out.
+        """
+        p = self.projected
+        norbs = len(p["fields"])
+        proj = {}
+        for spin, buf in p["spins"].items():
+            data = np.frombuffer(buf, dtype=np.float64)
+            nkpts = p["nkpts"][spin]
+            proj[spin] = data.reshape(nkpts, p["nbands"], -1, norbs)
+        if len(proj) > 2:
+            proj_mag = np.stack([proj.pop(i) for i in range(2, 5)], axis=-1)
+            return {Spin.up: proj[1]}, proj_mag
+        return {Spin.up if k == 1 else Spin.down: v for k, v in proj.items()}, None
+
+    def get_partial_dos(self):
+        """
+        Returns:
+            [{orbital: {Spin: np.array}}]: site-projected DOS in the same
+            structure as Vasprun.pdos.
+        """
+        orbs = [f.strip() for f in self.partial_dos["fields"][1:]]
+        lm = any("x" in s for s in orbs)
+        pdoss = []
+        for ion in self.partial_dos["ions"]:
+            pdos = defaultdict(dict)
+            for spin_idx, buf in ion.items():
+                spin = Spin.up if spin_idx == 1 else Spin.down
+                data = np.frombuffer(buf, dtype=np.float64).reshape(-1, len(orbs) + 1)
+                for j in range(1, data.shape[1]):
+                    orb = Orbital(j - 1) if lm else orbs[j - 1].upper()
+                    pdos[orb][spin] = data[:, j]
+            pdoss.append(pdos)
+        return pdoss
+
+
+class StreamingVasprun(Vasprun):
+    """
+    Vasprun that streams the <projected> and partial <dos> blocks line by line
+    instead of building them as XML elements. Those two blocks dominate the
+    DOM of large supercells (and of runs with a large NEDOS); the remaining
+    document is still handled by Vasprun itself, so every attribute ends up
+    identical to a regular Vasprun parse.
+    """
+
+    def _parse(self, stream, parse_dos, parse_eigen, parse_projected_eigen):
+        filtered = _HeavyBlockFilter(stream, parse_projected=parse_projected_eigen, parse_partial_dos=parse_dos)
+        super(StreamingVasprun, self)._parse(filtered, parse_dos, parse_eigen, False)
+
+        if filtered.projected is not None:
+            self.projected_eigenvalues, proj_mag = filtered.get_projected_eigenvalues()
+            if hasattr(self, "projected_magnetisation"):
+                self.projected_magnetisation = proj_mag
+        if filtered.partial_dos is not None:
+            self.pdos = filtered.get_partial_dos()
+
+
+def _with_vasprun_class(func, cls):
+    """
+    Copy of a function of atomate.vasp.drones that resolves the global name
+    Vasprun to cls. The module itself is left alone, so drones with and
+    without streaming can parse concurrently in one process.
+    """
+    return types.FunctionType(func.__code__, dict(func.__globals__, Vasprun=cls), func.__name__,
+                              func.__defaults__, func.__closure__)
+
+
+_streaming_process_vasprun = _with_vasprun_class(VaspDrone.process_vasprun, StreamingVasprun)
+
+
+class JVaspDrone(VaspDrone):
+    """
+    VaspDrone with an optional streaming vasprun.xml parser and an optional
+    on-disk cache of parsed task documents.
+
+    Args:
+        streaming (bool): parse vasprun.xml with StreamingVasprun, which keeps
+            the projected eigenvalues and partial DOS out of the XML tree.
+            The resulting task document is the same as with VaspDrone.
+        parse_cache (bool or str): cache the parsed document as gzipped JSON
+            (MontyEncoder). True stores it in PARSE_CACHE_DIR, a str is used
+            as cache directory. Only the newest entry per launch dir is kept.
+            The cache key covers the drone settings, the directory and the
+            name, size and mtime of the files the drone parses (vasprun.xml,
+            OUTCAR and the inputs, incl. their relax variants, plus the
+            volumetric files it is set to parse), so a change to any of
+            them triggers a fresh parse. Of CHGCAR, WAVECAR, ... otherwise
+            only the names count.
+        parse_cache_hash (bool): key the cache on the file contents (sha256)
+            instead of size/mtime, e.g. when files are copied around with new
+            mtimes. Hashing is still much cheaper than parsing.
+        \*\*kwargs: passed to VaspDrone.
+    """
+
+    def __init__(self, streaming=False, parse_cache=False, parse_cache_hash=False, **kwargs):
+        self.streaming = streaming
+        self.parse_cache = parse_cache
+        self.parse_cache_hash = parse_cache_hash
+        self._settings = kwargs
+        super(JVaspDrone, self).__init__(**kwargs)
+
+    def process_vasprun(self, dir_name, taskname, filename):
+        if not self.streaming:
+            return super(JVaspDrone, self).process_vasprun(dir_name, taskname, filename)
+        logger.info("Streaming parse of {}".format(filename))
+        return _streaming_process_vasprun(self, dir_name, taskname, filename)
+
+    def assimilate(self, path):
+        if not self.parse_cache:
+            return super(JVaspDrone, self).assimilate(path)
+
+        path = os.path.abspath(path)
+        cache_dir = os.path.expanduser(PARSE_CACHE_DIR if self.parse_cache is True else self.parse_cache)
+        prefix = hashlib.sha256(path.encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, "{}_{}.json.gz".format(prefix, self._cache_key(path)))
+        if os.path.exists(cache_file):
+            try:
+                with gzip.open(cache_file, "rt") as f:
+                    doc = json.load(f, cls=MontyDecoder)
+                logger.info("Using cached parse of {}".format(path))
+                doc["dir_name"] = get_uri(path)
+                doc["last_updated"] = datetime.datetime.utcnow()
+                return doc
+            except Exception as err:
+                logger.warning("Ignoring unreadable parse cache {}: {}".format(cache_file, err))
+
+        doc = super(JVaspDrone, self).assimilate(path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # older entries of this launch dir are stale
+        for f in os.listdir(cache_dir):
+            if f.startswith(prefix + "_"):
+                os.remove(os.path.join(cache_dir, f))
+        tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+        try:
+            with gzip.open(tmp, "wt", compresslevel=1) as f:
+                json.dump(doc, f, cls=MontyEncoder)
+            os.replace(tmp, cache_file)
+        except Exception as err:
+            logger.warning("Not caching the parse of {}: {}".format(path, err))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return doc
+
+    def _cache_key(self, path):
+        h = hashlib.sha256()
+        h.update(json.dumps({"path": path, "streaming": self.streaming, "settings": self._settings},
+                            sort_keys=True, default=str).encode())
+        parsed = set(PARSE_CACHE_FILES) | {f.upper() for f in self.store_volumetric_data}
+        if self.parse_locpot:
+            parsed.add("LOCPOT")
+        if self.parse_bader:
+            parsed |= {"CHGCAR", "AECCAR0", "AECCAR2"}
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            if not entry.name.startswith(tuple(parsed)):
+                if entry.name.startswith(PARSE_CACHE_PRESENCE):
+                    h.update(entry.name.encode())
+                continue
+            st = entry.stat()
+            h.update("{}:{}".format(entry.name, st.st_size).encode())
+            if self.parse_cache_hash:
+                with open(entry.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+            else:
+                h.update(str(st.st_mtime_ns).encode())
+        return h.hexdigest()
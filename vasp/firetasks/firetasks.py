@@ -6,24 +6,41 @@ from fireworks import FiretaskBase, FWAction, explicit_serialize
 from fireworks.utilities.fw_serializers import DATETIME_HANDLER
 
 from pymatgen.io.vasp.inputs import *
+from pymatgen.io.vasp.outputs import Outcar
 from pymatgen.io.vasp.sets import MPStaticSet, MVLGWSet, MPHSEBSSet
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.symmetry.bandstructure import HighSymmKpath
 
 from atomate.vasp.database import VaspCalcDb
-from atomate.utils.utils import env_chk
+from atomate.utils.utils import env_chk, get_logger, get_uri
 from atomate.vasp.config import *
 from atomate.vasp.drones import VaspDrone
 from atomate.common.firetasks.glue_tasks import get_calc_loc
+from atomate.vasp.firetasks.glue_tasks import CopyVaspOutputs
 
+from ..drones import JVaspDrone
+from ..database import get_calc_db, GRIDFS_KEYS, EIGENVALUE_KEYS
+from ..spool import spool_or_insert, make_record, write_record, reserve_spooled_task_id
+from ..uploader import enqueue_transfer
+from ..staging import stage_artifact, unread_artifacts
+from ..wavecar import MappedWavecar, write_wavecar_subset, bands_in_window, occupied_bands
+from ..symmetry_cache import get_symmetry_cache
+from ..kpath2d import ir_mesh_2d, dedupe_consecutive, kpath_2d_line_mode
+from ..bs_chunks import chunk_kpoints_file, merge_band_structures
+from ..transfer import connect, connection_pool, put_files, archive_files, rtransfer_jobs, scp_command, \
+    ssh_multiplex_options, TransferPolicy
 
 
 from monty.shutil import compress_dir, decompress_dir
+from monty.os.path import zpath
+from monty.json import MontyEncoder
 
 from glob import glob
 
-import shutil, gzip, os, re, traceback, time
+import shutil, gzip, errno, os, re, traceback, time, json
+import numpy as np
 
+logger = get_logger(__name__)
 
 @explicit_serialize
 class RmSelectiveDynPoscar(FiretaskBase):
@@ -143,11 +160,44 @@ class FileTransferTask(FiretaskBase):
         - server: (str) server host for remote transfer
         - user: (str) user to authenticate with on remote server
         - key_filename: (str) optional SSH key location for remote transfer
-        - max_retry: (int) number of times to retry failed transfers; defaults to `0` (no retries)
-        - retry_delay: (int) number of seconds to wait between retries; defaults to `10`
+        - max_retry: (int) number of times to retry a failed file; defaults to `0` (no retries)
+        - retry_delay: (int) number of seconds to wait before the first retry, doubled for every
+                further retry; defaults to `10`
+        - workers: (int) rtransfer only, number of files sent concurrently over separate
+                SFTP channels, largest first; defaults to `1`
+        - sessions: (int) rtransfer only, number of SSH sessions the workers are spread over;
+                defaults to `1`. More sessions help large files through a slow tunnel.
+        - sync: (str) rtransfer only, skip files the destination already has: "mtime" (same size
+                and mtime) or "checksum" (same sha256). Interrupted uploads are resumed.
+                Defaults to None (send everything).
+        - reuse_connection: (bool) rtransfer only, borrow SSH sessions from the process-wide
+                connection pool and return them afterwards, so later fireworks of the same
+                rocket skip the handshake. Stale sessions are replaced. Defaults to True.
+        - archive: (str) rtransfer only, send the files as one tar stream compressed on the fly
+                with "gzip" or "zstd" (or uncompressed with "tar") and unpacked on the remote
+                side. Much faster for the large text outputs. Requires tar (and the
+                decompressor) on the remote host. workers and sessions are ignored.
+        - verify: (str) rtransfer only, check every file after the upload, "size" or "checksum";
+                defaults to "size". The result is written to .transfer_manifest.json.
+        - policy: (dict) rtransfer only, TransferPolicy (vasp.transfer) as dict: include/exclude
+                globs, max_size, compress_above (sent as compressed stream) and defer_above (left
+                to the background uploader in async_queue).
+        - async_queue: (str) rtransfer only, do not transfer now but queue a manifest in this
+                directory (env_chk-able, on a shared filesystem) for the uploader daemon, see
+                vasp.uploader. The file list is fixed at queue time. With policy.defer_above,
+                only the deferred files are queued and the others are sent right away.
+        - db_file: (str) with async_queue, database whose task document of this launch dir
+                receives the transfer result.
+
+    In rtransfer mode, the transfer statistics (bytes, seconds and MB/s in total and per file)
+    are returned in stored_data["transfer"]. Files are retried one by one and resumed from their
+    partial upload; completed files are recorded in .transfer_state.json, so a rerun of the
+    firework continues after the last completed file.
     """
     required_params = ["mode", "files", "dest", "port"]
-    optional_params = ["server", "user", "key_filename", "max_retry", "retry_delay"]
+    optional_params = ["server", "user", "key_filename", "max_retry", "retry_delay", "workers", "sessions",
+                       "sync", "archive", "reuse_connection", "verify", "policy", "async_queue",
+                       "db_file"]
 
     fn_list = {
         "move": shutil.move,
@@ -168,75 +218,94 @@ class FileTransferTask(FiretaskBase):
         key_filename = env_chk(self.get('key_filename'), fw_spec)
 
         if mode == 'rtransfer':
-            # remote transfers
-            # Create SFTP connection
-            import paramiko
-            ssh = paramiko.SSHClient()
-            # ssh.load_host_keys(os.path.expanduser(os.path.join("~", ".ssh", "known_hosts")))
-            ssh.load_system_host_keys()
-            ssh.connect(self['server'], username=self.get('user'),
-                        key_filename=os.path.expanduser(os.path.join("~", ".ssh", "id_rsa")), port=self["port"])
-            sftp = ssh.open_sftp()
-
-
-        for f in self["files"]:
-            try:
-                if "all" == f:
-                    src = os.getcwd().split("/")[-1]
-                    dest = os.path.join(self["dest"], src)
-                    # sftp.mkdir(dest)
-
-                    for file in glob("*"):
-                        try:
-                            sftp.put(file, os.path.join(dest, file))
-                        except FileNotFoundError:
-                            sftp.mkdir(dest)
-                            sftp.put(file, os.path.join(dest, file))
-                else:
-                    if 'src' in f:
-                        src = os.path.abspath(os.path.expanduser(os.path.expandvars(f['src']))) if shell_interpret else f['src']
-                    else:
-                        src = abspath(os.path.expanduser(os.path.expandvars(f))) if shell_interpret else f
-
-                    if mode == 'rtransfer':
-                        dest = self['dest']
-                        if os.path.isdir(src):
-                            if not self._rexists(sftp, dest):
-                                sftp.mkdir(dest)
-
-                            for f in os.listdir(src):
-                                if os.path.isfile(os.path.join(src,f)):
-                                    sftp.put(os.path.join(src, f), os.path.join(dest, f))
-                        else:
-                            if not self._rexists(sftp, dest):
-                                sftp.mkdir(dest)
-
-                            sftp.put(src, os.path.join(dest, os.path.basename(src)))
+            jobs = rtransfer_jobs(self["files"], self["dest"], shell_interpret)
+            policy, parts = None, {}
+            if self.get('policy'):
+                policy = TransferPolicy.from_dict(self['policy'])
+                parts = policy.select(jobs)
+                jobs = parts["now"]
+                policy_stats = {k: [os.path.basename(l) for l, _ in v] for k, v in parts.items() if k != "now"}
+
+        if mode == 'rtransfer' and (self.get('async_queue') or parts.get("defer")):
+            if not self.get('async_queue'):
+                raise ValueError("policy.defer_above needs async_queue")
+            transfer = {"kind": "sftp", "server": self['server'], "port": self['port'], "user": self.get('user'),
+                        "key_filename": key_filename}
+            transfer.update({k: self[k] for k in ["workers", "sessions", "sync", "archive", "max_retry",
+                                                          "retry_delay", "verify"] if k in self})
+            if not parts.get("defer"):
+                enqueue_transfer(env_chk(self['async_queue'], fw_spec), dict(transfer, jobs=jobs),
+                                 db_file=env_chk(self.get('db_file'), fw_spec))
+                if parts.get("compress"):
+                    enqueue_transfer(env_chk(self['async_queue'], fw_spec),
+                                     dict(transfer, jobs=parts["compress"], archive=policy.compressor),
+                                     db_file=env_chk(self.get('db_file'), fw_spec))
+                return
+            enqueue_transfer(env_chk(self['async_queue'], fw_spec), dict(transfer, jobs=parts["defer"]),
+                             db_file=env_chk(self.get('db_file'), fw_spec))
+            logger.info("Deferred {} large files to the uploader".format(len(parts["defer"])))
 
+        if mode == 'rtransfer':
+            # remote transfers
+            reuse = self.get('reuse_connection', True)
+            connect_args = (self['server'], self['port'], self.get('user'), key_filename)
+            connect_fn = lambda: (connection_pool.acquire if reuse else connect)(*connect_args)
+            release_fn = connection_pool.release if reuse else None
+            for attempt in range(max_retry + 1):
+                try:
+                    if parts.get("compress"):
+                        archive_files(connect_fn, parts["compress"], compress=policy.compressor,
+                                      sync=self.get('sync'), release_fn=release_fn)
+                        parts["compress"] = []
+                    if self.get('archive'):
+                        stats = archive_files(connect_fn, jobs, compress=self['archive'], sync=self.get('sync'),
+                                              release_fn=release_fn)
                     else:
-                        if 'dest' in f:
-                            dest = os.path.abspath(os.path.expanduser(os.pathexpandvars(f['dest']))) if shell_interpret else f['dest']
-                        else:
-                            dest = os.path.abspath(os.path.expanduser(os.path.expandvars(self['dest']))) if shell_interpret else self['dest']
-                        FileTransferTask.fn_list[mode](src, dest)
-
-            except:
-                traceback.print_exc()
-                if max_retry:
-
+                        stats = put_files(connect_fn, jobs, workers=self.get('workers', 1),
+                                          sessions=self.get('sessions', 1), sync=self.get('sync'),
+                                          release_fn=release_fn, retries=max_retry, retry_delay=retry_delay,
+                                          state_file=".transfer_state.json", verify=self.get('verify', 'size'),
+                                          manifest_file=".transfer_manifest.json")
+                    if policy:
+                        stats["policy"] = policy_stats
+                    return FWAction(stored_data={"transfer": stats})
+                except Exception:
+                    traceback.print_exc()
+                    # put_files already retried every file, only archives are retried as a whole
+                    if not (self.get('archive') or parts.get("compress")) or attempt == max_retry:
+                        break
                     # we want to avoid hammering either the local or remote machine
-                    time.sleep(retry_delay)
-                    self['max_retry'] -= 1
-                    self.run_task(fw_spec)
+                    time.sleep(retry_delay * 2 ** attempt)
+            if not ignore_errors:
+                raise ValueError(
+                    "There was an error performing operation {} from {} "
+                    "to {}".format(mode, self["files"], self["dest"]))
+            return
 
-                elif not ignore_errors:
-                    raise ValueError(
-                        "There was an error performing operation {} from {} "
-                        "to {}".format(mode, self["files"], self["dest"]))
+        for f in self["files"]:
+            if 'src' in f:
+                src = os.path.abspath(os.path.expanduser(os.path.expandvars(f['src']))) if shell_interpret else f['src']
+            else:
+                src = os.path.abspath(os.path.expanduser(os.path.expandvars(f))) if shell_interpret else f
 
-        if mode == 'rtransfer':
-            sftp.close()
-            ssh.close()
+            if 'dest' in f:
+                dest = os.path.abspath(os.path.expanduser(os.path.expandvars(f['dest']))) if shell_interpret else f['dest']
+            else:
+                dest = os.path.abspath(os.path.expanduser(os.path.expandvars(self['dest']))) if shell_interpret else self['dest']
+
+            for attempt in range(max_retry + 1):
+                try:
+                    FileTransferTask.fn_list[mode](src, dest)
+                    break
+                except Exception:
+                    traceback.print_exc()
+                    if attempt < max_retry:
+                        # we want to avoid hammering either the local or remote machine
+                        time.sleep(retry_delay * 2 ** attempt)
+                    elif not ignore_errors:
+                        raise ValueError(
+                            "There was an error performing operation {} from {} "
+                            "to {}".format(mode, src, dest))
 
     @staticmethod
     def _rexists(sftp, path):
@@ -246,7 +315,7 @@ class FileTransferTask(FiretaskBase):
         try:
             sftp.stat(path)
         except IOError as e:
-            if e[0] == 2:
+            if e.errno == errno.ENOENT:
                 return False
             raise
         else:
@@ -266,18 +335,51 @@ class FileSCPTask(FiretaskBase):
         port: tunnel port
         user: user name of local workstation
         dest: absolute path in local workstation
+
+    Optional params:
+        sync: (str) use rsync instead of scp and only send new or changed files: "mtime"
+            (same size and mtime) or "checksum" (compare checksums). Partially transferred
+            files are kept (in .rsync-partial) as the basis of the next attempt. Defaults to
+            None (scp everything).
+        archive: (str) instead of scp, pipe a tar stream of the directory compressed with
+            "gzip" or "zstd" through ssh and unpack it in dest. Defaults to None.
+        multiplex: (bool) share one SSH master connection (OpenSSH ControlMaster) between
+            the transfers of this and later fireworks instead of a handshake per scp.
+            Defaults to False.
+        async_queue: (str) do not transfer now but queue a manifest in this directory
+            (env_chk-able, on a shared filesystem) for the uploader daemon, see vasp.uploader.
+            With policy.defer_above, only the deferred files are queued.
+        db_file: (str) with async_queue, database whose task document of this launch dir
+            receives the transfer result.
+        policy: (dict) TransferPolicy (vasp.transfer) as dict. Switches to rsync with the
+            include/exclude globs and max_size as filters; compress_above turns on rsync -z
+            and defer_above leaves larger files to the uploader in async_queue.
     """
     required_params = ["port", "user", "dest"]
+    optional_params = ["sync", "archive", "multiplex", "async_queue", "db_file", "policy"]
 
     def run_task(self, fw_spec):
-        cmd = "scp -P {} -r {} {}@localhost:{}".format(
-            self["port"],
-            os.getcwd(),
-            self["user"],
-            self["dest"]
-        )
+        policy = TransferPolicy.from_dict(self["policy"]) if self.get("policy") else None
+        transfer = {"kind": "scp", "src": os.getcwd(), "port": self["port"], "user": self["user"],
+                    "dest": self["dest"], "rsync_args": policy.rsync_args() if policy else None}
+        transfer.update({k: self[k] for k in ["sync", "archive", "multiplex"] if k in self})
+
+        if policy and policy.defer_above is not None:
+            if not self.get("async_queue"):
+                raise ValueError("policy.defer_above needs async_queue")
+            enqueue_transfer(env_chk(self["async_queue"], fw_spec),
+                             dict(transfer, rsync_args=policy.rsync_args(deferred=True)),
+                             db_file=env_chk(self.get("db_file"), fw_spec))
+        elif self.get("async_queue"):
+            enqueue_transfer(env_chk(self["async_queue"], fw_spec), transfer,
+                             db_file=env_chk(self.get("db_file"), fw_spec))
+            return
+
+        cmd = scp_command(os.getcwd(), self["port"], self["user"], self["dest"], sync=self.get("sync"),
+                          archive=self.get("archive"), multiplex=self.get("multiplex", False),
+                          rsync_args=transfer["rsync_args"])
         try:
-            subprocess.check_output(cmd.split(" "))
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT if self.get("archive") else None)
         except subprocess.CalledProcessError as e:
             print(e.output)
             raise BaseException(e.output)
@@ -295,23 +397,220 @@ class CopyFileSCPTask(FiretaskBase):
     Required params:
         port: tunnel port
         user: user name of local workstation
-        dest: absolute path in local workstation
+        copy_from: absolute path in local workstation
+
+    Optional params:
+        multiplex: (bool) share one SSH master connection (OpenSSH ControlMaster) between
+            the transfers of this and later fireworks. Defaults to False.
     """
     required_params = ["port", "user", "copy_from"]
+    optional_params = ["multiplex"]
 
     def run_task(self, fw_spec):
-        cmd = "scp -P {} -r {}@localhost:{} {}".format(
-            self["port"],
-            self["user"],
-            self["copy_from"],
-            os.getcwd(),
-        )
+        ssh_opts = ssh_multiplex_options() if self.get("multiplex") else []
+        cmd = ["scp", "-P", str(self["port"])] + ssh_opts + [
+            "-r", "{}@localhost:{}".format(self["user"], self["copy_from"]), os.getcwd()]
         try:
-            subprocess.check_output(cmd.split(" "))
+            subprocess.check_output(cmd)
         except subprocess.CalledProcessError as e:
             print(e.output)
             raise BaseException(e.output)
 
+@explicit_serialize
+class JCopyVaspOutputs(CopyVaspOutputs):
+    """
+    CopyVaspOutputs that stages the files with vasp.staging.stage_artifact
+    when the previous run is on the local filesystem: only the best form of
+    each file is taken (e.g. WAVECAR or WAVECAR.gz, never both), compressed
+    ones are streamed through pigz/zstd into place, uncompressed ones are
+    linked when stage_mode allows it. Remote (filesystem) runs are copied as
+    in CopyVaspOutputs.
+
+    Optional params:
+        (all params of CopyVaspOutputs)
+        stage_mode (str): "copy" (default), "reflink", "hardlink" or
+            "symlink". See vasp.staging.
+        readonly_files ([str]): files this run only reads, e.g. the WAVECAR
+            of irvsp or pyzfs. Only these may be hard- or symlinked, all
+            others are at most reflinked.
+    """
+
+    optional_params = CopyVaspOutputs.optional_params + ["stage_mode", "readonly_files"]
+
+    def copy_files(self):
+        if self.fileclient.ssh:
+            return super(JCopyVaspOutputs, self).copy_files()
+
+        stage_mode = self.get("stage_mode", "copy")
+        readonly_files = self.get("readonly_files", [])
+        all_files = os.listdir(self.from_dir)
+        staged = {}
+        for f in self.files_to_copy:
+            prev_path_full = os.path.join(self.from_dir, f)
+            dest_fname = "POSCAR" if f == "CONTCAR" and self.get("contcar_to_poscar", True) else f
+
+            relax_ext = ""
+            relax_paths = sorted(glob(prev_path_full + ".relax*"))
+            if relax_paths:
+                if len(relax_paths) > 9:
+                    raise ValueError("CopyVaspOutputs doesn't properly handle >9 relaxations!")
+                relax_ext = re.search(r"\.relax\d*", relax_paths[-1]).group(0)
+
+            method = stage_artifact(self.from_dir, f + relax_ext, os.path.join(self.to_dir, dest_fname),
+                                    stage_mode, readonly=f in readonly_files, listing=all_files)
+            if method is None:
+                raise ValueError("Cannot find file: {}".format(f))
+            staged[dest_fname] = method
+        return staged
+
+    def run_task(self, fw_spec):
+        calc_loc = get_calc_loc(self["calc_loc"], fw_spec["calc_locs"]) if self.get("calc_loc") else {}
+
+        files_to_copy = None
+        if "$ALL" not in self.get("additional_files", []):
+            files_to_copy = ["INCAR", "POSCAR", "KPOINTS", "POTCAR", "OUTCAR", "vasprun.xml"]
+            files_to_copy.extend(self.get("additional_files", []))
+            if self.get("contcar_to_poscar", True) and "CONTCAR" not in files_to_copy:
+                files_to_copy = [f for f in files_to_copy if f != "POSCAR"] + ["CONTCAR"]
+
+        self.setup_copy(self.get("calc_dir", None), filesystem=self.get("filesystem", None),
+                        files_to_copy=files_to_copy, from_path_dict=calc_loc)
+        staged = self.copy_files()
+        if staged:
+            return FWAction(stored_data={"staged": staged})
+
+@explicit_serialize
+class StagePrevArtifacts(FiretaskBase):
+    """
+    Stage the large artifacts (WAVECAR, CHGCAR, ...) of a previous run on the
+    local filesystem into the current directory, after the INCAR of this run
+    is written: the ones VASP will not read with that INCAR (see
+    vasp.staging.unread_artifacts) are skipped, of the others only the best
+    form is taken (see JCopyVaspOutputs). Put it after the last task that
+    modifies the INCAR.
+
+    Required params:
+        files ([str]): artifact names, e.g. ["WAVECAR", "CHGCAR"].
+
+    Optional params:
+        calc_dir (str): directory of the previous run.
+        calc_loc (str OR bool): instead of calc_dir, as in CopyVaspOutputs.
+        stage_mode (str): see JCopyVaspOutputs. Defaults to "copy".
+        readonly_files ([str]): see JCopyVaspOutputs.
+        skip_unread (bool): skip the artifacts the INCAR makes VASP ignore.
+            Defaults to True.
+        continue_on_missing (bool): ignore artifacts the previous run does
+            not have. Defaults to True.
+    """
+    required_params = ["files"]
+    optional_params = ["calc_dir", "calc_loc", "stage_mode", "readonly_files", "skip_unread", "continue_on_missing"]
+
+    def run_task(self, fw_spec):
+        if self.get("calc_dir"):
+            calc_dir = self["calc_dir"]
+        elif self.get("calc_loc"):
+            calc_dir = get_calc_loc(self["calc_loc"], fw_spec["calc_locs"])["path"]
+        else:
+            raise ValueError("Must specify calc_dir or calc_loc!")
+
+        unread = set()
+        if self.get("skip_unread", True) and os.path.exists("INCAR"):
+            unread = unread_artifacts(Incar.from_file("INCAR"))
+
+        listing = os.listdir(calc_dir)
+        staged = {}
+        for f in self["files"]:
+            if f in unread:
+                staged[f] = "skipped"
+                continue
+            method = stage_artifact(calc_dir, f, os.path.join(os.getcwd(), f), self.get("stage_mode", "copy"),
+                                    readonly=f in self.get("readonly_files", []), listing=listing)
+            if method is None and not self.get("continue_on_missing", True):
+                raise ValueError("Cannot find file: {}".format(f))
+            staged[f] = method or "missing"
+        return FWAction(stored_data={"staged": staged})
+
+@explicit_serialize
+class StageWavecarSubset(FiretaskBase):
+    """
+    Write a WAVECAR with only some bands, k-points and spins of the WAVECAR
+    of a previous run into the current directory (see vasp.wavecar), instead
+    of copying the whole file. Indices are 1-based as in VASP. Bands are
+    chosen by the first of bands, efermi_window or occupied; all bands if none
+    is given.
+
+    Optional params:
+        calc_dir (str): directory of the previous run.
+        calc_loc (str OR bool): instead of calc_dir, as in CopyVaspOutputs.
+        bands ([int, int]): first and last band.
+        efermi_window (float): bands within this many eV of the Fermi level
+            at any k-point, widened to complete degenerate multiplets.
+        efermi (float): Fermi level for efermi_window. Defaults to the one of
+            the OUTCAR (or VASP 6 WAVECAR) of the previous run.
+        occupied (bool): bands up to the highest occupied one.
+        extra_bands (int): empty bands added with occupied. Defaults to 0.
+        kpoints ([int]): k-points to keep. An explicit KPOINTS in the
+            current directory is reduced to the same k-points.
+        spins ([int]): spin channels to keep, 1 and/or 2.
+    """
+    optional_params = ["calc_dir", "calc_loc", "bands", "efermi_window", "efermi", "occupied", "extra_bands",
+                       "kpoints", "spins"]
+
+    def run_task(self, fw_spec):
+        if self.get("calc_dir"):
+            calc_dir = self["calc_dir"]
+        elif self.get("calc_loc"):
+            calc_dir = get_calc_loc(self["calc_loc"], fw_spec["calc_locs"])["path"]
+        else:
+            raise ValueError("Must specify calc_dir or calc_loc!")
+
+        # a compressed WAVECAR has to be unpacked before it can be mapped
+        src = os.path.join(calc_dir, "WAVECAR")
+        if not os.path.exists(src):
+            src = "WAVECAR.full"
+            if stage_artifact(calc_dir, "WAVECAR", src) is None:
+                raise ValueError("Cannot find file: WAVECAR")
+
+        wavecar = MappedWavecar(src)
+        if self.get("bands"):
+            bands = list(range(self["bands"][0] - 1, self["bands"][1]))
+        elif self.get("efermi_window"):
+            efermi = self.get("efermi")
+            if efermi is None:
+                try:
+                    efermi = Outcar(zpath(os.path.join(calc_dir, "OUTCAR"))).efermi
+                except Exception:
+                    efermi = wavecar.efermi
+            if efermi is None:
+                raise ValueError("No Fermi level for efermi_window, set efermi")
+            bands = bands_in_window(wavecar, efermi, self["efermi_window"])
+        elif self.get("occupied"):
+            bands = occupied_bands(wavecar, extra=self.get("extra_bands", 0))
+        else:
+            bands = None
+        kpoints = [k - 1 for k in self["kpoints"]] if self.get("kpoints") else None
+        spins = [s - 1 for s in self["spins"]] if self.get("spins") else None
+
+        nkpts = wavecar.nkpts
+        info = write_wavecar_subset(wavecar, "WAVECAR", bands=bands, kpoints=kpoints, spins=spins)
+        wavecar.close()
+        if src == "WAVECAR.full":
+            os.remove(src)
+
+        if kpoints is not None and os.path.exists("KPOINTS"):
+            kpts = Kpoints.from_file("KPOINTS")
+            if kpts.style == Kpoints.supported_modes.Reciprocal and len(kpts.kpts) == nkpts:
+                Kpoints(comment=kpts.comment, num_kpts=len(info["kpoints"]), style=kpts.style,
+                        kpts=[kpts.kpts[k] for k in info["kpoints"]],
+                        kpts_weights=[kpts.kpts_weights[k] for k in info["kpoints"]] if kpts.kpts_weights else None,
+                        labels=[kpts.labels[k] for k in info["kpoints"]] if kpts.labels else None,
+                        coord_type=kpts.coord_type).write_file("KPOINTS")
+
+        for key in ("bands", "kpoints", "spins"):
+            info[key] = [i + 1 for i in info[key]]
+        logger.info("WAVECAR subset: {} of {} bytes".format(info["bytes_out"], info["bytes_in"]))
+        return FWAction(stored_data={"wavecar_subset": info}, update_spec={"wavecar_subset": info})
+
 @explicit_serialize
 class WriteInputsFromDB(FiretaskBase):
     """
@@ -327,7 +626,7 @@ class WriteInputsFromDB(FiretaskBase):
 
     def run_task(self, fw_spec):
         pth = self.get("dest", os.getcwd())
-        db = VaspCalcDb.from_db_file(self["db_file"])
+        db = get_calc_db(self["db_file"])
         e = db.collection.find_one({"task_id": self.get("task_id")})
 
         poscar = Poscar.from_dict(e["orig_inputs"]["poscar"])
@@ -346,8 +645,32 @@ class WriteInputsFromDB(FiretaskBase):
 
 @explicit_serialize
 class Write2dNSCFKpoints(FiretaskBase):
+    """
+    Write the KPOINTS of a 2D (z-vacuum) NSCF run: the kz = 0 part of the
+    irreducible uniform mesh (for HSE), user-added k-points and the kz = 0
+    part of the high-symmetry path.
+
+    Required params:
+        is_hse (bool)
+
+    Optional params:
+        added_kpoints, reciprocal_density, kpoints_line_density
+        mode (str): "line" (default) filters the 3D HighSymmKpath and mesh to
+            kz = 0, "line_2d" generates the path and the n1 x n2 x 1 mesh in
+            the in-plane Brillouin zone only (see vasp.kpath2d), "uniform"
+            writes the uniform mesh. The 2D path is continuous and has every
+            segment end once, so its band structure is parsed as a single
+            branch, while the "line" path repeats the segment ends and gives
+            one branch per segment.
+        symmetry_cache (str): directory of the on-disk symmetry cache (see
+            vasp.symmetry_cache), supports env_chk. The in-process cache is
+            always used.
+        symmetry_cache_db (str): db_file for the DB symmetry cache, supports
+            env_chk.
+    """
     required_params = ["is_hse"]
-    optional_params = ["added_kpoints", "reciprocal_density", "kpoints_line_density", "mode"]
+    optional_params = ["added_kpoints", "reciprocal_density", "kpoints_line_density", "mode", "symmetry_cache",
+                       "symmetry_cache_db"]
     def run_task(self, fw_spec):
                  #structure, added_kpoints=None, reciprocal_density=50, kpoints_line_density=20, mode="line")
         structure = None
@@ -359,7 +682,9 @@ class Write2dNSCFKpoints(FiretaskBase):
         added_kpoints = self.get("added_kpoints", [])
         reciprocal_density = self.get("reciprocal_density", 50)
         kpoints_line_density = self.get("kpoints_line_density", 20)
-        mode = self.get("mode", "line")
+        mode = self.get("mode", "line").lower()
+        cache = get_symmetry_cache(cache_dir=env_chk(self.get("symmetry_cache"), fw_spec),
+                                   db_file=env_chk(self.get("symmetry_cache_db"), fw_spec))
 
         kpts = []
         weights = []
@@ -367,17 +692,16 @@ class Write2dNSCFKpoints(FiretaskBase):
 
         # for both modes, include the Uniform mesh w/standard weights
         grid = Kpoints.automatic_density_by_vol(structure, reciprocal_density).kpts
-        ir_kpts = SpacegroupAnalyzer(structure, symprec=0.1).get_ir_reciprocal_mesh(
-            grid[0]
-        )
         if self["is_hse"]:
-            for k in ir_kpts:
-                if round(k[0][2], 1) != 0:
-                    continue
-                kpts.append(k[0])
-                weights.append(int(k[1]))
-                all_labels.append(None)
-
+            if mode == "line_2d":
+                ir_kpts, ir_weights = ir_mesh_2d(structure, grid[0], symprec=0.1, cache=cache)
+            else:
+                ir_kpts, ir_weights = cache.ir_mesh(structure, grid[0], symprec=0.1)
+                mask = [round(k[2], 1) == 0 for k in ir_kpts]
+                ir_kpts, ir_weights = np.asarray(ir_kpts)[mask], np.asarray(ir_weights)[mask]
+            kpts.extend(ir_kpts.tolist())
+            weights.extend(int(w) for w in ir_weights)
+            all_labels.extend([None] * len(ir_kpts))
 
         # for both modes, include any user-added kpoints w/zero weight
         for k in added_kpoints:
@@ -386,26 +710,23 @@ class Write2dNSCFKpoints(FiretaskBase):
             all_labels.append("user-defined")
 
         # for line mode only, add the symmetry lines w/zero weight
-        if mode.lower() == "line":
-            kpath = HighSymmKpath(structure)
-            frac_k_points, labels = kpath.get_kpoints(
-                line_density=kpoints_line_density, coords_are_cartesian=False
-            )
-
-            two_d_kpt, two_d_kpt_label = [], []
-            for kpt, klabel in zip(frac_k_points, labels):
-                if round(kpt[2], 1) == 0:
-                    two_d_kpt.append(kpt)
-                    two_d_kpt_label.append(klabel)
-            frac_k_points, labels = two_d_kpt, two_d_kpt_label
-
-            for k, f in enumerate(frac_k_points):
-                kpts.append(f)
-                weights.append(0.0) if self["is_hse"] else weights.append(1.0)
-                all_labels.append(labels[k])
+        if mode in ("line", "line_2d"):
+            if mode == "line_2d":
+                frac_k_points, labels = cache.kpath_2d(structure, line_density=kpoints_line_density)
+                frac_k_points, labels = dedupe_consecutive(frac_k_points, labels)
+            else:
+                # the same k-points as before the symmetry cache, repeated
+                # segment ends included
+                frac_k_points, labels = cache.kpath(structure, line_density=kpoints_line_density)
+                mask = [round(k[2], 1) == 0 for k in frac_k_points]
+                frac_k_points = np.asarray(frac_k_points)[mask]
+                labels = [l for l, m in zip(labels, mask) if m]
+
+            kpts.extend(frac_k_points.tolist())
+            weights.extend([0.0 if self["is_hse"] else 1.0] * len(frac_k_points))
+            all_labels.extend(labels)
 
             style = Kpoints.supported_modes.Reciprocal
-            kpts = kpts
             kpts_weights = weights
             labels = all_labels
             num_kpts = len(kpts)
@@ -417,10 +738,12 @@ class Write2dNSCFKpoints(FiretaskBase):
             kpts_weights = None
             labels = None
 
+        else:
+            raise ValueError("Unknown mode {}, use line, line_2d or uniform".format(mode))
 
         comment = (
             "is_HSE={} run along symmetry lines".format(self["is_hse"])
-            if mode.lower() == "line"
+            if mode != "uniform"
             else "is_HSE={} run on uniform grid".format(self["is_hse"])
         )
 
@@ -435,16 +758,36 @@ class Write2dNSCFKpoints(FiretaskBase):
 
 @explicit_serialize
 class Write2dSCFKpointsFromVaspkit(FiretaskBase):
-    optional_params = ["vaspkit_cmd"]
+    """
+    Write the line-mode KPOINTS of the 2D high-symmetry path. Task 302 (the
+    default) is generated in-process by vasp.kpath2d, with the layout of
+    vaspkit's KPATH.in. Other tasks, or use_vaspkit, run vaspkit.
+
+    Optional params:
+        vaspkit_cmd (str): vaspkit task. Default: "302".
+        use_vaspkit (bool): run vaspkit also for task 302. Default: False.
+        divisions (int): k-points per segment of the in-process path.
+            Default: 20, as vaspkit.
+        lattice_type (str): 2D lattice of the in-process path, see
+            vasp.kpath2d.PATHS_2D. Default: from the cell.
+    """
+    optional_params = ["vaspkit_cmd", "use_vaspkit", "divisions", "lattice_type"]
     def run_task(self, fw_spec):
-        vaspkit_cmd = self.get("vaspkit_cmd", "302")
+        vaspkit_cmd = str(self.get("vaspkit_cmd") or "302")
         try:
             structure = Structure.from_file("POSCAR")
         except Exception:
             structure = Structure.from_file("POSCAR.gz")
 
+        if vaspkit_cmd == "302" and not self.get("use_vaspkit", False):
+            kpath_2d_line_mode(structure, divisions=self.get("divisions", 20),
+                               lattice_type=self.get("lattice_type")).write_file("KPOINTS")
+            return
+
+        if not shutil.which("vaspkit"):
+            raise RuntimeError("vaspkit -task {} needs vaspkit in PATH".format(vaspkit_cmd))
         structure.to(fmt="poscar", filename="POSCAR")
-        subprocess.call(f"vaspkit -task {vaspkit_cmd}".split(" "))
+        subprocess.run(f"vaspkit -task {vaspkit_cmd}".split(" "), check=True)
         Kpoints.from_file("KPATH.in").write_file("KPOINTS")
 
 @explicit_serialize
@@ -486,6 +829,26 @@ class WriteVaspHSEBSFromPrev(FiretaskBase):
         potcar_spec = self.get("potcar_spec", False)
         vis.write_input(".", potcar_spec=potcar_spec)
 
+@explicit_serialize
+class SplitZeroWeightKpoints(FiretaskBase):
+    """
+    Keep the weighted k-points and one contiguous chunk of the zero-weight
+    k-points of the explicit KPOINTS in the current directory, for HSE band
+    structures fanned out over several runs (see vasp.bs_chunks). Goes after
+    the task writing the KPOINTS.
+
+    Required params:
+        chunk (int): 0-based.
+        n_chunks (int)
+    """
+    required_params = ["chunk", "n_chunks"]
+
+    def run_task(self, fw_spec):
+        info = chunk_kpoints_file("KPOINTS", self["chunk"], self["n_chunks"])
+        logger.info("KPOINTS chunk {}/{}: zero-weight k-points {}-{} of {}".format(
+            info["chunk"] + 1, info["n_chunks"], info["start"], info["stop"], info["n_zero_weight"]))
+        return FWAction(stored_data={"kpoints_chunk": info})
+
 @explicit_serialize
 class VaspToDb(FiretaskBase):
     """
@@ -520,12 +883,53 @@ class VaspToDb(FiretaskBase):
             The path is a full mongo-style path so subdocuments can be referneced
             using dot notation and array keys can be referenced using the index.
             E.g "calcs_reversed.0.output.outar.run_stats"
+        streaming_parse (bool): parse vasprun.xml with a streaming parser that
+            keeps the projected eigenvalues and partial DOS out of the XML tree.
+            Use it for large supercells / large NEDOS runs. The task document
+            is the same as the default parser. Defaults to False.
+        parse_cache (bool or str): reuse the parsed document of an unchanged
+            directory. True caches in vasp.drones.PARSE_CACHE_DIR (outside
+            the launch dir), a str is the cache directory. Supports env_chk,
+            e.g. ">>parse_cache_dir<<". Defaults to False.
+        parse_cache_hash (bool): key parse_cache on file contents instead of
+            size/mtime. Defaults to False.
+        eigenvalues_format (str): GridFS format of eigenvalues and projected
+            eigenvalues, "json" (default) or "npz" (binary NumPy arrays, read
+            back with JVaspCalcDb.get_eigenvalues).
+        eigenvalues_dtype (str): cast eigenvalues before storing them in npz
+            format, e.g. "float32". Default: keep float64.
+        deduplicate_gridfs (bool): reuse identical GridFS payloads that are
+            already stored (e.g. when re-parsing the same directory) instead of
+            uploading them again. Defaults to False.
+        spool_dir (str): write-behind mode. If set, the task document is put
+            into this spool directory instead of being inserted; a flusher
+            pushes it to db_file later (see vasp.spool). Supports env_chk. The
+            job does not connect to the database: the task_id is assigned at
+            flush time and the children only get prev_fw_db and
+            prev_fw_collection (read from db_file). If the task_id is needed
+            up front (write_behind "reserve_task_id", or task_fields_to_push
+            referring to task_id), it is reserved while spooling, which costs
+            a connection and a counter update per job. Without db_file
+            (offline), none of these fields are known, and task_fields_to_push
+            that need them raise.
+        write_behind (dict): flusher settings for spool_dir, e.g.
+            {"background": True, "batch_size": 100, "flush_interval": 30,
+            "reserve_task_id": False}. Without "background", drain the spool
+            with "python -m vasp.spool drain".
+        offline_format (str): what to write when db_file is not set. "json"
+            (default) writes task.json; "json.gz" writes a gzipped spool
+            record task.json.gz that "python -m vasp.spool ingest" loads into
+            the database later, GridFS data included. With spool_dir set, the
+            record goes to the spool instead.
     """
     optional_params = ["calc_dir", "calc_loc", "parse_dos", "bandstructure_mode",
                        "additional_fields", "db_file", "fw_spec_field", "defuse_unsuccessful",
                        "task_fields_to_push", "parse_chgcar", "parse_aeccar",
                        "parse_potcar_file",
-                       "store_volumetric_data", "parse_eigenvalues"]
+                       "store_volumetric_data", "parse_eigenvalues", "streaming_parse",
+                       "parse_cache", "parse_cache_hash",
+                       "eigenvalues_format", "eigenvalues_dtype", "deduplicate_gridfs",
+                       "spool_dir", "write_behind", "offline_format"]
 
     def run_task(self, fw_spec):
         # get the directory that contains the VASP dir to parse
@@ -538,14 +942,17 @@ class VaspToDb(FiretaskBase):
         # parse the VASP directory
         logger.info("PARSING DIRECTORY: {}".format(calc_dir))
 
-        drone = VaspDrone(additional_fields=self.get("additional_fields"),
-                          parse_dos=self.get("parse_dos", "auto"), # JCustom
-                          parse_potcar_file=self.get("parse_potcar_file", True),
-                          bandstructure_mode=self.get("bandstructure_mode", False),
-                          parse_chgcar=self.get("parse_chgcar", False),  # deprecated
-                          parse_aeccar=self.get("parse_aeccar", False),  # deprecated
-                          parse_eigenvalues=self.get("parse_eigenvalues", "auto"), # Jcustom
-                          store_volumetric_data=self.get("store_volumetric_data", STORE_VOLUMETRIC_DATA))
+        drone = JVaspDrone(streaming=self.get("streaming_parse", False),
+                           parse_cache=env_chk(self.get("parse_cache", False), fw_spec),
+                           parse_cache_hash=self.get("parse_cache_hash", False),
+                           additional_fields=self.get("additional_fields"),
+                           parse_dos=self.get("parse_dos", "auto"), # JCustom
+                           parse_potcar_file=self.get("parse_potcar_file", True),
+                           bandstructure_mode=self.get("bandstructure_mode", False),
+                           parse_chgcar=self.get("parse_chgcar", False),  # deprecated
+                           parse_aeccar=self.get("parse_aeccar", False),  # deprecated
+                           parse_eigenvalues=self.get("parse_eigenvalues", "auto"), # Jcustom
+                           store_volumetric_data=self.get("store_volumetric_data", STORE_VOLUMETRIC_DATA))
 
         # assimilate (i.e., parse)
         task_doc = drone.assimilate(calc_dir)
@@ -562,21 +969,42 @@ class VaspToDb(FiretaskBase):
         # get the database connection
         db_file = env_chk(self.get('db_file'), fw_spec)
 
+        use_gridfs = (bool(self.get("parse_dos", False))
+                      or bool(self.get("bandstructure_mode", False))
+                      or bool(self.get("parse_eigenvalues", False))
+                      or self.get("parse_chgcar", False)  # deprecated
+                      or self.get("parse_aeccar", False)  # deprecated
+                      or bool(self.get("store_volumetric_data", STORE_VOLUMETRIC_DATA)))
+        insert_kwargs = {"eigenvalues_format": self.get("eigenvalues_format", "json"),
+                         "eigenvalues_dtype": self.get("eigenvalues_dtype"),
+                         "deduplicate": self.get("deduplicate_gridfs", False)}
+
+        spool_dir = env_chk(self.get("spool_dir"), fw_spec)
+        pushed = set((self.get("task_fields_to_push") or {}).values()) & {"task_id", "db", "collection"}
+        if spool_dir and db_file:
+            reserve_spooled_task_id(task_doc, db_file, write_behind=self.get("write_behind"),
+                                    task_fields_to_push=self.get("task_fields_to_push"))
+        elif spool_dir and pushed:
+            raise ValueError("task_fields_to_push {} need db_file with spool_dir".format(sorted(pushed)))
+
         # db insertion or taskdoc dump
-        if not db_file:
-            with open("task.json", "w") as f:
-                f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
+        if spool_or_insert(task_doc, db_file, spool_dir=spool_dir,
+                           write_behind=self.get("write_behind"), use_gridfs=use_gridfs,
+                           insert_kwargs=insert_kwargs, task="VaspToDb"):
+            logger.info("Finished parsing, task document spooled")
+        elif not db_file:
+            if self.get("offline_format", "json") == "json.gz":
+                write_record("task.json.gz", make_record(task_doc, use_gridfs=use_gridfs,
+                                                         insert_kwargs=insert_kwargs, task="VaspToDb"))
+            else:
+                with open("task.json", "w") as f:
+                    f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
         else:
-            mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
+            mmdb = get_calc_db(db_file, admin=True)
+            mmdb.ensure_indexes("VaspToDb")
             # Add current entry information
             task_doc.update({"db": mmdb.db_name, "collection": mmdb.collection.name})
-            t_id = mmdb.insert_task(
-                task_doc, use_gridfs=bool(self.get("parse_dos", False))
-                                     or bool(self.get("bandstructure_mode", False))
-                                     or bool(self.get("parse_eigenvalues", False))
-                                     or self.get("parse_chgcar", False)  # deprecated
-                                     or self.get("parse_aeccar", False)  # deprecated
-                                     or bool(self.get("store_volumetric_data", STORE_VOLUMETRIC_DATA)))
+            t_id = mmdb.insert_task(task_doc, use_gridfs=use_gridfs, **insert_kwargs)
             logger.info("Finished parsing with task_id: {}".format(t_id))
 
         defuse_children = False
@@ -622,3 +1050,66 @@ class VaspToDb(FiretaskBase):
         return FWAction(stored_data={"task_id": task_doc.get("task_id", None)},
                         defuse_children=defuse_children, update_spec=update_spec)
 
+
+
+@explicit_serialize
+class MergeBSChunks(FiretaskBase):
+    """
+    Stitch the band structures of the chunk runs of one HSE band structure
+    (see vasp.bs_chunks) and insert them as one task document. The chunk
+    documents are found by their kpoints_chunk.group (set by VaspToDb's
+    additional_fields); of a chunk that ran more than once, the last document
+    is used. The merged document is a copy of the one of the first chunk with
+    the merged band structure as its only GridFS data (the DOS, eigenvalues,
+    ... of a chunk describe that chunk), kpoints_chunk.merged = True and the
+    launch directory of this task as dir_name, so it never replaces the
+    document of the first chunk. Give it the task_label of the unchunked calculation in
+    additional_fields; the chunks carry " chunk i/n" in theirs.
+
+    Required params:
+        group (str): kpoints_chunk.group of the chunk task documents.
+        n_chunks (int)
+
+    Optional params:
+        db_file (str): path to file containing the database credentials.
+            Supports env_chk.
+        additional_fields (dict): fields to set in the merged document, e.g.
+            task_label.
+    """
+    required_params = ["group", "n_chunks"]
+    optional_params = ["db_file", "additional_fields"]
+
+    def run_task(self, fw_spec):
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        if not db_file:
+            raise ValueError("MergeBSChunks needs the db_file of the chunk task documents")
+        db = get_calc_db(db_file, admin=True)
+        n_chunks = self["n_chunks"]
+
+        docs = {}
+        for doc in db.collection.find({"kpoints_chunk.group": self["group"], "kpoints_chunk.merged": {"$ne": True}},
+                                      sort=[("last_updated", 1)]):
+            docs[doc["kpoints_chunk"]["chunk"]] = doc
+        missing = sorted(set(range(n_chunks)) - set(docs))
+        if missing:
+            raise RuntimeError("Chunks {} of group {} are not in the database".format(missing, self["group"]))
+        docs = [docs[i] for i in range(n_chunks)]
+
+        bs = merge_band_structures([db.get_band_structure(d["task_id"]) for d in docs])
+        fs_id, compression = db.insert_gridfs(json.dumps(bs.as_dict(), cls=MontyEncoder), "bandstructure_fs")
+
+        d = {k: v for k, v in docs[0].items() if k not in ("_id", "task_id")}
+        # the GridFS files of chunk 0 (DOS, eigenvalues, ...) stay owned by its
+        # document; a shared reference would be deleted with either document
+        gridfs_fields = tuple("{}_{}".format(name, suffix) for name in GRIDFS_KEYS + EIGENVALUE_KEYS
+                              for suffix in ("fs_id", "compression", "format"))
+        d["calcs_reversed"] = [{k: v for k, v in calc.items() if k not in gridfs_fields}
+                               for calc in docs[0]["calcs_reversed"]]
+        d["calcs_reversed"][0].update(bandstructure_fs_id=fs_id, bandstructure_compression=compression)
+        d.update(self.get("additional_fields", {}))
+        d["dir_name"] = get_uri(os.getcwd())
+        d["kpoints_chunk"] = {"group": self["group"], "n_chunks": n_chunks, "merged": True,
+                              "task_ids": [doc["task_id"] for doc in docs]}
+        t_id = db.insert(d)
+        logger.info("Merged {} band structure chunks into task {}".format(n_chunks, t_id))
+        return FWAction(stored_data={"task_id": t_id, "chunk_task_ids": d["kpoints_chunk"]["task_ids"]})
@@ -31,6 +31,9 @@ from atomate.utils.utils import env_chk, get_logger
 from atomate.utils.database import CalcDb
 from atomate.vasp.database import VaspCalcDb
 
+from ..database import get_calc_db
+from ..spool import spool_or_insert, reserve_spooled_task_id
+
 
 logger = get_logger(__name__)
 
@@ -210,11 +213,14 @@ class IRVSPToDb(FiretaskBase):
     optional_params:
         db_file (str): path to the db file
         additional_fields (dict): dict of additional fields to add
+        spool_dir (str): write-behind mode, see VaspToDb
+        write_behind (dict): flusher settings for spool_dir, see VaspToDb
 
     """
 
     required_params = ["irvsp_out"]
-    optional_params = ["db_file", "additional_fields", "collection_name", "fw_spec_field", "task_fields_to_push"]
+    optional_params = ["db_file", "additional_fields", "collection_name", "fw_spec_field", "task_fields_to_push",
+                       "spool_dir", "write_behind"]
 
     def run_task(self, fw_spec):
         irvsp = self.get("irvsp_out") or fw_spec["irvsp_out"]
@@ -230,6 +236,8 @@ class IRVSPToDb(FiretaskBase):
         d["dir_name"] = os.getcwd()
         d["post_relax_sg_name"] = fw_spec["post_relax_sg_name"],
         d["post_relax_sg_number"] = fw_spec["post_relax_sg_number"]
+        if "wavecar_subset" in fw_spec:
+            d["wavecar_subset"] = fw_spec["wavecar_subset"]
 
         # Check for additional keys to set based on the fw_spec
         if self.get("fw_spec_field") and isinstance(self.get("fw_spec_field"), list):
@@ -242,12 +250,21 @@ class IRVSPToDb(FiretaskBase):
 
         # store the results
         db_file = env_chk(self.get("db_file", ">>db_file<<"), fw_spec)
+        spool_dir = env_chk(self.get("spool_dir"), fw_spec)
         if not db_file:
             with open("irvsp.json", "w") as f:
                 f.write(json.dumps(d, default=DATETIME_HANDLER, indent=4))
+        elif spool_dir:
+            reserve_spooled_task_id(d, db_file, collection_name=self.get("collection_name"),
+                                    write_behind=self.get("write_behind"),
+                                    task_fields_to_push=self.get("task_fields_to_push"))
+            spool_or_insert(d, db_file, spool_dir=spool_dir, write_behind=self.get("write_behind"),
+                            collection_name=self.get("collection_name"), task="IRVSPToDb")
+            logger.info("IRVSP calculation complete, document spooled.")
         else:
-            db = VaspCalcDb.from_db_file(db_file, admin=True)
+            db = get_calc_db(db_file, admin=True)
             db.collection = db.db[self.get("collection_name", db.collection.name)]
+            db.ensure_indexes("IRVSPToDb")
             d.update({"db": db.db_name, "collection": db.collection.name})
             t_id = db.insert(d)
             logger.info("IRVSP calculation complete.")
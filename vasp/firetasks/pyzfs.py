@@ -3,6 +3,9 @@ from fireworks import explicit_serialize, FiretaskBase, FWAction
 from atomate.utils.utils import env_chk, get_logger, logger
 from atomate.vasp.database import VaspCalcDb
 
+from ..database import get_calc_db
+from ..spool import spool_or_insert, reserve_spooled_task_id
+
 from pymatgen.io.vasp.inputs import Structure
 
 from monty.serialization import loadfn
@@ -53,7 +56,8 @@ class RunPyzfs(FiretaskBase):
 @explicit_serialize
 class PyzfsToDb(FiretaskBase):
 
-    optional_params = ["db_file", "additional_fields", "collection_name", "task_fields_to_push"]
+    optional_params = ["db_file", "additional_fields", "collection_name", "task_fields_to_push",
+                       "spool_dir", "write_behind"]
 
     def run_task(self, fw_spec):
 
@@ -66,6 +70,8 @@ class PyzfsToDb(FiretaskBase):
         d["structure"] = fw_spec["structure"]
         d["pyzfs_out"] = pyzfs_out
         d["dir_name"] = os.getcwd()
+        if "wavecar_subset" in fw_spec:
+            d["wavecar_subset"] = fw_spec["wavecar_subset"]
         # Automatically add prev fws information
         for prev_info_key in ["prev_fw_taskid", "prev_fw_db", "prev_fw_collection"]:
             if prev_info_key in fw_spec:
@@ -73,15 +79,24 @@ class PyzfsToDb(FiretaskBase):
 
         # store the results
         db_file = env_chk(self.get("db_file"), fw_spec)
+        spool_dir = env_chk(self.get("spool_dir"), fw_spec)
         if not db_file:
             with open("pyzfs_todb.json", "w") as f:
                 f.write(json.dumps(d, default=DATETIME_HANDLER, indent=4))
+        elif spool_dir:
+            reserve_spooled_task_id(d, db_file, collection_name=self.get("collection_name"),
+                                    write_behind=self.get("write_behind"),
+                                    task_fields_to_push=self.get("task_fields_to_push"))
+            spool_or_insert(d, db_file, spool_dir=spool_dir, write_behind=self.get("write_behind"),
+                            collection_name=self.get("collection_name"), task="PyzfsToDb")
+            logger.info("Pyzfs calculation complete, document spooled.")
         else:
-            db = VaspCalcDb.from_db_file(db_file, admin=True)
+            db = get_calc_db(db_file, admin=True)
             print(self.get("collection_name", db.collection.name))
             db.collection = db.db[self.get("collection_name", db.collection.name)]
+            db.ensure_indexes("PyzfsToDb")
             d.update({"db": db.db_name, "collection": db.collection.name})
             t_id = db.insert(d)
             logger.info("Pyzfs calculation complete.")
 
-        return FWAction()
+        return FWAction(stored_data={"task_id": d.get("task_id", None)})
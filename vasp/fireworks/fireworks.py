@@ -35,6 +35,7 @@ from atomate.vasp.config import VASP_CMD, DB_FILE
 
 from ..firetasks.firetasks import *
 from ..firetasks.optics import *
+from ..potcar_metadata import get_default_magmom
 
 class JOptimizeFW(Firework):
     def __init__(
@@ -204,6 +205,7 @@ class JMVLGWFW(Firework):
             db_file=DB_FILE,
             vasptodb_kwargs=None,
             parents=None,
+            stage_mode="copy",
             **kwargs
     ):
         """
@@ -225,6 +227,9 @@ class JMVLGWFW(Firework):
             db_file (str): Path to file specifying db credentials.
             parents (Firework): Parents of this particular Firework. FW or list of FWS.
             vasptodb_kwargs (dict): kwargs to pass to VaspToDb
+            stage_mode (str): how the outputs of the previous run are staged, see JCopyVaspOutputs.
+                WAVEDER and WFULL are only read, so "hardlink" is safe for them when the previous
+                run is not touched afterwards; WAVECAR is rewritten and at most reflinked.
             \*\*kwargs: Other kwargs that are passed to Firework.__init__.
         """
         t = []
@@ -255,14 +260,16 @@ class JMVLGWFW(Firework):
 
 
         if prev_calc_dir:
-            t.append(CopyVaspOutputs(calc_dir=prev_calc_dir, contcar_to_poscar=True, additional_files=additional_file))
+            t.append(JCopyVaspOutputs(calc_dir=prev_calc_dir, contcar_to_poscar=True, additional_files=additional_file,
+                                      stage_mode=stage_mode, readonly_files=["WAVEDER", "WFULL"]))
             t.append(WriteMVLGWFromPrev(nbands=nbands, reciprocal_density=reciprocal_density,
                                          nbands_factor=nbands_factor, ncores=ncores, prev_incar=prev_incar,
                                          mode=mode, other_params=vasp_input_set_params))
         elif parents:
             if prev_calc_loc:
                 t.append(
-                    CopyVaspOutputs(calc_loc=prev_calc_loc, contcar_to_poscar=True, additional_files=additional_file)
+                    JCopyVaspOutputs(calc_loc=prev_calc_loc, contcar_to_poscar=True, additional_files=additional_file,
+                                     stage_mode=stage_mode, readonly_files=["WAVEDER", "WFULL"])
                 )
             t.append(WriteMVLGWFromPrev(nbands=nbands, reciprocal_density=reciprocal_density,
                                          nbands_factor=nbands_factor, ncores=ncores, prev_incar=prev_incar,
@@ -343,7 +350,7 @@ class ScanRelaxFW(Firework):
         t = []
         t.append(WriteVaspFromIOSet(structure=structure, vasp_input_set=vasp_input_set))
 
-        magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+        magmom = get_default_magmom(structure)
         if magmom:
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
 
@@ -434,7 +441,7 @@ class ScanStaticFW(Firework):
 
         t.append(RmSelectiveDynPoscar())
 
-        magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+        magmom = get_default_magmom(structure)
         if magmom:
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
 
@@ -457,7 +464,7 @@ class ScanStaticFW(Firework):
 class JHSEStaticFW(Firework):
     def __init__(self, structure=None, name="HSE_scf", vasp_input_set=None, vasp_input_set_params=None,
                  vasp_cmd=VASP_CMD, prev_calc_loc=True, prev_calc_dir=None, db_file=DB_FILE, vasptodb_kwargs=None,
-                 parents=None, force_gamma=True, default_magmom=True, **kwargs):
+                 parents=None, force_gamma=True, default_magmom=True, stage_mode="reflink", **kwargs):
         t = []
 
         vasp_input_set_params = vasp_input_set_params or {}
@@ -469,15 +476,17 @@ class JHSEStaticFW(Firework):
         fw_name = "{}-{}".format(structure.composition.reduced_formula if structure else "unknown", name)
 
 
+        # WAVECAR and CHGCAR of prev_calc_dir, staged once the INCAR is final
+        artifacts_from = None
         if prev_calc_dir and parents:
             t.append(CopyVaspOutputs(calc_loc=prev_calc_loc, contcar_to_poscar=True))
-            t.append(CopyFiles(from_dir=prev_calc_dir, files_to_copy=["CHGCAR.gz", "CHGCAR", "WAVECAR.gz", "WAVECAR"],
-                               continue_on_missing=True))
             t.append(WriteVaspHSEBSFromPrev(mode="uniform", reciprocal_density=None, kpoints_line_density=None))
             t.append(ModifyIncar(incar_update={"ICHARG": 11}))
+            artifacts_from = prev_calc_dir
         elif prev_calc_dir:
-            t.append(CopyVaspOutputs(calc_dir=prev_calc_dir, contcar_to_poscar=True, additional_files=["WAVECAR", "CHGCAR"]))
+            t.append(JCopyVaspOutputs(calc_dir=prev_calc_dir, contcar_to_poscar=True))
             t.append(WriteVaspHSEBSFromPrev(mode="uniform", reciprocal_density=None, kpoints_line_density=None))
+            artifacts_from = prev_calc_dir
         elif parents:
             if prev_calc_loc:
                 t.append(CopyVaspOutputs(calc_loc=prev_calc_loc, contcar_to_poscar=True))
@@ -507,7 +516,7 @@ class JHSEStaticFW(Firework):
         t.append(RmSelectiveDynPoscar())
 
         if default_magmom:
-            magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+            magmom = get_default_magmom(structure)
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
 
         if vasp_input_set_params.get("user_incar_settings", {}):
@@ -519,6 +528,10 @@ class JHSEStaticFW(Firework):
             t.append(WriteVaspFromPMGObjects(
                 kpoints=MPHSERelaxSet(structure=structure, force_gamma=force_gamma).kpoints.as_dict()))
 
+        if artifacts_from:
+            # rewritten by the run, so they are at most reflinked
+            t.append(StagePrevArtifacts(calc_dir=artifacts_from, files=["CHGCAR", "WAVECAR"], stage_mode=stage_mode))
+
         t.append(RunVaspCustodian(vasp_cmd=vasp_cmd, auto_npar=">>auto_npar<<"))
         t.append(PassCalcLocs(name=name))
         t.append(VaspToDb(db_file=db_file, **vasptodb_kwargs))
@@ -540,6 +553,7 @@ class JHSESOCFW(Firework):
             db_file=DB_FILE,
             parents=None,
             vasptodb_kwargs=None,
+            stage_mode="reflink",
             **kwargs
     ):
         """
@@ -555,6 +569,8 @@ class JHSESOCFW(Firework):
             db_file (str): Path to file specifying db credentials.
             parents (Firework): Parents of this particular Firework.
                 FW or list of FWS.
+            stage_mode (str): how CHGCAR/WAVECAR of the previous run are staged, see
+                StagePrevArtifacts. Both are rewritten by the run, so they are at most reflinked.
             \*\*kwargs: Other kwargs that are passed to Firework.__init__.
         """
         fw_name = "{}-{}".format(
@@ -570,7 +586,7 @@ class JHSESOCFW(Firework):
         vasptodb_kwargs["additional_fields"]["task_label"] = name
 
         if not magmom:
-            magmom = [[0,0,mag_z] for mag_z in MPRelaxSet(structure).incar.get("MAGMOM", None)]
+            magmom = [[0,0,mag_z] for mag_z in get_default_magmom(structure)]
 
         copy_add_files_from_prev = []
         if read_chgcar:
@@ -579,25 +595,26 @@ class JHSESOCFW(Firework):
             copy_add_files_from_prev.append("WAVECAR")
 
         t = []
+        artifacts = None
         if prev_calc_dir:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_dir=prev_calc_dir,
-                    additional_files=copy_add_files_from_prev,
                     contcar_to_poscar=True
                 )
             )
+            artifacts = StagePrevArtifacts(calc_dir=prev_calc_dir, files=copy_add_files_from_prev, stage_mode=stage_mode)
             t.append(
                 WriteVaspSOCFromPrev(prev_calc_dir=".", saxis=saxis)
             )
         elif parents and copy_vasp_outputs:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_loc=True,
-                    additional_files=copy_add_files_from_prev,
                     contcar_to_poscar=True
                 )
             )
+            artifacts = StagePrevArtifacts(calc_loc=True, files=copy_add_files_from_prev, stage_mode=stage_mode)
             t.append(
                 WriteVaspSOCFromPrev(prev_calc_dir=".", saxis=saxis)
             )
@@ -622,6 +639,9 @@ class JHSESOCFW(Firework):
         if vasp_input_set_params.get("user_kpoints_settings", {}):
             t.append(WriteVaspFromPMGObjects(kpoints=vasp_input_set_params.get("user_kpoints_settings", {})))
 
+        if artifacts and copy_add_files_from_prev:
+            t.append(artifacts)
+
         t.extend(
             [
                 RunVaspCustodian(vasp_cmd=vasp_cmd, auto_npar=">>auto_npar<<"),
@@ -683,7 +703,7 @@ class JHSERelaxFW(Firework):
             raise ValueError("Must specify structure or previous calculation")
 
         if default_magmom:
-            magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+            magmom = get_default_magmom(structure)
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
 
         if vasp_input_set_params.get("user_incar_settings", {}):
@@ -746,7 +766,7 @@ class JHSEcDFTFW(Firework):
             raise ValueError("Must specify previous calculation or parent")
 
         if default_magmom:
-            magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+            magmom = get_default_magmom(structure)
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
 
         if vasp_input_set_params.get("user_incar_settings", {}):
@@ -799,7 +819,7 @@ class JPBEcDFTRelaxFW(Firework):
         else:
             t.append(CopyVaspOutputs(additional_files=["WAVECAR"], calc_dir=prev_calc_dir))
             t.append(WriteVaspFromIOSet(structure=structure, vasp_input_set=vis))
-        magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+        magmom = get_default_magmom(structure)
         if magmom:
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
         t.append(ModifyIncar(incar_update=vasp_input_set_params.get("user_incar_settings", {})))
@@ -827,7 +847,7 @@ class JPBEcDFTStaticFW(Firework):
             t.append(CopyVaspOutputs(calc_loc=True, contcar_to_poscar=True))
         else:
             t.append(CopyVaspOutputs(additional_files=["CHGCAR"], calc_loc=True))
-        magmom = MPRelaxSet(structure).incar.get("MAGMOM", None)
+        magmom = get_default_magmom(structure)
         if magmom:
             t.append(ModifyIncar(incar_update={"MAGMOM": magmom}))
         t.append(WriteVaspStaticFromPrev())
@@ -851,6 +871,9 @@ class HSEBSFW(Firework):
             input_set_overrides=None,
             vasp_cmd=VASP_CMD,
             db_file=DB_FILE,
+            chunk=None,
+            n_chunks=1,
+            chunk_group=None,
             **kwargs
     ):
         """
@@ -868,9 +891,20 @@ class HSEBSFW(Firework):
             name (str): Name for the Firework.
             vasp_cmd (str): Command to run vasp.
             db_file (str): Path to file specifying db credentials.
+            chunk (int): run only this 0-based chunk of the zero-weight k-points of mode="line", see
+                vasp.bs_chunks. Run all n_chunks chunks with the same chunk_group and a MergeBSChunksFW.
+                The task_label of the chunk gets the suffix " chunk i/n_chunks".
+            n_chunks (int): number of chunks.
+            chunk_group (str): id shared by the chunks, stored in kpoints_chunk.group of the task documents.
             \*\*kwargs: Other kwargs that are passed to Firework.__init__.
         """
         name = name if name else "{} {}".format("hse", mode)
+        if chunk is not None:
+            # the chunk documents must not answer queries for the full band structure
+            name = "{} chunk {}/{}".format(name, chunk + 1, n_chunks)
+        additional_fields = {"task_label": name}
+        if chunk is not None:
+            additional_fields["kpoints_chunk"] = {"group": chunk_group, "chunk": chunk, "n_chunks": n_chunks}
 
         fw_name = "{}-{}".format(
             structure.composition.reduced_formula if structure else "unknown", name
@@ -887,6 +921,8 @@ class HSEBSFW(Firework):
             raise ValueError("Must specify a previous calculation for HSEBSFW")
 
         t.append(WriteVaspHSEBSFromPrev(prev_calc_dir=".", mode=mode, **input_set_overrides))
+        if chunk is not None:
+            t.append(SplitZeroWeightKpoints(chunk=chunk, n_chunks=n_chunks))
         t.append(RunVaspCustodian(vasp_cmd=vasp_cmd))
         t.append(PassCalcLocs(name=name))
 
@@ -896,7 +932,7 @@ class HSEBSFW(Firework):
         t.append(
             VaspToDb(
                 db_file=db_file,
-                additional_fields={"task_label": name},
+                additional_fields=additional_fields,
                 parse_dos=parse_dos,
                 bandstructure_mode=bandstructure_mode
             )
@@ -904,6 +940,41 @@ class HSEBSFW(Firework):
         super(HSEBSFW, self).__init__(t, parents=parents, name=fw_name, **kwargs)
 
 
+class MergeBSChunksFW(Firework):
+    def __init__(
+            self,
+            group,
+            n_chunks,
+            parents=None,
+            structure=None,
+            name="hse bs merge",
+            db_file=DB_FILE,
+            additional_fields=None,
+            **kwargs
+    ):
+        """
+        Stitch the band structures of the chunks of an HSE band structure (HSEBSFW with chunk, or the
+        fan_out_zero_weight_kpoints powerup) into one task document.
+
+        Args:
+            group (str): chunk_group of the chunks.
+            n_chunks (int): number of chunks.
+            parents (Firework): the chunk Fireworks.
+            structure (Structure): Input structure - used only to set the name of the FW.
+            name (str): Name for the Firework.
+            db_file (str): Path to file specifying db credentials.
+            additional_fields (dict): fields of the merged task document, e.g. the task_label of the
+                unchunked calculation ("hse line").
+            \*\*kwargs: Other kwargs that are passed to Firework.__init__.
+        """
+        fw_name = "{}-{}".format(
+            structure.composition.reduced_formula if structure else "unknown", name
+        )
+        t = [MergeBSChunks(group=group, n_chunks=n_chunks, db_file=db_file,
+                           additional_fields=additional_fields or {})]
+        super(MergeBSChunksFW, self).__init__(t, parents=parents, name=fw_name, **kwargs)
+
+
 class NonSCFFW(Firework):
     def __init__(
             self,
@@ -17,6 +17,7 @@ from ..firetasks.pytopomat import (
     RunIRVSPsingleKpt,
     IRVSPToDb
 )
+from ..firetasks.firetasks import JCopyVaspOutputs, StageWavecarSubset
 
 
 class IrvspFW(Firework):
@@ -32,6 +33,8 @@ class IrvspFW(Firework):
             prev_calc_dir=None,
             irvsp_out=None,
             irvsptodb_kwargs=None,
+            stage_mode="copy",
+            wavecar_subset=None,
             **kwargs
     ):
         """
@@ -45,6 +48,12 @@ class IrvspFW(Firework):
             db_file (str): path to the db file
             parents (Firework): Parents of this particular Firework. FW or list of FWS.
             prev_calc_dir (str): Path to a previous calculation to copy from
+            stage_mode (str): how the files of the previous calculation are staged, see
+                JCopyVaspOutputs. Default "copy"; irvsp only reads the WAVECAR, so "hardlink" saves the
+                copy when the previous calculation is not modified afterwards.
+            wavecar_subset (dict): params of StageWavecarSubset, e.g. {"efermi_window": 3}: stage only
+                these bands/k-points of the WAVECAR instead of the full file. Band indices in the irvsp
+                output then count from the first staged band.
             \*\*kwargs: Other kwargs that are passed to Firework.__init__.
 
         """
@@ -62,20 +71,28 @@ class IrvspFW(Firework):
 
         if prev_calc_dir:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_dir=prev_calc_dir,
-                    additional_files=["WAVECAR"],
+                    additional_files=[] if wavecar_subset else ["WAVECAR"],
                     contcar_to_poscar=True,
+                    stage_mode=stage_mode,
+                    readonly_files=["WAVECAR"],
                 )
             )
+            if wavecar_subset:
+                t.append(StageWavecarSubset(calc_dir=prev_calc_dir, **wavecar_subset))
         elif parents:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_loc=True,
-                    additional_files=["WAVECAR"],
+                    additional_files=[] if wavecar_subset else ["WAVECAR"],
                     contcar_to_poscar=True,
+                    stage_mode=stage_mode,
+                    readonly_files=["WAVECAR"],
                 )
             )
+            if wavecar_subset:
+                t.append(StageWavecarSubset(calc_loc=True, **wavecar_subset))
         else:
             raise ValueError("Must specify structure or previous calculation")
 
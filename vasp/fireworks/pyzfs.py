@@ -1,10 +1,10 @@
 from fireworks import Firework
 
 from atomate.common.firetasks.glue_tasks import PassCalcLocs
-from atomate.vasp.firetasks.glue_tasks import CopyVaspOutputs
 from atomate.vasp.config import DB_FILE
 
 from ..firetasks.pyzfs import RunPyzfs, PyzfsToDb
+from ..firetasks.firetasks import JCopyVaspOutputs, StageWavecarSubset
 
 class PyzfsFW(Firework):
     def __init__(
@@ -16,6 +16,8 @@ class PyzfsFW(Firework):
             pyzfs_cmd=">>pyzfs_cmd<<",
             db_file=DB_FILE,
             pyzfstodb_kwargs=None,
+            stage_mode="copy",
+            wavecar_subset=None,
             **kwargs
     ):
         fw_name = "{}-{}".format(
@@ -31,20 +33,29 @@ class PyzfsFW(Firework):
 
         if prev_calc_dir:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_dir=prev_calc_dir,
-                    additional_files=["WAVECAR"],
+                    additional_files=[] if wavecar_subset else ["WAVECAR"],
                     contcar_to_poscar=True,
+                    stage_mode=stage_mode,
+                    readonly_files=["WAVECAR"],
                 )
             )
+            # e.g. wavecar_subset={"occupied": True}: pyzfs only uses the occupied orbitals
+            if wavecar_subset:
+                t.append(StageWavecarSubset(calc_dir=prev_calc_dir, **wavecar_subset))
         elif parents:
             t.append(
-                CopyVaspOutputs(
+                JCopyVaspOutputs(
                     calc_loc=True,
-                    additional_files=["WAVECAR"],
+                    additional_files=[] if wavecar_subset else ["WAVECAR"],
                     contcar_to_poscar=True,
+                    stage_mode=stage_mode,
+                    readonly_files=["WAVECAR"],
                 )
             )
+            if wavecar_subset:
+                t.append(StageWavecarSubset(calc_loc=True, **wavecar_subset))
         else:
             raise ValueError("Must specify structure or previous calculation")
 
@@ -0,0 +1,243 @@
+"""
+K-points of 2D materials (slabs with the vacuum along c) generated in the
+in-plane Brillouin zone only.
+
+Write2dNSCFKpoints used to build the 3D HighSymmKpath and the 3D irreducible
+mesh of the slab and then to drop, point by point, everything off the kz = 0
+plane. kpath_2d instead constructs the 2D Brillouin zone of the in-plane
+reciprocal vectors (intersection of the half planes k.G <= |G|^2/2) and walks
+its boundary:
+
+    square                  G-X-M-G
+    hexagonal               G-M-K-G
+    rectangular             G-X-S-Y-G-S
+    centered rectangular    G-X-H1-C-H-Y-G
+    oblique                 G-X-H1-C-H-Y-G
+
+X is always the edge center along b1, and the points follow the boundary
+counterclockwise from it. ir_mesh_2d reduces an n1 x n2 x 1 mesh only.
+Shared segment ends are written once, and the masking and de-duplication of
+k-point lists are vectorized with numpy.
+
+kpath_2d_line_mode writes the same path as a line-mode KPOINTS in the layout
+of vaspkit's KPATH.in (task 302), so the 2D band structures no longer need
+vaspkit on the compute nodes.
+"""
+
+import numpy as np
+
+from pymatgen.io.vasp.inputs import Kpoints
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+GAMMA = "\\Gamma"
+# lattice type: path through the points of the zone boundary, counterclockwise
+# from the edge center X along b1; "b<i>" is the i-th boundary point
+# (vertices and edge centers alternate, b0 = X)
+PATHS_2D = {
+    "square": ([GAMMA, "X", "M", GAMMA], {"X": 0, "M": 1}),
+    "hexagonal": ([GAMMA, "M", "K", GAMMA], {"M": 0, "K": 1}),
+    "rectangular": ([GAMMA, "X", "S", "Y", GAMMA, "S"], {"X": 0, "S": 1, "Y": 2}),
+    "centered_rectangular": ([GAMMA, "X", "H1", "C", "H", "Y", GAMMA],
+                             {"X": 0, "H1": 1, "C": 2, "H": 3, "Y": 4}),
+    "oblique": ([GAMMA, "X", "H1", "C", "H", "Y", GAMMA], {"X": 0, "H1": 1, "C": 2, "H": 3, "Y": 4}),
+}
+
+
+def lattice_type_2d(structure, length_tol=1e-2, angle_tol=1.0):
+    """
+    2D Bravais lattice of the a, b vectors of structure.
+
+    Args:
+        structure (Structure): slab with the vacuum along c.
+        length_tol (float): relative tolerance of |a| = |b|.
+        angle_tol (float): tolerance of gamma in degrees.
+
+    Returns:
+        str: one of PATHS_2D.
+    """
+    a, b, gamma = structure.lattice.a, structure.lattice.b, structure.lattice.gamma
+    same_length = abs(a - b) <= length_tol * max(a, b)
+    if abs(gamma - 90) <= angle_tol:
+        return "square" if same_length else "rectangular"
+    if same_length:
+        if abs(gamma - 60) <= angle_tol or abs(gamma - 120) <= angle_tol:
+            return "hexagonal"
+        return "centered_rectangular"
+    return "oblique"
+
+
+def inplane_reciprocal(structure):
+    """
+    Returns:
+        np.array: 2x2, the reciprocal vectors b1, b2 (rows, 1/A incl. 2 pi)
+        in an orthonormal basis of the plane with b1 along x and b2 at
+        positive y.
+    """
+    b1, b2 = structure.lattice.reciprocal_lattice.matrix[:2]
+    e1 = b1 / np.linalg.norm(b1)
+    e2 = b2 - np.dot(b2, e1) * e1
+    e2 /= np.linalg.norm(e2)
+    return np.array([[np.dot(b1, e1), 0.0], [np.dot(b2, e1), np.dot(b2, e2)]])
+
+
+def brillouin_zone_2d(rec, tol=1e-8):
+    """
+    Boundary of the 2D Brillouin zone.
+
+    Args:
+        rec (np.array): 2x2 reciprocal vectors, e.g. from inplane_reciprocal.
+
+    Returns:
+        np.array: Nx2 cartesian vertices and edge centers, alternating and
+        sorted counterclockwise.
+    """
+    ij = np.array([(i, j) for i in range(-2, 3) for j in range(-2, 3) if (i, j) != (0, 0)])
+    g = ij @ rec
+    h = 0.5 * np.einsum("ij,ij->i", g, g)
+    p, q = np.triu_indices(len(g), 1)
+    det = g[p, 0] * g[q, 1] - g[p, 1] * g[q, 0]
+    ok = np.abs(det) > tol
+    p, q, det = p[ok], q[ok], det[ok]
+    # Cramer's rule for g_p.k = h_p, g_q.k = h_q
+    k = np.stack([(h[p] * g[q, 1] - h[q] * g[p, 1]) / det, (g[p, 0] * h[q] - g[q, 0] * h[p]) / det], axis=1)
+    inside = np.all(k @ g.T <= h + tol * np.abs(h).max(), axis=1)
+    scale = np.abs(rec).max()
+    vertices = np.unique(np.round(k[inside] / scale, 8), axis=0) * scale
+    vertices = vertices[np.argsort(np.arctan2(vertices[:, 1], vertices[:, 0]))]
+    centers = 0.5 * (vertices + np.roll(vertices, -1, axis=0))
+    boundary = np.empty((2 * len(vertices), 2))
+    boundary[0::2], boundary[1::2] = vertices, centers
+    return boundary
+
+
+def high_symmetry_kpoints_2d(structure, lattice_type=None):
+    """
+    Returns:
+        (dict, [str]): fractional coordinates of the labelled k-points and the
+        path through them, see PATHS_2D.
+    """
+    lattice_type = lattice_type or lattice_type_2d(structure)
+    rec = inplane_reciprocal(structure)
+    boundary = brillouin_zone_2d(rec)
+    # start at the edge center closest to the direction of b1 (= x)
+    angles = np.arctan2(boundary[:, 1], boundary[:, 0])
+    centers = np.arange(1, len(boundary), 2)
+    start = centers[np.argmin(np.abs(angles[centers]))]
+    boundary = np.roll(boundary, -start, axis=0)
+    path, index = PATHS_2D[lattice_type]
+    if max(index.values()) >= len(boundary) // 2:
+        # a zone with 4 edges, e.g. a nearly rectangular oblique cell
+        path, index = PATHS_2D["rectangular"]
+    frac = np.linalg.solve(rec.T, boundary.T).T
+    frac = np.where(np.abs(frac) < 1e-8, 0.0, frac)
+    kpoints = {GAMMA: np.zeros(3)}
+    for label, i in index.items():
+        kpoints[label] = np.array([frac[i, 0], frac[i, 1], 0.0])
+    return kpoints, path
+
+
+def kpath_2d(structure, line_density=20, lattice_type=None):
+    """
+    K-points along the 2D high-symmetry path, with line_density points per
+    1/A like HighSymmKpath.get_kpoints. The end of one segment is the start
+    of the next and appears only once.
+
+    Returns:
+        (np.array, [str]): Nx3 fractional k-points and their labels ("" off
+        the high-symmetry points).
+    """
+    kpoints, path = high_symmetry_kpoints_2d(structure, lattice_type)
+    rec = structure.lattice.reciprocal_lattice.matrix
+    start = np.array([kpoints[label] for label in path[:-1]])
+    end = np.array([kpoints[label] for label in path[1:]])
+    lengths = np.linalg.norm((end - start) @ rec, axis=1)
+    nums = np.maximum(np.ceil(lengths * line_density).astype(int), 1)
+    seg = np.repeat(np.arange(len(nums)), nums)
+    t = (np.arange(len(seg)) - np.repeat(np.cumsum(nums) - nums, nums)) / nums[seg]
+    kpts = np.vstack([start[seg] + t[:, None] * (end - start)[seg], end[-1:]])
+    labels = [""] * len(kpts)
+    for i, label in zip(np.concatenate([[0], np.cumsum(nums)]), path):
+        labels[i] = label
+    return kpts, labels
+
+
+def inplane_mask(kpts, tol=0.05):
+    """
+    Returns:
+        np.array: bool mask of the k-points with kz = 0 (|kz| < tol, the same
+        as round(kz, 1) == 0).
+    """
+    kpts = np.asarray(kpts, dtype=float).reshape(-1, 3)
+    return np.abs(kpts[:, 2]) < tol
+
+
+def dedupe_consecutive(kpts, labels=None, tol=1e-6):
+    """
+    Drop k-points equal to their predecessor. A label of a dropped point is
+    kept on the remaining one. Two labelled points in a row are both kept:
+    that is where BandStructureSymmLine starts a new branch.
+
+    Returns:
+        (np.array, [str]): k-points and labels.
+    """
+    kpts = np.asarray(kpts, dtype=float).reshape(-1, 3)
+    labels = [""] * len(kpts) if labels is None else list(labels)
+    keep = np.ones(len(kpts), dtype=bool)
+    keep[1:] = np.any(np.abs(np.diff(kpts, axis=0)) > tol, axis=1)
+    labelled = np.array([bool(label) for label in labels], dtype=bool)
+    keep[1:] |= labelled[1:] & labelled[:-1]
+    for i in np.where(~keep)[0]:
+        j = i - 1
+        while not keep[j]:
+            j -= 1
+        labels[j] = labels[j] or labels[i]
+    return kpts[keep], [label for label, k in zip(labels, keep) if k]
+
+
+def ir_mesh_2d(structure, mesh, symprec=0.1, cache=None):
+    """
+    Irreducible k-points of the in-plane n1 x n2 x 1 mesh.
+
+    Args:
+        structure (Structure)
+        mesh ([int]): the third division is ignored.
+        symprec (float)
+        cache (SymmetryCache): used if given.
+
+    Returns:
+        (np.array, np.array): Nx3 fractional k-points and integer weights.
+    """
+    mesh = (int(mesh[0]), int(mesh[1]), 1)
+    if cache is not None:
+        kpts, weights = cache.ir_mesh(structure, mesh, symprec=symprec)
+    else:
+        ir = SpacegroupAnalyzer(structure, symprec=symprec).get_ir_reciprocal_mesh(mesh)
+        kpts, weights = [k for k, _ in ir], [w for _, w in ir]
+    return np.asarray(kpts, dtype=float).reshape(-1, 3), np.asarray(weights, dtype=int)
+
+
+def kpath_2d_line_mode(structure, divisions=20, lattice_type=None):
+    """
+    Line-mode KPOINTS of the 2D high-symmetry path, in the layout of the
+    KPATH.in written by "vaspkit -task 302" (labels GAMMA, X, ..., one pair
+    of points per segment), without running vaspkit.
+
+    Args:
+        structure (Structure): slab with the vacuum along c.
+        divisions (int): k-points per segment.
+        lattice_type (str): one of PATHS_2D, default from lattice_type_2d.
+
+    Returns:
+        Kpoints
+    """
+    kpoints, path = high_symmetry_kpoints_2d(structure, lattice_type)
+    kpts, labels = [], []
+    for start, end in zip(path[:-1], path[1:]):
+        for label in (start, end):
+            kpts.append([round(float(x), 10) for x in kpoints[label]])
+            labels.append("GAMMA" if label == GAMMA else label)
+    return Kpoints(comment="K-Path Generated by vasp.kpath2d.", style=Kpoints.supported_modes.Line_mode,
+                   num_kpts=divisions, kpts=kpts, coord_type="Reciprocal", labels=labels)
@@ -0,0 +1,267 @@
+"""
+Benchmark the transfer modes of FileTransferTask, FileSCPTask and
+CopyFileSCPTask.
+
+Against the real workstation, on given launch directories:
+
+    python -m vasp.local_run.benchmark_transfer -s localhost -p 12346 -u jengyuantsai \\
+        -d /home/jengyuantsai/transfer_bench launch_dir1 launch_dir2 --cleanup
+
+On a laptop, with synthetic launch directories and the in-process server of
+vasp.local_run.sftp_server (no tunnel needed):
+
+    python -m vasp.local_run.benchmark_transfer --local --synthetic 3 --scale 200
+
+Every directory is uploaded once per method into its own scratch directory
+below dest. "sftp_resync" repeats the sftp upload with sync="mtime" and
+measures the latency of a no-op rerun; its MB/s is that of the bytes sent.
+With --baseline, the MB/s of every other method is compared with an earlier
+--json run and the command fails when a method got slower than --tolerance
+allows.
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from vasp.transfer import connect, put_files, archive_files, rtransfer_jobs, scp_command
+
+# name: (fraction of scale, kind). Sizes follow a typical defect supercell
+# SCF run: one huge binary WAVECAR, large text outputs, many small inputs.
+LAUNCH_DIR_FILES = {
+    "WAVECAR": (1.0, "binary"),
+    "CHGCAR": (0.3, "grid"),
+    "vasprun.xml": (0.25, "xml"),
+    "PROCAR": (0.2, "table"),
+    "DOSCAR": (0.03, "table"),
+    "OUTCAR": (0.05, "text"),
+    "EIGENVAL": (0.01, "table"),
+    "CONTCAR": (0.0005, "table"),
+    "POSCAR": (0.0005, "table"),
+    "OSZICAR": (0.0002, "text"),
+    "IBZKPT": (0.0002, "table"),
+    "INCAR": (0.00002, "text"),
+    "KPOINTS": (0.00001, "text"),
+    "FW.json": (0.0001, "text"),
+    "vasp.out": (0.0003, "text"),
+}
+
+SFTP_METHODS = {
+    "sftp": lambda c, jobs: put_files(c, jobs),
+    "sftp_x4": lambda c, jobs: put_files(c, jobs, workers=4),
+    "sftp_resync": lambda c, jobs: put_files(c, jobs, sync="mtime"),
+    "tar": lambda c, jobs: archive_files(c, jobs, compress="tar"),
+    "gzip": lambda c, jobs: archive_files(c, jobs, compress="gzip"),
+    "zstd": lambda c, jobs: archive_files(c, jobs, compress="zstd"),
+}
+# FileSCPTask/CopyFileSCPTask, run as OpenSSH subprocesses
+SCP_METHODS = ("scp", "rsync", "scp_archive", "scp_download")
+METHODS = list(SFTP_METHODS) + list(SCP_METHODS)
+# no-op reruns: their MB/s counts the bytes actually sent, not the directory
+# size, and is left out of compare
+RESYNC_METHODS = ("sftp_resync",)
+
+
+def _write_synthetic(path, size, kind, rng):
+    with open(path, "wb") as f:
+        if kind == "binary":
+            f.write(os.urandom(size))
+            return
+        written = 0
+        while written < size:
+            if kind == "xml":
+                line = "       <r> {:12.4f} {:12.4f} {:12.4f} </r>\n".format(
+                    rng.uniform(-20, 20), rng.random(), rng.random())
+            elif kind == "text":
+                line = " energy  without entropy= {:18.8f}  energy(sigma->0) = {:18.8f}\n".format(
+                    rng.uniform(-900, -100), rng.uniform(-900, -100))
+            elif kind == "grid":
+                line = " ".join("{:.11E}".format(rng.uniform(0, 5)) for _ in range(5)) + "\n"
+            else:
+                line = " ".join("{:10.5f}".format(rng.random()) for _ in range(8)) + "\n"
+            data = line.encode()
+            f.write(data)
+            written += len(data)
+
+
+def make_launch_dir(path, scale=100, seed=0):
+    """
+    Write a synthetic launch directory with VASP-like file names, size
+    distribution and compressibility (random binary WAVECAR, numeric text
+    for the rest).
+
+    Args:
+        path (str): directory, created if needed.
+        scale (float): size of the largest file (WAVECAR) in MB.
+        seed (int): seed of the text content.
+
+    Returns:
+        str: path
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for name, (fraction, kind) in LAUNCH_DIR_FILES.items():
+        _write_synthetic(os.path.join(path, name), max(1, int(fraction * scale * 1e6)), kind, rng)
+    return path
+
+
+def _du(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def _run_scp(method, src, remote_dir, port, user, ssh_options):
+    if method == "scp_download":
+        # CopyFileSCPTask: fetch the uploaded copy back
+        local = tempfile.mkdtemp(prefix="scp_download.")
+        try:
+            subprocess.check_output(["scp", "-P", str(port)] + ssh_options +
+                                    ["-r", "{}@localhost:{}".format(user, remote_dir), local],
+                                    stderr=subprocess.STDOUT)
+        finally:
+            shutil.rmtree(local, ignore_errors=True)
+        return
+    if method == "scp":
+        cmd = scp_command(src, port, user, remote_dir, ssh_options=ssh_options)
+    elif method == "rsync":
+        cmd = scp_command(src, port, user, remote_dir, sync="mtime", ssh_options=ssh_options)
+    else:
+        cmd = scp_command(src, port, user, remote_dir, archive="gzip", ssh_options=ssh_options)
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def benchmark(connect_fn, dirs, dest, methods=None, cleanup=False, port=None, user=None, ssh_options=None):
+    """
+    Args:
+        connect_fn (callable): returns a connected paramiko.SSHClient.
+        dirs ([str]): local launch directories.
+        dest (str): remote scratch directory.
+        methods ([str]): keys of METHODS. Default: all sftp methods, plus
+            the scp methods when port and user are given.
+        cleanup (bool): remove the uploaded copies afterwards.
+        port (int), user (str), ssh_options ([str]): for the scp methods.
+
+    Returns:
+        [dict]: one row per directory and method.
+    """
+    if methods is None:
+        methods = list(SFTP_METHODS) + (list(SCP_METHODS) if port and user else [])
+    rows = []
+    for d in dirs:
+        d = os.path.abspath(d)
+        nbytes = _du(d)
+        for method in methods:
+            remote_dir = os.path.join(dest, "{}.{}".format(os.path.basename(d), method))
+            start = time.time()
+            if method in SFTP_METHODS:
+                jobs = rtransfer_jobs([d], remote_dir)
+                if method == "sftp_resync":
+                    put_files(connect_fn, jobs)
+                    start = time.time()
+                stats = SFTP_METHODS[method](connect_fn, jobs)
+                sent = stats.get("bytes_sent", stats["bytes"])
+            else:
+                if method == "scp_download":
+                    _run_scp("scp", d, remote_dir, port, user, ssh_options or [])
+                    start = time.time()
+                _run_scp(method, d, remote_dir, port, user, ssh_options or [])
+                sent = None
+            seconds = time.time() - start
+            moved = sent if method in RESYNC_METHODS else nbytes
+            rows.append({"dir": d, "method": method, "MB": round(nbytes / 1e6, 2),
+                         "MB_sent": round(sent / 1e6, 2) if sent is not None else None,
+                         "seconds": round(seconds, 3), "MB_s": round(moved / seconds / 1e6, 2) if seconds else None})
+            if cleanup:
+                ssh = connect_fn()
+                ssh.exec_command("rm -rf {}".format(shlex.quote(remote_dir)))[1].channel.recv_exit_status()
+                ssh.close()
+    return rows
+
+
+def compare(rows, baseline, tolerance=0.2):
+    """
+    Methods whose mean MB/s dropped by more than tolerance against baseline
+    rows (as returned by benchmark). RESYNC_METHODS are skipped.
+
+    Returns:
+        {str: (float, float)}: method -> (baseline MB/s, current MB/s).
+    """
+    def mean(rs):
+        out = {}
+        for r in rs:
+            if r["MB_s"] is not None and r["method"] not in RESYNC_METHODS:
+                out.setdefault(r["method"], []).append(r["MB_s"])
+        return {k: sum(v) / len(v) for k, v in out.items()}
+
+    old, new = mean(baseline), mean(rows)
+    return {m: (old[m], new[m]) for m in new if m in old and new[m] < old[m] * (1 - tolerance)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dirs", nargs="*", help="local launch directories")
+    parser.add_argument("-s", "--server", default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=12346)
+    parser.add_argument("-u", "--user", default=None)
+    parser.add_argument("-k", "--key_filename", default=None)
+    parser.add_argument("-d", "--dest", default=None, help="remote scratch directory")
+    parser.add_argument("-m", "--methods", nargs="+", choices=METHODS, default=None)
+    parser.add_argument("--local", action="store_true", help="use the in-process SSH server")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic launch dirs to add")
+    parser.add_argument("--scale", type=float, default=100, help="WAVECAR size of synthetic dirs in MB")
+    parser.add_argument("--cleanup", action="store_true", help="remove the uploaded copies")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    parser.add_argument("--baseline", default=None, help="JSON output of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative MB/s drop")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="transfer_bench.")
+    server = None
+    try:
+        dirs = list(args.dirs) + [make_launch_dir(os.path.join(work, "launch_{}".format(i)), args.scale, seed=i)
+                                  for i in range(args.synthetic)]
+        if not dirs:
+            parser.error("no launch directories, give some or use --synthetic")
+        if args.local:
+            from vasp.local_run.sftp_server import LocalSSHServer
+            server = LocalSSHServer().start()
+            connect_fn, port, ssh_options = server.connect, server.port, server.ssh_options
+            user, dest = args.user or os.environ.get("USER", "bench"), args.dest or os.path.join(work, "remote")
+            os.makedirs(dest, exist_ok=True)
+        else:
+            if not args.dest:
+                parser.error("--dest is required without --local")
+            connect_fn = lambda: connect(args.server, args.port, args.user, args.key_filename)
+            port, user, dest, ssh_options = args.port, args.user, args.dest, None
+        rows = benchmark(connect_fn, dirs, dest, args.methods, args.cleanup, port=port, user=user,
+                         ssh_options=ssh_options)
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print("{:<32} {:<13} {:>10} {:>10} {:>9} {:>8}".format("dir", "method", "MB", "MB sent", "seconds", "MB/s"))
+        for r in rows:
+            print("{:<32} {:<13} {:>10} {:>10} {:>9} {:>8}".format(
+                os.path.basename(r["dir"])[-32:], r["method"], r["MB"], str(r["MB_sent"]), r["seconds"], r["MB_s"]))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(rows, json.load(f), args.tolerance)
+        for method, (old, new) in slower.items():
+            print("REGRESSION {}: {:.2f} -> {:.2f} MB/s".format(method, old, new), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
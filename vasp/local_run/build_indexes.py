@@ -0,0 +1,59 @@
+"""
+Create the indexes the *ToDb firetasks rely on (see TASK_INDEXES in
+vasp.database). Safe to run repeatedly: existing indexes are left alone.
+
+    python -m vasp.local_run.build_indexes -d db.json -c ir_data:IRVSPToDb -c zfs_data:PyzfsToDb
+
+Without -c, the collection of the db_file gets the VaspToDb indexes.
+"""
+
+import argparse
+import json
+
+from atomate.utils.utils import get_logger
+
+from vasp.database import JVaspCalcDb, TASK_INDEXES
+
+logger = get_logger(__name__)
+
+
+def build_indexes(db_file, collections=None, background=True):
+    """
+    Args:
+        db_file (str): path to the db.json of the database.
+        collections ({str: [str]}): collection name -> *ToDb tasks writing to
+            it. None is the collection of the db_file. Default:
+            {None: ["VaspToDb"]}.
+        background (bool): build new indexes in the background.
+
+    Returns:
+        {str: [str]}: index names per collection.
+    """
+    mmdb = JVaspCalcDb.from_db_file(db_file, admin=True)
+    default = mmdb.collection.name
+    out = {}
+    for name, tasks in (collections or {None: ["VaspToDb"]}).items():
+        mmdb.collection = mmdb.db[name or default]
+        out[mmdb.collection.name] = mmdb.ensure_indexes(tasks, background=background)
+        logger.info("{}: {}".format(mmdb.collection.name, ", ".join(out[mmdb.collection.name])))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-d", "--db_file", required=True, help="db.json of the database")
+    parser.add_argument("-c", "--collection", action="append", default=[],
+                        help="collection[:Task[,Task]], tasks from {} (default VaspToDb)".format(
+                            ", ".join(TASK_INDEXES)))
+    parser.add_argument("--foreground", action="store_true", help="build new indexes in the foreground")
+    args = parser.parse_args()
+
+    collections = {}
+    for c in args.collection:
+        name, _, tasks = c.partition(":")
+        collections[name] = tasks.split(",") if tasks else ["VaspToDb"]
+    print(json.dumps(build_indexes(args.db_file, collections or None, background=not args.foreground)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+In-process SSH/SFTP server standing in for the workstation behind the tunnel.
+
+It serves the local filesystem over SFTP and runs exec requests (tar,
+sha256sum, rsync --server, ...) with bash, which is everything the transfer
+code in vasp.transfer and the scp/rsync based firetasks need. It listens on
+127.0.0.1 only and accepts any user name, but only the client key generated
+for the server instance, which connect and ssh_options hand to the clients.
+It is meant for exercising and benchmarking the transfer modes on a laptop:
+
+    with LocalSSHServer() as server:
+        put_files(server.connect, jobs, workers=4)
+        subprocess.check_call(scp_command(src, server.port, "me", dest, ssh_options=server.ssh_options))
+"""
+
+import getpass
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+
+import paramiko
+from paramiko.sftp import SFTP_OK
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_handle import SFTPHandle
+from paramiko.sftp_server import SFTPServer
+from paramiko.sftp_si import SFTPServerInterface
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+
+class _Handle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPInterface(SFTPServerInterface):
+    """
+    SFTP on the local filesystem, with absolute paths as is.
+    """
+
+    @staticmethod
+    def _call(fn, *args):
+        try:
+            fn(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join("/", path) if not os.path.isabs(path) else path)
+
+    def list_folder(self, path):
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags | getattr(os, "O_BINARY", 0), getattr(attr, "st_mode", None) or 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            return SFTPServer.convert_errno(17)
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        return self._call(SFTPServer.set_file_attr, path, attr)
+
+    def symlink(self, target_path, path):
+        return self._call(os.symlink, target_path, path)
+
+    def readlink(self, path):
+        try:
+            return os.readlink(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPServer(SFTPServer):
+    """
+    Reports exit status 0 when the client ends the session; OpenSSH scp
+    (SFTP mode) fails on a subsystem channel closed without one.
+    """
+
+    def finish_subsystem(self):
+        try:
+            self.sock.send_exit_status(0)
+        except (OSError, EOFError):
+            pass
+        super().finish_subsystem()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """
+    Accepts the holder of client_key and runs exec requests with bash.
+    """
+
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key.get_name() == self.client_key.get_name() and key.asbytes() == self.client_key.asbytes():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+
+def _run_exec(channel, command):
+    proc = subprocess.Popen(["bash", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def feed():
+        try:
+            for chunk in iter(lambda: channel.recv(1 << 16), b""):
+                proc.stdin.write(chunk)
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    def drain(stream, send):
+        for chunk in iter(lambda: stream.read1(1 << 16), b""):
+            send(chunk)
+
+    threads = [threading.Thread(target=feed, daemon=True),
+               threading.Thread(target=drain, args=(proc.stdout, channel.sendall), daemon=True),
+               threading.Thread(target=drain, args=(proc.stderr, channel.sendall_stderr), daemon=True)]
+    for t in threads:
+        t.start()
+    status = proc.wait()
+    for t in threads[1:]:
+        t.join()
+    channel.send_exit_status(status)
+    channel.shutdown_write()
+    channel.close()
+
+
+class LocalSSHServer:
+    """
+    SSH server on 127.0.0.1 with an SFTP subsystem and exec support, run in
+    background threads of this process. Use as a context manager.
+
+    Attributes:
+        port (int): listening port.
+        ssh_options ([str]): OpenSSH client options (-F <config>) that make
+            ssh/scp/rsync talk to this server with its client key and without
+            host key prompts.
+    """
+
+    def __init__(self, port=0):
+        self._key = paramiko.RSAKey.generate(2048)
+        # the only credential the server accepts, fresh for every instance
+        self._client_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", port))
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._tmp = tempfile.TemporaryDirectory()
+        identity = os.path.join(self._tmp.name, "id_rsa")
+        self._client_key.write_private_key_file(identity)
+        os.chmod(identity, 0o600)
+        config = os.path.join(self._tmp.name, "ssh_config")
+        with open(config, "w") as f:
+            f.write("Host localhost 127.0.0.1\n"
+                    "  HostName 127.0.0.1\n"
+                    "  StrictHostKeyChecking no\n"
+                    "  UserKnownHostsFile /dev/null\n"
+                    "  PreferredAuthentications publickey\n"
+                    "  IdentityFile {}\n"
+                    "  IdentitiesOnly yes\n"
+                    "  LogLevel ERROR\n".format(identity))
+        self.ssh_options = ["-F", config]
+
+    def start(self):
+        self._sock.listen(32)
+        self._sock.settimeout(0.2)
+        self._thread = threading.Thread(target=self._serve, name="local-ssh-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            conn.settimeout(None)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self._key)
+            transport.set_subsystem_handler("sftp", _SFTPServer, _SFTPInterface)
+            try:
+                transport.start_server(server=_ServerInterface(self._client_key))
+            except (paramiko.SSHException, EOFError):
+                continue
+            self._transports.append(transport)
+
+    def connect(self, user=None):
+        """
+        Returns:
+            paramiko.SSHClient: a session to this server.
+        """
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect("127.0.0.1", port=self.port, username=user or getpass.getuser(), pkey=self._client_key,
+                    look_for_keys=False, allow_agent=False)
+        return ssh
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+        self._tmp.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,51 +1,252 @@
-import json, os
-from monty.json import MontyEncoder, MontyDecoder
-from atomate.vasp.database import VaspCalcDb
-from atomate.vasp.drones import VaspDrone
-
-local_scf_path = "/home/qimin/tsai/sdb_tsai/Research/projects/Scan2dDefect/calc_data/scf"
-
-mmdb = VaspCalcDb.from_db_file('/mnt/sdb/tsai/scripts/update_eigen/db.json', admin=True)
-
-for e in mmdb.collection.find({"task_label": "SCAN_scf"})[:1]:
-    t_id = e["task_id"]
-    print(t_id)
-    if t_id != 3257:
-        continue
-
-    path = e["dir_name"].split("/")[-1]
-    drone = VaspDrone(parse_eigenvalues=True, parse_dos=True)
-    task_doc = drone.assimilate(os.path.join(local_scf_path, path))
-
-    eigenvals = {}
-    dos = None
-    if "calcs_reversed" in task_doc:
-        for eigenvalue in ("eigenvalues", "projected_eigenvalues"):
-            if eigenvalue in task_doc["calcs_reversed"][0]["output"]:  # only store idx=0 data
-                eigenvals[eigenvalue] = json.dumps(task_doc["calcs_reversed"][0]["output"][eigenvalue],
-                                                   cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["output"][eigenvalue]
-
-            if "dos" in task_doc["calcs_reversed"][0]:  # only store idx=0 (last step)
-                dos = json.dumps(task_doc["calcs_reversed"][0]["dos"], cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["dos"]
-
-    if eigenvals:
-        for name, data in eigenvals.items():
-            data_gfs_id, compression_type = mmdb.insert_gridfs(data, "{}_fs".format(name), task_id=t_id)
-            mmdb.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.{}_compression".format(name): compression_type}})
-            mmdb.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.{}_fs_id".format(name): data_gfs_id}})
-    if dos:
-        dos_gfs_id, compression_type = mmdb.insert_gridfs(
-            dos, "dos_fs", task_id=t_id
-        )
-        mmdb.collection.update_one(
-            {"task_id": t_id},
-            {"$set": {"calcs_reversed.0.dos_compression": compression_type}},
-        )
-        mmdb.collection.update_one(
-            {"task_id": t_id}, {"$set": {"calcs_reversed.0.dos_fs_id": dos_gfs_id}}
-        )
+"""
+Backfill eigenvalues, projected eigenvalues and DOS of existing tasks by
+re-parsing their launch directories.
 
+Tasks are selected with a Mongo query, re-parsed in a process pool and written
+to GridFS in batches. A watermark file records the highest task_id up to which
+every task has been processed and the task_ids that failed, so a killed run
+picks up where it stopped and a rerun retries the failed tasks.
 
+    python -m vasp.local_run.store_eigenvalues -d db.json -q '{"task_label": "SCAN_scf"}' \\
+        -l /home/qimin/tsai/sdb_tsai/Research/projects/Scan2dDefect/calc_data/scf -n 8
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import deque
+from multiprocessing import Pool
+
+from monty.json import MontyEncoder
+
+from pymongo import UpdateOne
+
+from atomate.utils.utils import get_logger
+
+from vasp.database import JVaspCalcDb, EIGENVALUE_KEYS, encode_eigenvalues
+from vasp.drones import JVaspDrone
+
+logger = get_logger(__name__)
+
+
+def get_launch_dir(dir_name, launch_root=None):
+    """
+    Local path of a task's launch dir. dir_name in task docs is
+    "hostname:/path"; with launch_root, the last path component is looked up
+    under launch_root instead.
+    """
+    path = dir_name.split(":", 1)[-1]
+    if launch_root:
+        return os.path.join(launch_root, path.rstrip("/").split("/")[-1])
+    return path
+
+
+def parse_task(args):
+    """
+    Re-parse one launch dir and serialize its GridFS payloads. Runs in a worker
+    process, so the expensive parse, encode and compress steps are parallel.
+
+    Returns:
+        (int, {str: (bytes, str, str)}, str): task_id, {name: (zlib blob,
+        format, sha256 of the uncompressed data)} and an error message (None
+        on success).
+    """
+    task_id, path, parse_dos, fmt, dtype, streaming, parse_cache = args
+    try:
+        drone = JVaspDrone(streaming=streaming, parse_cache=parse_cache, parse_eigenvalues=True,
+                           parse_dos=parse_dos)
+        task_doc = drone.assimilate(path)
+        calc = task_doc["calcs_reversed"][0]  # only store idx=0 data
+
+        blobs = {}
+        for name in EIGENVALUE_KEYS:
+            if name in calc["output"]:
+                data = encode_eigenvalues(calc["output"][name], fmt=fmt, dtype=dtype)
+                blobs[name] = (zlib.compress(data), fmt, hashlib.sha256(data).hexdigest())
+        if parse_dos and "dos" in calc:
+            data = json.dumps(calc["dos"], cls=MontyEncoder).encode()
+            blobs["dos"] = (zlib.compress(data), None, hashlib.sha256(data).hexdigest())
+        return task_id, blobs, None
+    except Exception as err:
+        return task_id, {}, "{}: {}".format(type(err).__name__, err)
+
+
+class Watermark:
+    """
+    Resume point of a backfill run, stored as JSON.
+
+    The watermark is the highest task_id such that every selected task with a
+    smaller or equal task_id has been processed. Tasks finish out of order in
+    the pool, so finished task_ids above the watermark are kept until the gap
+    below them closes. Task_ids at or below the watermark (retries of failed
+    tasks) do not move it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.value = None
+        self.tasks_done = 0
+        self.bytes_stored = 0
+        self.failed = []
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                d = json.load(f)
+            self.value = d["watermark"]
+            self.tasks_done = d.get("tasks_done", 0)
+            self.bytes_stored = d.get("bytes_stored", 0)
+            self.failed = d.get("failed", [])
+        self._pending = deque()
+        self._finished = set()
+
+    def submitted(self, task_id):
+        if self.value is None or task_id > self.value:
+            self._pending.append(task_id)
+
+    def finished(self, task_ids):
+        self._finished.update(t for t in task_ids if self.value is None or t > self.value)
+        while self._pending and self._pending[0] in self._finished:
+            self.value = self._pending.popleft()
+            self._finished.discard(self.value)
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"watermark": self.value, "tasks_done": self.tasks_done,
+                       "bytes_stored": self.bytes_stored, "failed": self.failed}, f)
+        os.replace(tmp, self.filename)
+
+
+def store_batch(mmdb, results):
+    """
+    Write the GridFS blobs of a batch of parsed tasks and point the task
+    documents to them with a single bulk update.
+
+    Returns:
+        int: bytes stored.
+    """
+    requests, nbytes = [], 0
+    for task_id, blobs in results:
+        update = {}
+        for name, (blob, fmt, digest) in blobs.items():
+            fs_id, compression_type = mmdb.insert_gridfs(blob, "{}_fs".format(name), task_id=task_id,
+                                                         precompressed=True, sha256=digest)
+            update["calcs_reversed.0.{}_fs_id".format(name)] = fs_id
+            update["calcs_reversed.0.{}_compression".format(name)] = compression_type
+            if fmt:
+                update["calcs_reversed.0.{}_format".format(name)] = fmt
+            nbytes += len(blob)
+        if update:
+            requests.append(UpdateOne({"task_id": task_id}, {"$set": update}))
+    if requests:
+        mmdb.collection.bulk_write(requests, ordered=False)
+    return nbytes
+
+
+def backfill(db_file, query, launch_root=None, nproc=4, batch_size=20, watermark_file=None,
+             parse_dos=True, fmt="npz", dtype=None, streaming=False, deduplicate=False, parse_cache=False):
+    """
+    Re-parse the launch dirs of all tasks matching query and store their
+    eigenvalues, projected eigenvalues and (optionally) DOS in GridFS.
+
+    Args:
+        db_file (str): path to the db.json of the task collection.
+        query (dict): Mongo query selecting the tasks.
+        launch_root (str): local directory holding the launch dirs, see
+            get_launch_dir. Default: use dir_name of the task as is.
+        nproc (int): number of parser processes.
+        batch_size (int): number of tasks per GridFS/bulk-update batch.
+        watermark_file (str): JSON file used to resume an interrupted run.
+        parse_dos (bool): also store the DOS.
+        fmt (str): eigenvalues format, "npz" or "json".
+        dtype (str): e.g. "float32" for npz eigenvalues.
+        streaming (bool): use the streaming vasprun.xml parser.
+        deduplicate (bool): reuse identical GridFS payloads already stored.
+        parse_cache (bool or str): parse cache of JVaspDrone.
+    """
+    mmdb = JVaspCalcDb.from_db_file(db_file, admin=True)
+    mmdb.deduplicate = deduplicate
+    watermark = Watermark(watermark_file)
+
+    if watermark.value is not None:
+        query = {"$and": [query, {"$or": [{"task_id": {"$gt": watermark.value}},
+                                          {"task_id": {"$in": watermark.failed}}]}]}
+        logger.info("Resuming after task_id {}, retrying {} failed tasks".format(
+            watermark.value, len(watermark.failed)))
+
+    cursor = mmdb.collection.find(query, {"task_id": 1, "dir_name": 1}).sort("task_id", 1)
+    jobs = []
+    for e in cursor:
+        watermark.submitted(e["task_id"])
+        jobs.append((e["task_id"], get_launch_dir(e["dir_name"], launch_root), parse_dos, fmt, dtype, streaming,
+                     parse_cache))
+    logger.info("{} tasks to backfill".format(len(jobs)))
+
+    start, done, nbytes = time.time(), 0, 0
+    batch, finished = [], []
+
+    def flush():
+        nonlocal nbytes
+        n = store_batch(mmdb, batch)
+        stored = {task_id for task_id, _ in batch}
+        watermark.failed = [task_id for task_id in watermark.failed if task_id not in stored]
+        nbytes += n
+        watermark.bytes_stored += n
+        watermark.tasks_done += len(batch)
+        watermark.finished(finished)
+        watermark.save()
+        minutes = (time.time() - start) / 60
+        logger.info("{}/{} tasks, {:.1f} tasks/min, {:.1f} MB stored".format(
+            done, len(jobs), done / minutes if minutes else 0, nbytes / 1e6))
+        del batch[:], finished[:]
+
+    with Pool(nproc) as pool:
+        for task_id, blobs, err in pool.imap_unordered(parse_task, jobs):
+            done += 1
+            finished.append(task_id)
+            if err:
+                logger.warning("task_id {} failed: {}".format(task_id, err))
+                if task_id not in watermark.failed:
+                    watermark.failed.append(task_id)
+            else:
+                batch.append((task_id, blobs))
+            if len(finished) >= batch_size:
+                flush()
+        flush()
+
+    minutes = (time.time() - start) / 60
+    return {"tasks": done, "failed": len(watermark.failed), "bytes_stored": nbytes,
+            "tasks_per_min": done / minutes if minutes else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-d", "--db_file", required=True, help="db.json of the task collection")
+    parser.add_argument("-q", "--query", default='{"task_label": "SCAN_scf"}', help="Mongo query (JSON)")
+    parser.add_argument("-l", "--launch_root", default=None, help="local directory holding the launch dirs")
+    parser.add_argument("-n", "--nproc", type=int, default=4, help="number of parser processes")
+    parser.add_argument("-b", "--batch_size", type=int, default=20, help="tasks per GridFS/update batch")
+    parser.add_argument("-w", "--watermark", default="backfill_watermark.json", help="resume file")
+    parser.add_argument("--no_dos", action="store_true", help="do not store the DOS")
+    parser.add_argument("--format", default="npz", choices=["npz", "json"], help="eigenvalues format")
+    parser.add_argument("--dtype", default=None, help="e.g. float32 (npz only)")
+    parser.add_argument("--streaming", action="store_true", help="streaming vasprun.xml parser")
+    parser.add_argument("--deduplicate", action="store_true", help="reuse identical GridFS payloads")
+    parser.add_argument("--parse_cache", default=None,
+                        help="cache parsed documents in this directory ('default': ~/.cache/vasp_parse_cache)")
+    args = parser.parse_args()
+
+    stats = backfill(args.db_file, json.loads(args.query), launch_root=args.launch_root, nproc=args.nproc,
+                     batch_size=args.batch_size, watermark_file=args.watermark, parse_dos=not args.no_dos,
+                     fmt=args.format, dtype=args.dtype, streaming=args.streaming,
+                     deduplicate=args.deduplicate,
+                     parse_cache=True if args.parse_cache == "default" else (args.parse_cache or False))
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
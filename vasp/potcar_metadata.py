@@ -0,0 +1,95 @@
+"""
+Memoized POTCAR and input-set metadata for the workflow builders.
+
+get_wf_full_hse/get_wf_full_scan and the fireworks used to construct a
+MPRelaxSet/MPHSERelaxSet/MPScanRelaxSet only to read the ENMAX of the POTCARs,
+NELECT of a charge state or the default MAGMOM, each time parsing the POTCAR
+files again. The functions here give the same numbers as the input sets
+(default POTCAR choice and functional of the set's yaml, no user_potcar_settings)
+from a per-process cache keyed by element and functional, so building the
+workflows of thousands of defects reads every POTCAR once:
+
+    encut = 1.3 * max_enmax(structure, MPHSERelaxSet)
+    nelect = get_nelect(structure, MPHSERelaxSet)
+    magmom = get_default_magmom(structure)
+"""
+
+from functools import lru_cache
+
+from pymatgen.io.vasp import sets
+from pymatgen.io.vasp.inputs import PotcarSingle
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+
+def _config(input_set):
+    cls = getattr(sets, input_set) if isinstance(input_set, str) else input_set
+    return cls.CONFIG
+
+
+@lru_cache(maxsize=None)
+def _potcar_data(symbol, functional):
+    potcar = PotcarSingle.from_symbol_and_functional(symbol, functional)
+    return {"symbol": symbol, "functional": functional, "element": potcar.element,
+            "enmax": potcar.enmax, "zval": potcar.zval}
+
+
+def potcar_data(element, input_set="MPRelaxSet"):
+    """
+    POTCAR metadata of an element in an input set, read once per process.
+
+    Args:
+        element (str): element symbol.
+        input_set (str or DictSet class): e.g. "MPHSERelaxSet" or MPScanRelaxSet.
+
+    Returns:
+        dict: symbol, functional, element, enmax and zval of the POTCAR.
+    """
+    config = _config(input_set)
+    setting = config["POTCAR"].get(element, element)
+    symbol = setting["symbol"] if isinstance(setting, dict) else setting
+    return _potcar_data(symbol, config.get("POTCAR_FUNCTIONAL", "PBE"))
+
+
+def max_enmax(structure, input_set="MPRelaxSet"):
+    """
+    Returns:
+        float: the largest ENMAX of the POTCARs of structure, as
+        max(p.enmax for p in input_set(structure).potcar).
+    """
+    return max(potcar_data(el.symbol, input_set)["enmax"] for el in structure.composition.elements)
+
+
+def get_nelect(structure, input_set="MPRelaxSet", use_structure_charge=True):
+    """
+    Returns:
+        float: NELECT of structure, as input_set(structure,
+        use_structure_charge=use_structure_charge).nelect.
+    """
+    comp = structure.composition.element_composition
+    nelect = sum(amt * potcar_data(el.symbol, input_set)["zval"] for el, amt in comp.items())
+    if use_structure_charge:
+        return nelect - structure.charge
+    return nelect
+
+
+def get_default_magmom(structure, input_set="MPRelaxSet"):
+    """
+    Returns:
+        [float]: MAGMOM per site, as input_set(structure).incar.get("MAGMOM"):
+        the magmom site property or spin of the species if set, else the
+        default of the input set.
+    """
+    defaults = _config(input_set)["INCAR"].get("MAGMOM")
+    if defaults is None:
+        return None
+    magmom = []
+    for site in structure:
+        if hasattr(site, "magmom"):
+            magmom.append(site.magmom)
+        elif hasattr(site.specie, "spin"):
+            magmom.append(site.specie.spin)
+        else:
+            magmom.append(defaults.get(str(site.specie), defaults.get(site.specie.symbol, 0.6)))
+    return magmom
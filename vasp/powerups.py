@@ -1,16 +1,25 @@
+import copy
+import uuid
+
 from .firetasks.firetasks import Write2dNSCFKpoints, Write2dSCFKpointsFromVaspkit, FileTransferTask, \
     WriteInputsFromDB, FileSCPTask, \
-    CopyFileSCPTask
+    CopyFileSCPTask, SplitZeroWeightKpoints
+from .fireworks.fireworks import MergeBSChunksFW
+
+from .transfer import TransferPolicy
+from .potcar_metadata import get_default_magmom
 
 from atomate.utils.utils import get_fws_and_tasks
 from atomate.vasp.config import (
-    VDW_KERNEL_DIR
+    VDW_KERNEL_DIR,
+    DB_FILE
 )
 from atomate.vasp.firetasks.glue_tasks import CopyFiles
 from atomate.vasp.firetasks.write_inputs import ModifyIncar, WriteVaspFromPMGObjects
 
+from fireworks import Firework, Workflow
+
 from pymatgen import Structure
-from pymatgen.io.vasp.sets import MPRelaxSet
 
 __author__ = "Jeng-Yuan Tsai"
 __email__ = "tsaie79@gmail.com"
@@ -22,6 +31,8 @@ def scp_files(
         port=12346,
         fw_name_constraint=None,
         task_name_constraint="VaspToDb",
+        async_queue=None,
+        policy=None,
 ):
     """
     SCP ALL files to local computer
@@ -38,6 +49,13 @@ def scp_files(
         dest (str): "/home/jengyuantsai/test_scp_fw/defect_db/binary_vac_AB/" (make sure every folder exists)
         fw_name_constraint (str): pattern for fireworks to clean up files after
         task_name_constraint (str): pattern for firetask to clean up files
+        async_queue (str): only queue the transfer in this directory for the uploader
+            daemon (python -m vasp.uploader) instead of transferring on the compute node.
+            The result is reported to the task document in >>db_file<<.
+        policy (TransferPolicy or dict): which files to send and how, e.g.
+            TransferPolicy(exclude=LARGE_ARTIFACTS) to keep WAVECAR/WAVEDER/WFULL of
+            GW runs off the tunnel, or defer_above="1G" with async_queue to leave
+            large files to the uploader.
 
     Returns:
        Workflow
@@ -47,6 +65,11 @@ def scp_files(
         fw_name_constraint=fw_name_constraint,
         task_name_constraint=task_name_constraint,
     )
+    transfer_kwargs = {}
+    if async_queue:
+        transfer_kwargs.update(async_queue=async_queue, db_file=">>db_file<<")
+    if policy:
+        transfer_kwargs["policy"] = TransferPolicy.from_dict(policy).as_dict()
     user = "jengyuantsai" if port==12346 else "qimin"
     for idx_fw, idx_t in idx_list:
         original_wf.fws[idx_fw].tasks.insert(idx_t + 1, FileTransferTask(
@@ -55,7 +78,8 @@ def scp_files(
             dest=dest,
             server="localhost",
             user=user,
-            port=port
+            port=port,
+            **transfer_kwargs
         ))
 
     return original_wf
@@ -66,6 +90,9 @@ def bash_scp_files(
         port=12350,
         fw_name_constraint=None,
         task_name_constraint="VaspToDb",
+        multiplex=False,
+        async_queue=None,
+        policy=None,
 ):
     """
     SCP ALL files to local computer
@@ -82,6 +109,14 @@ def bash_scp_files(
         dest (str): "/home/jengyuantsai/test_scp_fw/defect_db/binary_vac_AB/" (make sure every folder exists)
         fw_name_constraint (str): pattern for fireworks to clean up files after
         task_name_constraint (str): pattern for firetask to clean up files
+        multiplex (bool): share one SSH master connection between the transfers
+        async_queue (str): only queue the transfer in this directory for the uploader
+            daemon (python -m vasp.uploader) instead of transferring on the compute node.
+            The result is reported to the task document in >>db_file<<.
+        policy (TransferPolicy or dict): which files to send and how, e.g.
+            TransferPolicy(exclude=LARGE_ARTIFACTS) to keep WAVECAR/WAVEDER/WFULL of
+            GW runs off the tunnel, or defer_above="1G" with async_queue to leave
+            large files to the uploader.
 
     Returns:
        Workflow
@@ -91,12 +126,19 @@ def bash_scp_files(
         fw_name_constraint=fw_name_constraint,
         task_name_constraint=task_name_constraint,
     )
+    transfer_kwargs = {}
+    if async_queue:
+        transfer_kwargs.update(async_queue=async_queue, db_file=">>db_file<<")
+    if policy:
+        transfer_kwargs["policy"] = TransferPolicy.from_dict(policy).as_dict()
     user = "tsai"
     for idx_fw, idx_t in idx_list:
         original_wf.fws[idx_fw].tasks.insert(idx_t + 1, FileSCPTask(
             port=port,
             user=user,
+            multiplex=multiplex,
             dest=dest,
+            **transfer_kwargs
         ))
 
     return original_wf
@@ -107,6 +149,7 @@ def bash_scp_copy_files(
         port=12346,
         fw_name_constraint=None,
         task_name_constraint="VaspToDb",
+        multiplex=False,
 ):
     """
     SCP ALL files to local computer
@@ -123,6 +166,7 @@ def bash_scp_copy_files(
         dest (str): "/home/jengyuantsai/test_scp_fw/defect_db/binary_vac_AB/" (make sure every folder exists)
         fw_name_constraint (str): pattern for fireworks to clean up files after
         task_name_constraint (str): pattern for firetask to clean up files
+        multiplex (bool): share one SSH master connection between the transfers
 
     Returns:
        Workflow
@@ -137,6 +181,7 @@ def bash_scp_copy_files(
         original_wf.fws[idx_fw].tasks.insert(idx_t + 1, CopyFileSCPTask(
             port=port,
             user=user,
+            multiplex=multiplex,
             copy_from=copy_from,
         ))
 
@@ -198,7 +243,7 @@ def jmodify_to_soc(
             )
 
     if not magmom:
-        magmom = [[0,0,mag_z] for mag_z in MPRelaxSet(structure).incar.get("MAGMOM", None)]
+        magmom = [[0,0,mag_z] for mag_z in get_default_magmom(structure)]
 
     modify_incar_soc = {
         "incar_update": {
@@ -307,7 +352,7 @@ def cp_vasp_from_prev(original_wf, vasp_io, fw_name_constraint=None):
     return original_wf
 
 def add_modify_2d_nscf_kpoints(
-        original_wf, is_hse=False, modify_kpoints_params=None, fw_name_constraint=None
+        original_wf, is_hse=False, modify_kpoints_params=None, fw_name_constraint=None, n_chunks=1
 ):
     """
     Every FireWork that runs VASP has a ModifyKpoints task just beforehand. For
@@ -319,6 +364,8 @@ def add_modify_2d_nscf_kpoints(
         modify_kpoints_params (dict): dict of parameters for ModifyKpoints.
         fw_name_constraint (str): Only apply changes to FWs where fw_name
         contains this substring.
+        n_chunks (int): with is_hse, split the zero-weight k-points of each FW
+            into n_chunks parallel FWs, see fan_out_zero_weight_kpoints.
 
     Returns:
        Workflow
@@ -337,20 +384,83 @@ def add_modify_2d_nscf_kpoints(
             idx_t,
             Write2dNSCFKpoints(is_hse=is_hse, **modify_kpoints_params)
         )
+    if is_hse and n_chunks > 1:
+        original_wf = fan_out_zero_weight_kpoints(original_wf, n_chunks, fw_name_constraint=fw_name_constraint)
     return original_wf
 
+def fan_out_zero_weight_kpoints(original_wf, n_chunks, fw_name_constraint=None):
+    """
+    Replace every FireWork that runs an HSE band structure (explicit KPOINTS
+    with zero-weight k-points) by n_chunks copies, each running the weighted
+    mesh and one chunk of the zero-weight k-points, and a MergeBSChunksFW that
+    stitches their band structures into one task document (see
+    vasp.bs_chunks). The chunks take the place of the FireWork in the
+    workflow, the merge FW the one of its children.
+
+    Args:
+        original_wf (Workflow)
+        n_chunks (int): number of chunks per FireWork.
+        fw_name_constraint (str): Only apply changes to FWs where fw_name
+        contains this substring.
+
+    Returns:
+       Workflow: a new Workflow.
+    """
+    idx_list = get_fws_and_tasks(
+        original_wf,
+        fw_name_constraint=fw_name_constraint,
+        task_name_constraint="RunVasp",
+    )
+    fws = list(original_wf.fws)
+    links = {fw_id: list(children) for fw_id, children in original_wf.links.items()}
+    for idx_fw, idx_t in idx_list:
+        fw = original_wf.fws[idx_fw]
+        group = uuid.uuid4().hex
+        todb = [t for t in fw.tasks if "VaspToDb" in t._fw_name]
+        task_label = (todb[0].get("additional_fields") or {}).get("task_label", fw.name) if todb else fw.name
+        chunk_fws = []
+        for chunk in range(n_chunks):
+            tasks = copy.deepcopy(fw.tasks)
+            tasks.insert(idx_t, SplitZeroWeightKpoints(chunk=chunk, n_chunks=n_chunks))
+            for t in tasks:
+                if "VaspToDb" in t._fw_name:
+                    t["additional_fields"] = dict(t.get("additional_fields") or {}, kpoints_chunk={
+                        "group": group, "chunk": chunk, "n_chunks": n_chunks},
+                        task_label="{} chunk {}/{}".format(task_label, chunk + 1, n_chunks))
+                    t["bandstructure_mode"] = "line"
+            chunk_fws.append(Firework(tasks, spec=copy.deepcopy(fw.spec),
+                                      name="{} chunk {}/{}".format(fw.name, chunk + 1, n_chunks)))
+        merge_fw = MergeBSChunksFW(group, n_chunks, db_file=todb[0].get("db_file", DB_FILE) if todb else DB_FILE,
+                                   additional_fields={"task_label": task_label},
+                                   spec={k: v for k, v in fw.spec.items() if k in ("_fworker", "_category")})
+        # fw.name already carries the formula
+        merge_fw.name = "{} merge".format(fw.name)
+
+        chunk_ids = [f.fw_id for f in chunk_fws]
+        for parent, children in links.items():
+            if fw.fw_id in children:
+                links[parent] = [c for c in children if c != fw.fw_id] + chunk_ids
+        links[merge_fw.fw_id] = links.pop(fw.fw_id, [])
+        for fw_id in chunk_ids:
+            links[fw_id] = [merge_fw.fw_id]
+        fws[fws.index(fw)] = chunk_fws[0]
+        fws.extend(chunk_fws[1:] + [merge_fw])
+    return Workflow(fws, links_dict=links, name=original_wf.name, metadata=original_wf.metadata)
+
 def add_2d_nscf_kpoints_from_vaspkit(
-        original_wf, vaspkit_cmd=None, fw_name_constraint=None
+        original_wf, vaspkit_cmd=None, fw_name_constraint=None, use_vaspkit=False, divisions=20
 ):
     """
-    Using vaspkit to generate 2D kpoints for nscf calculation. Notice that HSE is not supported, because it needs
-    uniform kpoints.
+    Write the 2D k-path of vaspkit for nscf calculation. Notice that HSE is not supported, because it needs
+    uniform kpoints. Task 302 is generated in-process (vasp.kpath2d), so vaspkit is only needed for other tasks.
 
     Args:
         original_wf (Workflow)
-        vaspkit_cmd (str): vaspkit command. Eg. vaspkit -task 302
+        vaspkit_cmd (str): vaspkit task, e.g. "302" (the default when None).
         fw_name_constraint (str): Only apply changes to FWs where fw_name
         contains this substring.
+        use_vaspkit (bool): run vaspkit also for task 302.
+        divisions (int): k-points per segment of the in-process path.
 
     Returns:
        Workflow
@@ -365,7 +475,7 @@ def add_2d_nscf_kpoints_from_vaspkit(
     for idx_fw, idx_t in idx_list:
         original_wf.fws[idx_fw].tasks.insert(
             idx_t,
-            Write2dSCFKpointsFromVaspkit(vaspkit_cmd=vaspkit_cmd)
+            Write2dSCFKpointsFromVaspkit(vaspkit_cmd=vaspkit_cmd, use_vaspkit=use_vaspkit, divisions=divisions)
         )
     return original_wf
 
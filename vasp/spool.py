@@ -0,0 +1,525 @@
+"""
+Write-behind spool for documents headed to the database.
+
+Instead of connecting to the database at the end of every job, the *ToDb
+firetasks can drop their document into a spool directory (one gzipped JSON
+record per document, written atomically). A flusher later pushes the spool to
+the database in batches with JVaspCalcDb.insert_many, either in a background
+thread of the rocket process or from the command line:
+
+    python -m vasp.spool drain /path/to/spool --batch_size 100
+    python -m vasp.spool drain /path/to/spool --watch --interval 60
+
+The same record format is used offline, when no database is reachable from
+the compute nodes: VaspToDb(offline_format="json.gz") writes task.json.gz into
+the launch dir (or a spool_dir without db_file). Such records, and legacy
+task.json files, are bulk loaded later with a process pool:
+
+    python -m vasp.spool ingest -d db.json -n 8 /path/to/launch_dirs /path/to/spool
+
+"""
+
+import argparse
+import atexit
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+from multiprocessing import Pool
+
+from monty.json import MontyEncoder, MontyDecoder
+from monty.serialization import loadfn
+
+from atomate.utils.utils import get_logger
+
+from .database import get_calc_db
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+SPOOL_EXT = ".spool.json.gz"
+# records spooled before they got SPOOL_EXT: <time>_<host>_<uuid>.json.gz
+LEGACY_SPOOL_NAME = re.compile(r"^\d+\.\d+_.+_[0-9a-f]{32}\.json\.gz$")
+RECORD_KEYS = ("db_file", "collection_name", "use_gridfs", "insert_kwargs", "doc")
+INFLIGHT_EXT = ".inflight"
+INGESTED_EXT = ".ingested"
+OFFLINE_TASK_FILES = ("task.json.gz", "task.json")
+# datetime fields of a task document; a legacy task.json has them as
+# isoformat strings (DATETIME_HANDLER)
+DATETIME_FIELDS = ("last_updated", "created_at", "completed_at")
+
+
+def get_db_fields(db_file, collection_name=None):
+    """
+    The "db" and "collection" entries a task document gets on insertion, read
+    from the db_file without connecting to the database.
+    """
+    creds = loadfn(db_file)
+    return {"db": creds["database"], "collection": collection_name or creds["collection"]}
+
+
+def make_record(doc, db_file=None, collection_name=None, use_gridfs=False, insert_kwargs=None, task=None):
+    """
+    A spool record: the document plus what is needed to insert it later.
+    db_file may be None for offline records; it is given at ingest time.
+    task is the *ToDb task that wrote the document (a key of TASK_INDEXES),
+    whose indexes are ensured on insertion.
+    """
+    return {
+        "db_file": os.path.abspath(db_file) if db_file else None,
+        "collection_name": collection_name,
+        "use_gridfs": use_gridfs,
+        "insert_kwargs": insert_kwargs or {},
+        "task": task,
+        "doc": doc,
+    }
+
+
+def write_record(filename, record):
+    """
+    Write a record as gzipped JSON. json.dump encodes incrementally, so the
+    document is streamed into the compressor instead of being built as one
+    string. The file appears atomically under its final name.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    tmp = os.path.join(dirname, "." + basename + ".tmp")
+    with gzip.open(tmp, "wt", compresslevel=6) as f:
+        json.dump(record, f, cls=MontyEncoder)
+    os.replace(tmp, filename)
+
+
+def restore_datetimes(doc):
+    """
+    Turn the isoformat strings DATETIME_HANDLER wrote for the DATETIME_FIELDS
+    of doc back into datetimes, in place. Other strings, e.g. the
+    "YYYY-MM-DD HH:MM:SS" completed_at of VaspDrone, are left alone.
+    """
+    for field in DATETIME_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, str) and "T" in value:
+            try:
+                doc[field] = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                pass
+    return doc
+
+
+def is_record_name(name):
+    """
+    Whether a file name is one of a spool record or an offline task file, as
+    opposed to e.g. FW.json.gz or custodian.json.gz of a launch dir.
+    """
+    if name in OFFLINE_TASK_FILES:
+        return True
+    return not name.startswith(".") and (name.endswith(SPOOL_EXT) or bool(LEGACY_SPOOL_NAME.match(name)))
+
+
+def read_record(filename):
+    """
+    Read a spool record. A legacy task.json (plain task document) is wrapped
+    into a record with use_gridfs=True, which moves whatever DOS, band
+    structure, volumetric data or eigenvalues it holds to GridFS; its
+    datetimes are restored with restore_datetimes.
+
+    Raises:
+        ValueError: if the file does not hold a record (or a task document).
+    """
+    if filename.endswith(".gz") or filename.endswith(INFLIGHT_EXT):
+        with gzip.open(filename, "rt") as f:
+            record = json.load(f, cls=MontyDecoder)
+        if not isinstance(record, dict) or any(k not in record for k in RECORD_KEYS) \
+                or not isinstance(record["doc"], dict):
+            raise ValueError("{} is not a spool record".format(filename))
+        return record
+    with open(filename) as f:
+        doc = json.load(f, cls=MontyDecoder)
+    if not isinstance(doc, dict):
+        raise ValueError("{} is not a task document".format(filename))
+    return make_record(restore_datetimes(doc), use_gridfs=True, task="VaspToDb")
+
+
+def insert_records(records, db_file=None):
+    """
+    Insert records grouped by target with JVaspCalcDb.insert_many.
+
+    Args:
+        records ([(key, dict)]): records with an arbitrary key each.
+        db_file (str): used for records without their own db_file and
+            overrides nothing else.
+
+    Returns:
+        ([key], [key]): keys of inserted and of failed records.
+    """
+    groups = defaultdict(list)
+    for key, record in records:
+        # records written before they named their task all came from VaspToDb
+        target = (record["db_file"] or db_file, record["collection_name"], record["use_gridfs"],
+                  json.dumps(record["insert_kwargs"], sort_keys=True), record.get("task") or "VaspToDb")
+        groups[target].append((key, record["doc"]))
+
+    inserted, failed = [], []
+    for (target_db_file, collection_name, use_gridfs, insert_kwargs, task), items in groups.items():
+        keys = [key for key, _ in items]
+        try:
+            if not target_db_file:
+                raise ValueError("no db_file for offline records")
+            mmdb = get_calc_db(target_db_file, admin=True)
+            if collection_name:
+                mmdb.collection = mmdb.db[collection_name]
+            mmdb.ensure_indexes(task)
+            docs = [doc for _, doc in items]
+            for doc in docs:
+                doc.update({"db": mmdb.db_name, "collection": mmdb.collection.name})
+            mmdb.insert_many(docs, use_gridfs=use_gridfs, **json.loads(insert_kwargs))
+        except Exception as err:
+            logger.warning("Inserting {} documents into {} failed: {}".format(len(items), target_db_file, err))
+            failed.extend(keys)
+            continue
+        inserted.extend(keys)
+    return inserted, failed
+
+
+class TaskSpool:
+    """
+    Directory of pending documents.
+
+    Every record holds the document plus what is needed to insert it later:
+    db_file, collection_name (None -> collection of the db_file), use_gridfs,
+    insert_kwargs for JVaspCalcDb.insert_many and the *ToDb task whose
+    indexes the collection needs. Records are claimed by
+    renaming them, so several flushers can share one spool directory.
+
+    Args:
+        spool_dir (str): spool directory, created if needed.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = os.path.abspath(os.path.expanduser(spool_dir))
+        os.makedirs(os.path.join(self.spool_dir, "failed"), exist_ok=True)
+
+    def put(self, doc, db_file=None, collection_name=None, use_gridfs=False, insert_kwargs=None, task=None):
+        """
+        Add a document to the spool.
+
+        Returns:
+            str: path of the spool record.
+        """
+        name = "{:.6f}_{}_{}".format(time.time(), socket.gethostname(), uuid.uuid4().hex)
+        path = os.path.join(self.spool_dir, name + SPOOL_EXT)
+        write_record(path, make_record(doc, db_file, collection_name, use_gridfs, insert_kwargs, task))
+        return path
+
+    def pending(self):
+        return sorted(os.path.join(self.spool_dir, f) for f in os.listdir(self.spool_dir)
+                      if f.endswith(SPOOL_EXT) or LEGACY_SPOOL_NAME.match(f))
+
+    def claim(self, limit=None):
+        """
+        Claim up to limit pending records for this process.
+
+        Returns:
+            [str]: paths of the claimed records.
+        """
+        claimed = []
+        for path in self.pending():
+            if limit and len(claimed) >= limit:
+                break
+            inflight = path + INFLIGHT_EXT
+            try:
+                os.rename(path, inflight)
+            except FileNotFoundError:  # claimed by another flusher
+                continue
+            # requeue_stale measures the age of a claim from the mtime, which
+            # the rename keeps
+            os.utime(inflight)
+            claimed.append(inflight)
+        return claimed
+
+    def requeue_stale(self, max_age=3600):
+        """
+        Put records back that were claimed by a flusher that died.
+        """
+        for path in glob.glob(os.path.join(self.spool_dir, "*.json.gz" + INFLIGHT_EXT)):
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.rename(path, path[:-len(INFLIGHT_EXT)])
+
+    @staticmethod
+    def load(path):
+        return read_record(path)
+
+    @staticmethod
+    def done(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            logger.warning("{} was requeued while claimed".format(path))
+
+    def release(self, path):
+        try:
+            os.rename(path, path[:-len(INFLIGHT_EXT)])
+        except FileNotFoundError:
+            logger.warning("{} was requeued while claimed".format(path))
+
+    def fail(self, path):
+        shutil.move(path, os.path.join(self.spool_dir, "failed", os.path.basename(path)[:-len(INFLIGHT_EXT)]))
+
+
+class SpoolFlusher:
+    """
+    Pushes a TaskSpool to the database in batches.
+
+    Args:
+        spool (TaskSpool): spool to drain.
+        batch_size (int): maximum number of documents per bulk insert.
+        flush_interval (float): seconds between flushes of the background
+            thread.
+        db_file (str): database for records spooled without a db_file.
+    """
+
+    _running = {}
+    _lock = threading.Lock()
+
+    def __init__(self, spool, batch_size=100, flush_interval=30, db_file=None):
+        self.spool = spool
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        """
+        Flush one batch.
+
+        Returns:
+            int: number of documents inserted.
+        """
+        paths = self.spool.claim(self.batch_size)
+        records = []
+        for path in paths:
+            try:
+                records.append((path, self.spool.load(path)))
+            except Exception as err:
+                logger.warning("Cannot read spool record {}: {}".format(path, err))
+                self.spool.fail(path)
+
+        inserted, failed = insert_records(records, db_file=self.db_file)
+        for path in inserted:
+            self.spool.done(path)
+        for path in failed:  # retried by the next flush
+            self.spool.release(path)
+        return len(inserted)
+
+    def drain(self):
+        """
+        Flush until the spool is empty.
+
+        Returns:
+            int: number of documents inserted.
+        """
+        total = 0
+        while self.spool.pending():
+            n = self.flush()
+            if not n:
+                break
+            total += n
+        return total
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.drain()
+            except Exception as err:
+                logger.warning("Spool flush failed: {}".format(err))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="spool-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, drain=True):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if drain:
+            try:
+                self.drain()
+            except Exception as err:
+                logger.warning("Final spool flush failed, documents stay in {}: {}".format(
+                    self.spool.spool_dir, err))
+
+    @classmethod
+    def ensure_running(cls, spool_dir, **kwargs):
+        """
+        Start one background flusher per spool directory and process.
+        """
+        spool_dir = os.path.abspath(os.path.expanduser(spool_dir))
+        with cls._lock:
+            if spool_dir not in cls._running:
+                flusher = cls(TaskSpool(spool_dir), **kwargs)
+                flusher.start()
+                cls._running[spool_dir] = flusher
+            return cls._running[spool_dir]
+
+
+def spool_or_insert(doc, db_file, spool_dir=None, write_behind=None, collection_name=None,
+                    use_gridfs=None, insert_kwargs=None, task=None):
+    """
+    Spool doc if spool_dir is set; the caller inserts it otherwise.
+
+    Args:
+        db_file (str): target database. May be None to spool offline; the
+            database is then given when draining/ingesting.
+        write_behind (dict): optional flusher settings ("background",
+            "batch_size", "flush_interval"). With background=True a flusher
+            thread of this process pushes the spool. "reserve_task_id" is
+            read by the *ToDb tasks, see VaspToDb.
+        task (str): the calling *ToDb task, see make_record.
+
+    Returns:
+        bool: whether the document was spooled.
+    """
+    if not spool_dir:
+        return False
+    write_behind = write_behind or {}
+    if db_file:
+        doc.update(get_db_fields(db_file, collection_name))
+    path = TaskSpool(spool_dir).put(doc, db_file, collection_name=collection_name, use_gridfs=use_gridfs,
+                                    insert_kwargs=insert_kwargs, task=task)
+    logger.info("Spooled document to {}".format(path))
+    if db_file and write_behind.get("background"):
+        SpoolFlusher.ensure_running(spool_dir, batch_size=write_behind.get("batch_size", 100),
+                                    flush_interval=write_behind.get("flush_interval", 30))
+    return True
+
+
+def reserve_spooled_task_id(doc, db_file, collection_name=None, write_behind=None, task_fields_to_push=None):
+    """
+    Give a document spooled with db_file its task_id now, if it is needed up
+    front: with write_behind {"reserve_task_id": True} or when
+    task_fields_to_push refers to task_id. Otherwise the task_id is assigned
+    when the spool is flushed and the job does not connect to the database.
+
+    Returns:
+        int: the task_id, or None if it is left to the flush.
+    """
+    if not ((write_behind or {}).get("reserve_task_id") or "task_id" in (task_fields_to_push or {}).values()):
+        return None
+    mmdb = get_calc_db(db_file, admin=True)
+    if collection_name:
+        mmdb.collection = mmdb.db[collection_name]
+    return mmdb.assign_task_id(doc)
+
+
+def find_records(paths):
+    """
+    Spool records and offline task files below paths, skipping the ones that
+    were already ingested.
+    """
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d != "failed"]
+            for f in files:
+                if is_record_name(f):
+                    if f == "task.json" and "task.json.gz" in files:
+                        continue
+                    found.append(os.path.join(root, f))
+    return sorted(found)
+
+
+def _ingest_batch(args):
+    db_file, paths = args
+    records, unreadable = [], []
+    for path in paths:
+        try:
+            records.append((path, read_record(path)))
+        except Exception as err:
+            logger.warning("Cannot read {}: {}".format(path, err))
+            unreadable.append(path)
+    inserted, failed = insert_records(records, db_file=db_file)
+    for path in inserted:
+        os.rename(path, path + INGESTED_EXT)
+    return len(inserted), failed + unreadable
+
+
+def ingest(paths, db_file, nproc=4, batch_size=100):
+    """
+    Bulk load spool records and offline task files into the database. Every
+    worker process inserts whole batches with its own connection. Ingested
+    files are renamed to *.ingested so that a second run skips them.
+
+    Args:
+        paths ([str]): files, spool dirs or trees of launch dirs.
+        db_file (str): target database for records without a db_file.
+        nproc (int): number of worker processes.
+        batch_size (int): documents per bulk insert.
+
+    Returns:
+        (int, [str]): number of documents inserted and files that failed.
+    """
+    files = find_records(paths)
+    logger.info("Ingesting {} documents".format(len(files)))
+    batches = [(db_file, files[i:i + batch_size]) for i in range(0, len(files), batch_size)]
+    total, failed = 0, []
+    with Pool(nproc) as pool:
+        for n, f in pool.imap_unordered(_ingest_batch, batches):
+            total += n
+            failed.extend(f)
+            logger.info("{}/{} documents ingested".format(total, len(files)))
+    return total, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command")
+    drain = sub.add_parser("drain", help="push spooled documents to the database")
+    drain.add_argument("spool_dir")
+    drain.add_argument("-d", "--db_file", default=None, help="database for records spooled without one")
+    drain.add_argument("-b", "--batch_size", type=int, default=100)
+    drain.add_argument("-w", "--watch", action="store_true", help="keep draining every --interval seconds")
+    drain.add_argument("-i", "--interval", type=float, default=30)
+    drain.add_argument("--stale", type=float, default=3600,
+                       help="requeue records claimed longer than this many seconds ago")
+    ingest_parser = sub.add_parser("ingest", help="bulk load offline task files and spool records")
+    ingest_parser.add_argument("paths", nargs="+")
+    ingest_parser.add_argument("-d", "--db_file", required=True)
+    ingest_parser.add_argument("-n", "--nproc", type=int, default=4)
+    ingest_parser.add_argument("-b", "--batch_size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == "drain":
+        spool = TaskSpool(args.spool_dir)
+        flusher = SpoolFlusher(spool, batch_size=args.batch_size, flush_interval=args.interval,
+                               db_file=args.db_file)
+        while True:
+            spool.requeue_stale(args.stale)
+            n = flusher.drain()
+            logger.info("Inserted {} documents, {} pending".format(n, len(spool.pending())))
+            if not args.watch:
+                break
+            time.sleep(args.interval)
+    elif args.command == "ingest":
+        n, failed = ingest(args.paths, args.db_file, nproc=args.nproc, batch_size=args.batch_size)
+        logger.info("Inserted {} documents, {} failed".format(n, len(failed)))
+        for f in failed:
+            print(f)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Staging of prior-run artifacts into a new launch directory.
+
+CopyVaspOutputs copies WAVECAR, CHGCAR, WAVEDER, ... byte by byte, although
+source and destination usually sit on the same scratch filesystem. stage_file
+puts the file in place with the cheapest safe method instead:
+
+    "reflink"   copy-on-write clone (btrfs, XFS, ...): instantaneous, no extra
+                disk usage, and the run may rewrite the file freely.
+    "hardlink"  same inode, no extra disk usage. Only for files the run does
+                not rewrite: VASP writes WAVECAR/CHGCAR in place, which would
+                change the parent run's copy too.
+    "symlink"   like hardlink, but also works when hardlinks are not allowed
+                (other owner with fs.protected_hardlinks). Breaks when the
+                parent directory is removed.
+
+Links are only made within one filesystem. When they are impossible, the file
+is reflinked, and when that is impossible too (across filesystems, or on
+Lustre/GPFS), copied.
+
+stage_artifact first resolves the single best available form of an artifact
+(WAVECAR or WAVECAR.gz, whichever is newer) and streams compressed forms
+through pigz/zstd/lbzip2 straight into the destination, without an
+intermediate copy of the archive. unread_artifacts tells from the INCAR of
+the new run which of WAVECAR and CHGCAR VASP will not read at all.
+"""
+
+import bz2
+import errno
+import gzip
+import os
+import shutil
+import subprocess
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+STAGE_MODES = ("copy", "reflink", "hardlink", "symlink")
+# extension: (decompressors in order of preference, python fallback)
+COMPRESSED_FORMS = {
+    ".gz": ([["pigz", "-dc"], ["gzip", "-dc"]], gzip.open),
+    ".GZ": ([["pigz", "-dc"], ["gzip", "-dc"]], gzip.open),
+    ".bz2": ([["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]], bz2.open),
+    ".zst": ([["zstd", "-dcq"]], None),
+}
+# linux/fs.h
+_FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    """
+    Clone src to dest with the FICLONE ioctl.
+
+    Returns:
+        bool: whether the filesystem made the clone. dest does not exist
+        otherwise.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as fin, open(dest, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+    except OSError:
+        if os.path.lexists(dest):
+            os.remove(dest)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def _same_filesystem(src, dest):
+    return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dest))).st_dev
+
+
+def stage_file(src, dest, mode="copy", readonly=False):
+    """
+    Put src at dest, replacing dest.
+
+    Args:
+        src (str): file of the previous run.
+        dest (str): path in the new launch directory.
+        mode (str): one of STAGE_MODES, the cheapest method to try.
+        readonly (bool): the run will only read dest. Without it, "hardlink"
+            and "symlink" are reduced to "reflink".
+
+    Returns:
+        str: the method that was used.
+    """
+    if mode not in STAGE_MODES:
+        raise ValueError("Unknown stage mode {}, use one of {}".format(mode, STAGE_MODES))
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if readonly and mode in ("hardlink", "symlink") and _same_filesystem(src, dest):
+        try:
+            if mode == "hardlink":
+                os.link(src, dest)
+            else:
+                os.symlink(os.path.abspath(src), dest)
+            return mode
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EACCES, errno.EXDEV, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if mode != "copy" and reflink(src, dest):
+        return "reflink"
+    shutil.copy2(src, dest)
+    return "copy"
+
+
+def resolve_artifact(directory, name, listing=None):
+    """
+    The single best available form of an artifact: name itself or name with
+    one of the extensions of COMPRESSED_FORMS. When several exist (e.g. a
+    rerun left both WAVECAR and WAVECAR.gz), the newest one wins, and the
+    uncompressed one on ties.
+
+    Args:
+        directory (str): directory of the previous run.
+        name (str): file name, e.g. "WAVECAR" or "CHGCAR.relax2".
+        listing ([str]): file names of directory, if already known.
+
+    Returns:
+        str: file name in directory, or None if there is no form of name.
+    """
+    listing = os.listdir(directory) if listing is None else listing
+    forms = [f for f in [name] + [name + ext for ext in COMPRESSED_FORMS] if f in listing]
+    if not forms:
+        return None
+    return max(forms, key=lambda f: (os.stat(os.path.join(directory, f)).st_mtime, f == name))
+
+
+def decompress_file(src, dest):
+    """
+    Stream the compressed file src into dest with the first available
+    decompressor of COMPRESSED_FORMS (pigz, lbzip2, ... decompress in
+    separate threads from reading and writing), or with python's gzip/bz2.
+
+    Returns:
+        str: the decompressor used.
+    """
+    ext = os.path.splitext(src)[1]
+    commands, opener = COMPRESSED_FORMS[ext]
+    for cmd in commands:
+        if not shutil.which(cmd[0]):
+            continue
+        try:
+            with open(dest, "wb") as fout:
+                subprocess.run(cmd + [src], stdout=fout, stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError:
+            os.remove(dest)
+            raise
+        return cmd[0]
+    if opener is None:
+        raise RuntimeError("No decompressor for {} found, install {}".format(src, commands[0][0]))
+    with opener(src, "rb") as fin, open(dest, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    return "python"
+
+
+def stage_artifact(directory, name, dest, mode="copy", readonly=False, listing=None):
+    """
+    Stage the best form of name (see resolve_artifact) at dest: uncompressed
+    ones with stage_file, compressed ones with decompress_file.
+
+    Returns:
+        str: the method used (see stage_file), "decompress:<tool>", or None
+        if there is no form of name.
+    """
+    found = resolve_artifact(directory, name, listing)
+    if found is None:
+        return None
+    src = os.path.join(directory, found)
+    if found == name:
+        return stage_file(src, dest, mode, readonly=readonly)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    return "decompress:" + decompress_file(src, dest)
+
+
+def unread_artifacts(incar):
+    """
+    Artifacts of a previous run that VASP will not read with this INCAR:
+    WAVECAR with ISTART=0, and CHGCAR unless ICHARG is 1 or 11 (ICHARG%10
+    == 1).
+
+    Args:
+        incar (dict): INCAR of the new run, e.g. pymatgen's Incar.
+
+    Returns:
+        set: file names.
+    """
+    unread = set()
+    if int(incar.get("ISTART", 1)) == 0:
+        unread.add("WAVECAR")
+    if int(incar.get("ICHARG", 0)) % 10 != 1:
+        unread.add("CHGCAR")
+    return unread
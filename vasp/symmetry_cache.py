@@ -0,0 +1,209 @@
+"""
+Cache of symmetry-derived k-point data (irreducible meshes, high-symmetry
+paths), keyed by a canonical fingerprint of the structure and the symmetry
+settings.
+
+The same structures recur across the PBE/HSE/SOC NSCF steps and the charge
+states of one defect, and every firework used to rerun spglib and
+HighSymmKpath on them. Results are kept in an in-process LRU (shared by the
+fireworks of one rocket) and optionally in a directory of JSON files on a
+shared filesystem and/or a MongoDB collection, so a repeated k-point
+generation is a lookup:
+
+    cache = get_symmetry_cache(cache_dir="/scratch/symmetry_cache")
+    kpts, weights = cache.ir_mesh(structure, (12, 12, 1), symprec=0.1)
+    kpts, labels = cache.kpath(structure, line_density=20)
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from pymatgen.symmetry.bandstructure import HighSymmKpath
+
+from atomate.utils.utils import get_logger
+
+from . import kpath2d
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+# decimals of lattice vectors (A) and fractional coordinates in the fingerprint
+FINGERPRINT_DECIMALS = 4
+
+
+def structure_fingerprint(structure, decimals=FINGERPRINT_DECIMALS):
+    """
+    sha1 of the lattice and of the sorted (species, wrapped fractional
+    coordinates, magmom) of the sites, rounded to decimals. Independent of
+    site order and numerical noise, but not of the cell setting, which the
+    cached k-points depend on.
+
+    Returns:
+        str
+    """
+    sites = []
+    for site in structure:
+        frac = [round(round(x % 1.0, decimals) % 1.0, decimals) for x in site.frac_coords]
+        magmom = site.properties.get("magmom")
+        sites.append([site.species_string, frac, None if magmom is None else str(magmom)])
+    data = {"lattice": [[round(x, decimals) for x in v] for v in structure.lattice.matrix],
+            "sites": sorted(sites, key=lambda s: (s[0], s[1], s[2] or ""))}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class SymmetryCache:
+    """
+    Args:
+        maxsize (int): entries of the in-process LRU.
+        cache_dir (str): directory of the on-disk store, created if needed.
+        db_file (str): database whose "collection" gets the DB store.
+        collection (str): collection name of the DB store.
+    """
+
+    def __init__(self, maxsize=256, cache_dir=None, db_file=None, collection="symmetry_cache"):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.db_file = db_file
+        self.collection = collection
+        self.stats = {"hits": 0, "disk_hits": 0, "db_hits": 0, "misses": 0}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._coll = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _db(self):
+        if self._coll is None:
+            from .database import get_calc_db
+            self._coll = get_calc_db(self.db_file, admin=True).db[self.collection]
+        return self._coll
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json.gz")
+
+    def _load(self, key):
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._lru[key]
+        value = None
+        if self.cache_dir and os.path.exists(self._path(key)):
+            try:
+                with gzip.open(self._path(key), "rt") as f:
+                    value = json.load(f)
+                self.stats["disk_hits"] += 1
+            except (OSError, ValueError):
+                value = None
+        if value is None and self.db_file:
+            doc = self._db().find_one({"_id": key})
+            if doc:
+                value = doc["value"]
+                self.stats["db_hits"] += 1
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._lru[key] = value
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def _store(self, key, value):
+        self._remember(key, value)
+        if self.cache_dir:
+            tmp = "{}.{}.tmp".format(self._path(key), os.getpid())
+            with gzip.open(tmp, "wt") as f:
+                json.dump(value, f)
+            os.replace(tmp, self._path(key))
+        if self.db_file:
+            self._db().replace_one({"_id": key}, {"_id": key, "value": value}, upsert=True)
+
+    def get(self, kind, structure, params, compute):
+        """
+        The cached value of compute() for (kind, structure, params).
+
+        Args:
+            kind (str): name of the computation.
+            structure (Structure)
+            params (dict): JSON-able settings the result depends on.
+            compute (callable): returns the JSON-able value on a miss.
+        """
+        key = hashlib.sha1(json.dumps([kind, structure_fingerprint(structure), params],
+                                      sort_keys=True).encode()).hexdigest()
+        value = self._load(key)
+        if value is None:
+            self.stats["misses"] += 1
+            value = compute()
+            self._store(key, value)
+        return value
+
+    def ir_mesh(self, structure, mesh, symprec=0.1, is_shift=(0, 0, 0)):
+        """
+        SpacegroupAnalyzer.get_ir_reciprocal_mesh.
+
+        Returns:
+            ([[float]], [int]): irreducible k-points (fractional) and weights.
+        """
+        def compute():
+            ir = SpacegroupAnalyzer(structure, symprec=symprec).get_ir_reciprocal_mesh(mesh, is_shift=is_shift)
+            return {"kpts": [[float(x) for x in k] for k, _ in ir], "weights": [int(w) for _, w in ir]}
+
+        value = self.get("ir_mesh", structure, {"mesh": [int(m) for m in mesh], "symprec": symprec,
+                                                "is_shift": list(is_shift)}, compute)
+        return value["kpts"], value["weights"]
+
+    def kpath(self, structure, line_density=20, symprec=0.01, angle_tolerance=5):
+        """
+        HighSymmKpath(structure).get_kpoints in fractional coordinates.
+
+        Returns:
+            ([[float]], [str]): k-points along the path and their labels ("" off
+            the high-symmetry points).
+        """
+        def compute():
+            kpath = HighSymmKpath(structure, symprec=symprec, angle_tolerance=angle_tolerance)
+            kpts, labels = kpath.get_kpoints(line_density=line_density, coords_are_cartesian=False)
+            return {"kpts": [[float(x) for x in k] for k in kpts], "labels": list(labels)}
+
+        value = self.get("kpath", structure, {"line_density": line_density, "symprec": symprec,
+                                              "angle_tolerance": angle_tolerance}, compute)
+        return value["kpts"], value["labels"]
+
+    def kpath_2d(self, structure, line_density=20):
+        """
+        vasp.kpath2d.kpath_2d.
+
+        Returns:
+            ([[float]], [str]): k-points along the in-plane path and their
+            labels.
+        """
+        def compute():
+            kpts, labels = kpath2d.kpath_2d(structure, line_density=line_density)
+            return {"kpts": kpts.tolist(), "labels": labels}
+
+        value = self.get("kpath_2d", structure, {"line_density": line_density}, compute)
+        return value["kpts"], value["labels"]
+
+
+_caches = {}
+
+
+def get_symmetry_cache(cache_dir=None, db_file=None):
+    """
+    The process-wide SymmetryCache with these stores, so that the fireworks of
+    a rocket share its LRU.
+    """
+    key = (cache_dir, db_file)
+    if key not in _caches:
+        _caches[key] = SymmetryCache(cache_dir=cache_dir, db_file=db_file)
+    return _caches[key]
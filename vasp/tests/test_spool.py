@@ -0,0 +1,87 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from vasp.spool import TaskSpool, find_records, read_record, write_record, make_record, _ingest_batch, \
+    INGESTED_EXT
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+
+def write_gz(path, obj):
+    with gzip.open(path, "wt") as f:
+        json.dump(obj, f)
+
+
+class TestFindRecords(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.launch_dir = os.path.join(self.root, "launcher_2021")
+        os.makedirs(self.launch_dir)
+        # gzipped atomate launch dir: none of these is a record
+        write_gz(os.path.join(self.launch_dir, "FW.json.gz"), {"spec": {}, "fw_id": 1})
+        write_gz(os.path.join(self.launch_dir, "custodian.json.gz"), [{"job": {}, "corrections": []}])
+        write_gz(os.path.join(self.launch_dir, "transformations.json.gz"), {"history": []})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_skips_non_record_gz(self):
+        self.assertEqual(find_records([self.root]), [])
+
+    def test_finds_task_files_and_spool_records(self):
+        write_record(os.path.join(self.launch_dir, "task.json.gz"), make_record({"dir_name": "a"}))
+        path = TaskSpool(os.path.join(self.root, "spool")).put({"dir_name": "b"})
+        legacy = os.path.join(self.root, "spool", "1612345678.123456_node1_{}.json.gz".format("0" * 32))
+        write_record(legacy, make_record({"dir_name": "c"}))
+        self.assertEqual(find_records([self.root]),
+                         sorted([os.path.join(self.launch_dir, "task.json.gz"), path, legacy]))
+
+    def test_read_record_rejects_non_records(self):
+        for f in ("FW.json.gz", "custodian.json.gz"):
+            with self.assertRaises(ValueError):
+                read_record(os.path.join(self.launch_dir, f))
+
+    def test_ingest_batch_reports_non_records_as_failed(self):
+        paths = [os.path.join(self.launch_dir, f) for f in ("FW.json.gz", "custodian.json.gz")]
+        n, failed = _ingest_batch((None, paths))
+        self.assertEqual(n, 0)
+        self.assertEqual(sorted(failed), sorted(paths))
+        self.assertFalse(any(os.path.exists(p + INGESTED_EXT) for p in paths))
+
+
+class TestTaskSpool(unittest.TestCase):
+    def setUp(self):
+        self.spool = TaskSpool(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.spool.spool_dir)
+
+    def test_old_record_is_not_stale_once_claimed(self):
+        path = self.spool.put({"dir_name": "a"})
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+        inflight, = self.spool.claim()
+        self.spool.requeue_stale(3600)
+        self.assertEqual(self.spool.pending(), [])
+        self.spool.done(inflight)
+        self.assertEqual(os.listdir(self.spool.spool_dir), ["failed"])
+
+    def test_done_and_release_tolerate_requeued_records(self):
+        self.spool.put({"dir_name": "a"})
+        self.spool.put({"dir_name": "b"})
+        first, second = self.spool.claim()
+        os.rename(first, first[:-len(".inflight")])
+        os.rename(second, second[:-len(".inflight")])
+        self.spool.done(first)
+        self.spool.release(second)
+        self.assertEqual(len(self.spool.pending()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,780 @@
+"""
+Remote file transfer over SFTP, used by FileTransferTask in rtransfer mode.
+
+Files are sent by a pool of worker threads, each with its own SFTP channel.
+The workers share a configurable number of SSH sessions, so many small files
+do not wait behind one another and large files can use more than one TCP
+stream through the tunnel. Files are sent largest first, which keeps the
+workers busy until the end instead of finishing on one big WAVECAR.
+
+With sync, files the remote side already has are skipped: "mtime" compares
+size and modification time with a directory listing of the destination,
+"checksum" compares sha256 sums (computed remotely with sha256sum). Files are
+written to <name>.part and renamed when complete, with the local mtime, so an
+interrupted transfer leaves no truncated files and the next sync resumes the
+.part file where it stopped.
+
+put_archive sends a whole set of files as one tar stream, compressed on the
+fly (pigz/gzip or zstd) and unpacked by tar on the remote side. Nothing is
+written to disk on either side, and the text outputs of VASP (vasprun.xml,
+OUTCAR, PROCAR, DOSCAR) shrink 5-10x on the way.
+
+SSH sessions can be borrowed from a process-wide ConnectionPool, so the
+fireworks of a rapidfire rocket share their handshakes with the workstation
+instead of doing a full key exchange per firework. Idle sessions are checked
+before reuse and replaced when the tunnel dropped them. ssh_multiplex_options
+gives the same for the scp/rsync/ssh subprocesses through OpenSSH's
+ControlMaster.
+"""
+
+import atexit
+import errno
+import hashlib
+import json
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from fnmatch import fnmatch
+from glob import glob
+
+from atomate.utils.utils import get_logger
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+PART_EXT = ".part"
+SYNC_MODES = (None, "mtime", "checksum")
+_CHUNK = 1 << 20
+
+# local state that never goes to the workstation: parse caches that older
+# JVaspDrones kept in the launch dir
+TRANSFER_EXCLUDES = (".parse_cache",)
+# compressor: (local compress command, remote decompress command)
+ARCHIVE_COMPRESSORS = {
+    None: (None, None),
+    "gzip": (["pigz", "-1"] if shutil.which("pigz") else ["gzip", "-1"], "gzip -dc"),
+    "zstd": (["zstd", "-1", "-T0", "-q"], "zstd -dcq"),
+}
+
+
+def connect(server, port, user=None, key_filename=None):
+    """
+    Open an SSH session with the system host keys.
+
+    Returns:
+        paramiko.SSHClient
+    """
+    import paramiko
+    ssh = paramiko.SSHClient()
+    ssh.load_system_host_keys()
+    ssh.connect(server, username=user, port=port,
+                key_filename=key_filename or os.path.expanduser(os.path.join("~", ".ssh", "id_rsa")))
+    return ssh
+
+
+class ConnectionPool:
+    """
+    Idle SSH sessions keyed by (server, port, user, key_filename).
+
+    acquire returns an idle session after a health check (active transport
+    and a successful SSH_MSG_IGNORE) or opens a new one; release hands it
+    back for the next user. At most max_idle sessions are kept per key. The
+    pool is emptied in forked children, since a paramiko transport belongs to
+    the process that opened it.
+
+    Args:
+        max_idle (int): idle sessions kept per key.
+        keepalive (int): seconds between keepalive packets of idle sessions,
+            so that the tunnel does not drop them between fireworks.
+    """
+
+    def __init__(self, max_idle=4, keepalive=30):
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self._idle = defaultdict(list)
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self, server, port, user=None, key_filename=None):
+        key = (server, int(port), user, key_filename)
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._idle.clear()
+                self._keys.clear()
+                self._pid = os.getpid()
+            while self._idle[key]:
+                ssh = self._idle[key].pop()
+                if self._healthy(ssh):
+                    return ssh
+                logger.info("Dropping stale SSH session to {}:{}".format(server, port))
+                self._keys.pop(id(ssh), None)
+                ssh.close()
+        ssh = connect(server, port, user, key_filename)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        with self._lock:
+            self._keys[id(ssh)] = key
+        return ssh
+
+    def release(self, ssh):
+        with self._lock:
+            key = self._keys.get(id(ssh))
+            if key is not None and os.getpid() == self._pid and len(self._idle[key]) < self.max_idle:
+                self._idle[key].append(ssh)
+                return
+            self._keys.pop(id(ssh), None)
+        ssh.close()
+
+    def close(self):
+        with self._lock:
+            for sessions in self._idle.values():
+                for ssh in sessions:
+                    ssh.close()
+            self._idle.clear()
+            self._keys.clear()
+
+    @staticmethod
+    def _healthy(ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close)
+
+
+def ssh_multiplex_options(persist="10m"):
+    """
+    OpenSSH options that share one master connection per user@host:port
+    between ssh/scp/rsync processes. The master stays up for persist after
+    the last process exits.
+    """
+    control_dir = os.path.expanduser(os.path.join("~", ".ssh", "controlmasters"))
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    return ["-o", "ControlMaster=auto", "-o", "ControlPath={}/%r@%h:%p".format(control_dir),
+            "-o", "ControlPersist={}".format(persist)]
+
+
+def parse_size(size):
+    """
+    Bytes of a size given as int or str with a K/M/G/T suffix, e.g. "500M".
+    """
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = size.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+# wavefunction-like outputs that local analysis (vasprun.xml, OUTCAR) never needs
+LARGE_ARTIFACTS = ["WAVECAR*", "WAVEDER*", "WFULL*", "W????.tmp"]
+
+
+class TransferPolicy:
+    """
+    Which files of a launch dir are transferred, and how.
+
+    Args:
+        include ([str]): glob patterns of the file names to send. Default:
+            all files.
+        exclude ([str]): glob patterns of file names never sent, e.g.
+            LARGE_ARTIFACTS. Wins over include.
+        max_size (int or str): larger files are not sent at all.
+        compress_above (int or str): larger files are sent as a compressed
+            stream (see put_archive) and unpacked on the remote side.
+        defer_above (int or str): larger files are left to the background
+            uploader (vasp.uploader), so they do not hold the allocation.
+        compressor (str): "gzip" or "zstd" for compress_above.
+
+    Sizes are bytes or strings like "500M" or "2G". A policy is stored in
+    firetasks as its as_dict().
+    """
+
+    def __init__(self, include=None, exclude=None, max_size=None, compress_above=None, defer_above=None,
+                 compressor="gzip"):
+        self.include = list(include) if include else None
+        self.exclude = list(exclude or [])
+        self.max_size = parse_size(max_size)
+        self.compress_above = parse_size(compress_above)
+        self.defer_above = parse_size(defer_above)
+        self.compressor = compressor
+
+    def as_dict(self):
+        return {"include": self.include, "exclude": self.exclude, "max_size": self.max_size,
+                "compress_above": self.compress_above, "defer_above": self.defer_above,
+                "compressor": self.compressor}
+
+    @classmethod
+    def from_dict(cls, d):
+        return d if isinstance(d, cls) else cls(**d)
+
+    def wanted(self, name):
+        if self.include is not None and not any(fnmatch(name, p) for p in self.include):
+            return False
+        return not any(fnmatch(name, p) for p in self.exclude)
+
+    def select(self, jobs):
+        """
+        Split (local, remote) pairs by how they are transferred.
+
+        Returns:
+            dict: "now", "compress", "defer" and "excluded" lists of pairs.
+        """
+        parts = {"now": [], "compress": [], "defer": [], "excluded": []}
+        for local, remote in jobs:
+            size = os.path.getsize(local)
+            if not self.wanted(os.path.basename(local)) or (self.max_size is not None and size > self.max_size):
+                parts["excluded"].append((local, remote))
+            elif self.defer_above is not None and size > self.defer_above:
+                parts["defer"].append((local, remote))
+            elif self.compress_above is not None and size > self.compress_above:
+                parts["compress"].append((local, remote))
+            else:
+                parts["now"].append((local, remote))
+        return parts
+
+    def rsync_args(self, deferred=False):
+        """
+        rsync filter options for the policy. rsync cannot compress by size,
+        so any compress_above turns on -z for all files. With deferred, the
+        options select only the files left to the background uploader.
+        """
+        args = []
+        for pattern in self.exclude:
+            args.append("--exclude={}".format(pattern))
+        if self.include is not None:
+            args += ["--include={}".format(p) for p in self.include] + ["--include=*/", "--exclude=*"]
+        max_size = self.max_size
+        if self.defer_above is not None:
+            if deferred:
+                args.append("--min-size={}".format(self.defer_above + 1))
+            else:
+                max_size = self.defer_above if max_size is None else min(max_size, self.defer_above)
+        if max_size is not None:
+            args.append("--max-size={}".format(max_size))
+        if self.compress_above is not None:
+            args.append("-z")
+        return args
+
+
+def scp_command(src, port, user, dest, sync=None, archive=None, multiplex=False, rsync_args=None,
+                ssh_options=None):
+    """
+    Command line sending the local directory src into dest on
+    user@localhost:port, as used by FileSCPTask: scp -r, rsync with sync
+    ("mtime" or "checksum"), or with archive ("gzip" or "zstd") a
+    tar | compressor | ssh pipeline run by bash. rsync_args (e.g. from
+    TransferPolicy.rsync_args) select rsync, with sync="mtime" by default.
+    ssh_options are extra OpenSSH client options, e.g. ["-F", config].
+    rsync and tar skip TRANSFER_EXCLUDES; scp -r cannot.
+
+    Returns:
+        [str]: argv for subprocess.
+    """
+    ssh_opts = list(ssh_options or []) + (ssh_multiplex_options() if multiplex else [])
+    if rsync_args is not None:
+        sync = sync or "mtime"
+    elif archive:
+        compress_cmd, decompress_cmd = ARCHIVE_COMPRESSORS[archive]
+        cmd = "tar -cf - {} -C {} {} | {} | ssh -p {} {} {}@localhost {}".format(
+            " ".join("--exclude={}".format(shlex.quote(e)) for e in TRANSFER_EXCLUDES),
+            shlex.quote(os.path.dirname(src)), shlex.quote(os.path.basename(src)),
+            " ".join(compress_cmd), port, " ".join(shlex.quote(o) for o in ssh_opts), user,
+            shlex.quote("mkdir -p {0} && {1} | tar -xf - -C {0}".format(shlex.quote(dest), decompress_cmd)))
+        return ["bash", "-o", "pipefail", "-c", cmd]
+    if sync:
+        if sync not in ("mtime", "checksum"):
+            raise ValueError("Unknown sync mode {}".format(sync))
+        # no --append(-verify): it skips files whose remote copy is not smaller, i.e. rewritten
+        # outputs of a rerun; interrupted files are kept in .rsync-partial as delta basis instead
+        cmd = ["rsync", "-a", "--partial-dir=.rsync-partial",
+               "-e", " ".join(shlex.quote(o) for o in ["ssh", "-p", str(port)] + ssh_opts)]
+        cmd += ["--exclude={}".format(e) for e in TRANSFER_EXCLUDES]
+        if sync == "checksum":
+            cmd.append("--checksum")
+        return cmd + (rsync_args or []) + [src, "{}@localhost:{}".format(user, dest)]
+    return ["scp", "-P", str(port)] + ssh_opts + ["-r", src, "{}@localhost:{}".format(user, dest)]
+
+
+def rtransfer_jobs(files, dest, shell_interpret=True):
+    """
+    The (local, remote) file pairs of an rtransfer FileTransferTask.
+
+    Args:
+        files: "all" (every file of the cwd into dest/<cwd name>), local
+            files, local directories (their files go into dest) or dicts with
+            a "src" key.
+        dest (str): remote directory.
+        shell_interpret (bool): expand ~ and environment variables in src.
+
+    Returns:
+        [(str, str)]
+    """
+    jobs = []
+    for f in files:
+        if f == "all":
+            remote_dir = os.path.join(dest, os.path.basename(os.getcwd()))
+            jobs.extend((os.path.abspath(name), os.path.join(remote_dir, name))
+                        for name in sorted(glob("*")) if os.path.isfile(name))
+            continue
+        src = f["src"] if isinstance(f, dict) else f
+        if shell_interpret:
+            src = os.path.abspath(os.path.expanduser(os.path.expandvars(src)))
+        if os.path.isdir(src):
+            jobs.extend((os.path.join(src, name), os.path.join(dest, name))
+                        for name in sorted(os.listdir(src)) if os.path.isfile(os.path.join(src, name)))
+        else:
+            jobs.append((src, os.path.join(dest, os.path.basename(src))))
+    return jobs
+
+
+def _close(ssh):
+    ssh.close()
+
+
+def rexists(sftp, path):
+    """
+    os.path.exists for paramiko's SFTP client.
+    """
+    try:
+        sftp.stat(path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return True
+
+
+def make_remote_dirs(sftp, remote_files):
+    """
+    Create the missing parent directories of remote_files (one level, like
+    the destination directories of FileTransferTask).
+    """
+    for d in sorted({os.path.dirname(r) for r in remote_files}):
+        if not rexists(sftp, d):
+            sftp.mkdir(d)
+
+
+def sha256sum(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_manifest(sftp, remote_dirs):
+    """
+    {remote path: (size, mtime)} of the files in remote_dirs.
+    """
+    manifest = {}
+    for d in remote_dirs:
+        try:
+            attrs = sftp.listdir_attr(d)
+        except FileNotFoundError:
+            continue
+        manifest.update({os.path.join(d, a.filename): (a.st_size, a.st_mtime) for a in attrs})
+    return manifest
+
+
+def remote_checksums(ssh, remote_files):
+    """
+    {remote path: sha256} computed on the remote side.
+    """
+    sums = {}
+    remote_files = list(remote_files)
+    for i in range(0, len(remote_files), 100):
+        cmd = "sha256sum -- " + " ".join(shlex.quote(f) for f in remote_files[i:i + 100])
+        _, stdout, _ = ssh.exec_command(cmd)
+        for line in stdout.read().decode().splitlines():
+            digest, _, path = line.partition("  ")
+            sums[path] = digest
+    return sums
+
+
+def unchanged_files(ssh, sftp, jobs, sync="mtime"):
+    """
+    The jobs whose remote file is already identical to the local one.
+
+    Args:
+        sync (str): "mtime" (same size and mtime) or "checksum" (same size
+            and sha256).
+
+    Returns:
+        set: (local, remote) pairs that need no transfer.
+    """
+    manifest = remote_manifest(sftp, {os.path.dirname(r) for _, r in jobs})
+    same_size = []
+    for local, remote in jobs:
+        st = os.stat(local)
+        if remote in manifest and manifest[remote][0] == st.st_size:
+            same_size.append((local, remote, int(st.st_mtime) == manifest[remote][1]))
+
+    if sync == "mtime":
+        return {(local, remote) for local, remote, same_mtime in same_size if same_mtime}
+
+    sums = remote_checksums(ssh, [r for _, r, _ in same_size])
+    unchanged = set()
+    for local, remote, same_mtime in same_size:
+        if sums.get(remote) == sha256sum(local):
+            unchanged.add((local, remote))
+            if not same_mtime:
+                # the next mtime sync will not need to hash the file again
+                st = os.stat(local)
+                sftp.utime(remote, (st.st_atime, st.st_mtime))
+    return unchanged
+
+
+def put_file(sftp, local, remote, resume=True):
+    """
+    Upload local to remote through remote.part, keeping the local mtime.
+
+    With resume, an existing remote.part that is not larger than the local
+    file and was written after the local file was last modified is continued
+    instead of restarted.
+
+    Returns:
+        (int, int): bytes sent and bytes resumed.
+    """
+    st = os.stat(local)
+    part = remote + PART_EXT
+    offset = 0
+    if resume:
+        try:
+            part_st = sftp.stat(part)
+            if part_st.st_size <= st.st_size and part_st.st_mtime >= int(st.st_mtime):
+                offset = part_st.st_size
+        except FileNotFoundError:
+            pass
+
+    with open(local, "rb") as f, sftp.open(part, "r+b" if offset else "wb") as rf:
+        rf.set_pipelined(True)
+        f.seek(offset)
+        rf.seek(offset)
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            rf.write(chunk)
+    sftp.utime(part, (st.st_atime, st.st_mtime))
+    sftp.posix_rename(part, remote)
+    return st.st_size - offset, offset
+
+
+class TransferState:
+    """
+    Files already uploaded by an earlier, interrupted attempt, stored as JSON
+    (e.g. .transfer_state.json in the launch dir). An entry is only trusted
+    while the local file keeps the size and mtime it had when it was sent.
+
+    Args:
+        filename (str): state file, None to keep the state in memory only.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.done = {}
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.done = json.load(f)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(local):
+        st = os.stat(local)
+        return [st.st_size, int(st.st_mtime)]
+
+    def is_done(self, local, remote):
+        entry = self.done.get(remote)
+        return entry is not None and entry["local"] == local and entry["signature"] == self._signature(local)
+
+    def add(self, local, remote):
+        with self._lock:
+            self.done[remote] = {"local": local, "signature": self._signature(local)}
+            self.save()
+
+    def discard(self, remotes):
+        with self._lock:
+            for remote in remotes:
+                self.done.pop(remote, None)
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.done, f)
+        os.replace(tmp, self.filename)
+
+
+def verify_files(ssh, sftp, jobs, verify="size"):
+    """
+    Compare uploaded files with their local source.
+
+    Args:
+        verify (str): "size" (remote listing) or "checksum" (remote
+            sha256sum).
+
+    Returns:
+        [dict]: verification manifest, one entry per file with local and
+        remote path, size, sha256 (checksum only) and "verified".
+    """
+    listing = remote_manifest(sftp, {os.path.dirname(r) for _, r in jobs})
+    sums = remote_checksums(ssh, [r for _, r in jobs]) if verify == "checksum" else {}
+    manifest = []
+    for local, remote in jobs:
+        size = os.path.getsize(local)
+        entry = {"file": local, "remote": remote, "bytes": size,
+                 "verified": remote in listing and listing[remote][0] == size}
+        if verify == "checksum":
+            entry["sha256"] = sha256sum(local)
+            entry["verified"] = entry["verified"] and sums.get(remote) == entry["sha256"]
+        manifest.append(entry)
+    return manifest
+
+
+def put_files(connect_fn, jobs, workers=1, sessions=1, sync=None, release_fn=None, retries=3, retry_delay=10,
+              state_file=None, verify=None, manifest_file=None):
+    """
+    Upload files with several SFTP channels in parallel.
+
+    Each file is retried on its own: after a failure the worker waits
+    retry_delay * 2**attempt seconds, reconnects if the session is gone and
+    resumes the file from its .part. Completed files are recorded in
+    state_file, so a later call (e.g. a rerun of the firework) continues after
+    the last completed file instead of starting over.
+
+    Args:
+        connect_fn (callable): returns a new, connected paramiko.SSHClient.
+        jobs ([(str, str)]): (local, remote) pairs.
+        workers (int): number of concurrent SFTP channels.
+        sessions (int): number of SSH sessions the channels are spread over.
+        sync (str): skip files that are unchanged on the remote side, "mtime"
+            or "checksum". None sends everything.
+        release_fn (callable): called with each session when done, e.g.
+            ConnectionPool.release. Default: close it.
+        retries (int): retries per file.
+        retry_delay (float): seconds before the first retry of a file.
+        state_file (str): JSON file recording completed files.
+        verify (str): check all files after the upload, "size" or
+            "checksum". Files that fail are dropped from the state and an
+            IOError is raised.
+        manifest_file (str): write the verification manifest to this JSON
+            file.
+
+    Returns:
+        dict: transfer statistics, including per-file bytes, seconds,
+        throughput and attempts, suitable for stored_data.
+    """
+    if sync not in SYNC_MODES:
+        raise ValueError("Unknown sync mode {}, use one of {}".format(sync, SYNC_MODES))
+    all_jobs = jobs = sorted(jobs, key=lambda j: os.path.getsize(j[0]), reverse=True)
+    state = TransferState(state_file)
+    workers = max(1, min(workers, len(jobs)))
+    clients = [connect_fn() for _ in range(max(1, min(sessions, workers)))]
+    todo = queue.Queue()
+    per_file, errors, lock = [], [], threading.Lock()
+    skipped = [local for local, remote in jobs if state.is_done(local, remote)]
+    jobs = [(local, remote) for local, remote in jobs if not state.is_done(local, remote)]
+
+    def work(i):
+        ssh, sftp = clients[i % len(clients)], None
+        try:
+            while not errors:
+                try:
+                    local, remote = todo.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                for attempt in range(retries + 1):
+                    try:
+                        if sftp is None:
+                            sftp = ssh.open_sftp()
+                        nbytes, resumed = put_file(sftp, local, remote)
+                        break
+                    except Exception as err:
+                        if sftp is not None:
+                            sftp.close()
+                            sftp = None
+                        if attempt == retries:
+                            with lock:
+                                errors.append((local, err))
+                            return
+                        delay = retry_delay * 2 ** attempt
+                        logger.warning("{} failed (attempt {}), retrying in {} s: {}".format(
+                            local, attempt + 1, delay, err))
+                        time.sleep(delay)
+                        transport = ssh.get_transport()
+                        if transport is None or not transport.is_active():
+                            try:
+                                ssh = connect_fn()
+                                with lock:
+                                    clients.append(ssh)
+                            except Exception as conn_err:
+                                logger.warning("Reconnect failed: {}".format(conn_err))
+                state.add(local, remote)
+                seconds = time.time() - start
+                stat = {"file": local, "bytes": nbytes, "seconds": round(seconds, 3),
+                        "MB_s": round(nbytes / seconds / 1e6, 2) if seconds else None}
+                if resumed:
+                    stat["resumed_bytes"] = resumed
+                if attempt:
+                    stat["attempts"] = attempt + 1
+                logger.info("{file}: {bytes} B in {seconds} s ({MB_s} MB/s)".format(**stat))
+                with lock:
+                    per_file.append(stat)
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    start = time.time()
+    manifest = None
+    try:
+        sftp = clients[0].open_sftp()
+        if sync:
+            unchanged = unchanged_files(clients[0], sftp, jobs, sync)
+            skipped += [local for local, remote in jobs if (local, remote) in unchanged]
+            jobs = [job for job in jobs if job not in unchanged]
+        make_remote_dirs(sftp, [r for _, r in jobs])
+        sftp.close()
+        for job in jobs:
+            todo.put(job)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if verify and not errors:
+            ssh = connect_fn()
+            clients.append(ssh)
+            sftp = ssh.open_sftp()
+            manifest = verify_files(ssh, sftp, all_jobs, verify)
+            sftp.close()
+    finally:
+        for ssh in clients:
+            (release_fn or _close)(ssh)
+    if errors:
+        local, err = errors[0]
+        raise IOError("Transfer of {} failed: {}".format(local, err)) from err
+
+    stats = {}
+    if manifest is not None:
+        if manifest_file:
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f, indent=1)
+        bad = [e["remote"] for e in manifest if not e["verified"]]
+        if bad:
+            state.discard(bad)
+            raise IOError("Verification failed for {}".format(", ".join(bad)))
+        stats["verified"] = len(manifest)
+
+    seconds = time.time() - start
+    nbytes = sum(s["bytes"] for s in per_file)
+    stats.update({"files": len(per_file), "bytes": nbytes, "seconds": round(seconds, 3),
+                  "MB_s": round(nbytes / seconds / 1e6, 2) if seconds else None,
+                  "workers": workers, "sessions": len(clients), "skipped": len(skipped),
+                  "skipped_bytes": sum(os.path.getsize(f) for f in skipped), "per_file": per_file})
+    return stats
+
+
+def put_archive(ssh, jobs, compress="gzip"):
+    """
+    Upload files as one compressed tar stream per remote directory, unpacked
+    by tar on the remote side.
+
+    Args:
+        ssh (paramiko.SSHClient): connected session.
+        jobs ([(str, str)]): (local, remote) pairs. The remote file name must
+            equal the local one, as in rtransfer_jobs.
+        compress (str): "gzip" (pigz if available), "zstd" or None.
+
+    Returns:
+        dict: transfer statistics with raw and sent bytes.
+    """
+    if compress not in ARCHIVE_COMPRESSORS:
+        raise ValueError("Unknown compressor {}, use one of {}".format(compress, list(ARCHIVE_COMPRESSORS)))
+    compress_cmd, decompress_cmd = ARCHIVE_COMPRESSORS[compress]
+
+    groups = defaultdict(list)
+    for local, remote in jobs:
+        if os.path.basename(local) != os.path.basename(remote):
+            raise ValueError("Cannot rename {} to {} in an archive".format(local, remote))
+        groups[os.path.dirname(remote)].append(local)
+
+    start, raw, sent = time.time(), 0, 0
+    for remote_dir, files in groups.items():
+        tar_cmd = ["tar", "-cf", "-"]
+        for local in files:
+            tar_cmd += ["-C", os.path.dirname(local), os.path.basename(local)]
+            raw += os.path.getsize(local)
+        unpack = "tar -xf - -C {}".format(shlex.quote(remote_dir))
+        if decompress_cmd:
+            unpack = "{} | {}".format(decompress_cmd, unpack)
+        channel = ssh.get_transport().open_session()
+        channel.exec_command("mkdir -p {} && {}".format(shlex.quote(remote_dir), unpack))
+
+        tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+        stream = tar.stdout
+        compressor = None
+        if compress_cmd:
+            compressor = subprocess.Popen(compress_cmd, stdin=tar.stdout, stdout=subprocess.PIPE)
+            tar.stdout.close()
+            stream = compressor.stdout
+        try:
+            for chunk in iter(lambda: stream.read(_CHUNK), b""):
+                channel.sendall(chunk)
+                sent += len(chunk)
+            channel.shutdown_write()
+            status = channel.recv_exit_status()
+            if status or tar.wait() or (compressor and compressor.wait()):
+                raise IOError("Archive transfer to {} failed: {}".format(
+                    remote_dir, channel.makefile_stderr().read().decode().strip()))
+        finally:
+            stream.close()
+            channel.close()
+            for p in (tar, compressor):
+                if p and p.poll() is None:
+                    p.kill()
+        logger.info("{} files to {}".format(len(files), remote_dir))
+
+    seconds = time.time() - start
+    return {"files": len(jobs), "bytes": raw, "bytes_sent": sent, "seconds": round(seconds, 3),
+            "MB_s": round(raw / seconds / 1e6, 2) if seconds else None,
+            "compression_ratio": round(raw / sent, 2) if sent else None, "archive": compress}
+
+
+def archive_files(connect_fn, jobs, compress="gzip", sync=None, release_fn=None):
+    """
+    put_archive with its own session, optionally skipping unchanged files.
+
+    Args:
+        compress (str): "gzip", "zstd", or "tar" for an uncompressed stream.
+        sync (str): see put_files.
+        release_fn (callable): see put_files.
+    """
+    ssh = connect_fn()
+    try:
+        skipped = set()
+        if sync:
+            sftp = ssh.open_sftp()
+            skipped = unchanged_files(ssh, sftp, jobs, sync)
+            sftp.close()
+        stats = put_archive(ssh, [job for job in jobs if job not in skipped],
+                            compress=None if compress == "tar" else compress)
+    finally:
+        (release_fn or _close)(ssh)
+    stats["skipped"] = len(skipped)
+    return stats
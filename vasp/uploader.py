@@ -0,0 +1,216 @@
+"""
+Asynchronous uploads of launch directories.
+
+Instead of transferring the outputs while the compute allocation waits,
+FileTransferTask and FileSCPTask can only enqueue a transfer manifest (one
+spool record per transfer, see vasp.spool.TaskSpool) in a queue directory on
+a shared filesystem. A lightweight uploader, e.g. on the login node where the
+tunnel to the workstation ends, drains the queue:
+
+    python -m vasp.uploader /path/to/upload_queue --watch --interval 30
+
+Failed transfers are retried with exponential backoff and moved to
+<queue>/failed after max_attempts. When the manifest names a db_file, the
+result is written into the task document of the launch dir (matched by
+dir_name) under "transfer".
+"""
+
+import argparse
+import datetime
+import os
+import subprocess
+import time
+
+from atomate.utils.utils import get_logger, get_uri
+
+from .database import get_calc_db
+from .spool import TaskSpool, read_record, write_record
+from .transfer import connection_pool, put_files, archive_files, scp_command
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+logger = get_logger(__name__)
+
+
+def enqueue_transfer(queue_dir, transfer, db_file=None, dir_name=None):
+    """
+    Add a transfer manifest to the upload queue.
+
+    Args:
+        queue_dir (str): queue directory, created if needed.
+        transfer (dict): "kind" ("sftp" or "scp") plus the arguments of
+            run_transfer. Local paths must be absolute.
+        db_file (str): database holding the task document to report to.
+        dir_name (str): launch dir whose task document gets the report.
+            Default: the cwd.
+
+    Returns:
+        str: path of the queued manifest.
+    """
+    manifest = {"transfer": transfer, "dir_name": dir_name or get_uri(os.getcwd()),
+                "attempts": 0, "not_before": 0, "queued_at": datetime.datetime.utcnow()}
+    path = TaskSpool(queue_dir).put(manifest, db_file)
+    logger.info("Queued transfer {}".format(path))
+    return path
+
+
+def run_transfer(transfer):
+    """
+    Run the transfer of a manifest.
+
+    Returns:
+        dict: transfer statistics.
+    """
+    t = dict(transfer)
+    kind = t.pop("kind")
+    if kind == "sftp":
+        connect_args = (t["server"], t["port"], t.get("user"), t.get("key_filename"))
+        connect_fn = lambda: connection_pool.acquire(*connect_args)
+        jobs = [tuple(j) for j in t["jobs"]]
+        if t.get("archive"):
+            return archive_files(connect_fn, jobs, compress=t["archive"], sync=t.get("sync"),
+                                 release_fn=connection_pool.release)
+        return put_files(connect_fn, jobs, workers=t.get("workers", 1), sessions=t.get("sessions", 1),
+                         sync=t.get("sync"), release_fn=connection_pool.release, retries=t.get("max_retry", 3),
+                         retry_delay=t.get("retry_delay", 10), verify=t.get("verify", "size"))
+    if kind == "scp":
+        start = time.time()
+        subprocess.check_output(scp_command(t["src"], t["port"], t["user"], t["dest"], sync=t.get("sync"),
+                                            archive=t.get("archive"), multiplex=t.get("multiplex", False),
+                                            rsync_args=t.get("rsync_args")),
+                                stderr=subprocess.STDOUT)
+        return {"seconds": round(time.time() - start, 3)}
+    raise ValueError("Unknown transfer kind {}".format(kind))
+
+
+def report(db_file, dir_name, info):
+    """
+    Set "transfer" in the task document of dir_name.
+
+    Returns:
+        bool: whether a task document was found. It may not exist yet when
+        VaspToDb spools its document.
+    """
+    mmdb = get_calc_db(db_file, admin=True)
+    return mmdb.collection.update_one({"dir_name": dir_name}, {"$set": {"transfer": info}}).matched_count > 0
+
+
+class Uploader:
+    """
+    Drains an upload queue.
+
+    Args:
+        queue_dir (str): queue directory.
+        max_attempts (int): attempts per manifest before it is moved to
+            <queue>/failed.
+        backoff (float): seconds before the first retry, doubled with every
+            further attempt.
+        db_file (str): database for manifests queued without one.
+    """
+
+    def __init__(self, queue_dir, max_attempts=5, backoff=60, db_file=None):
+        self.queue = TaskSpool(queue_dir)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.db_file = db_file
+
+    def process(self, path):
+        """
+        Run (or retry) one claimed manifest.
+
+        Returns:
+            bool: whether the manifest is finished.
+        """
+        try:
+            record = read_record(path)
+            manifest = record["doc"]
+        except Exception as err:
+            # a truncated or corrupt manifest would be claimed again forever
+            logger.warning("Cannot read manifest {}, moving it to failed: {}".format(path, err))
+            self.queue.fail(path)
+            return True
+        if manifest["not_before"] > time.time():
+            self.queue.release(path)
+            return False
+        db_file = record["db_file"] or self.db_file
+
+        try:
+            if "result" not in manifest:
+                stats = run_transfer(manifest["transfer"])
+                stats.pop("per_file", None)
+                manifest["result"] = {"state": "done", "stats": stats, "attempts": manifest["attempts"] + 1,
+                                      "completed_at": datetime.datetime.utcnow()}
+                logger.info("Transferred {}".format(manifest["dir_name"]))
+            if db_file and not report(db_file, manifest["dir_name"], manifest["result"]):
+                raise LookupError("no task document with dir_name {} yet".format(manifest["dir_name"]))
+        except Exception as err:
+            manifest["attempts"] += 1
+            manifest["error"] = "{}: {}".format(type(err).__name__, err)
+            logger.warning("Transfer of {} failed (attempt {}): {}".format(
+                manifest["dir_name"], manifest["attempts"], manifest["error"]))
+            if manifest["attempts"] >= self.max_attempts:
+                if db_file and "result" not in manifest:
+                    try:
+                        report(db_file, manifest["dir_name"], {"state": "failed", "error": manifest["error"],
+                                                               "attempts": manifest["attempts"]})
+                    except Exception:
+                        pass
+                write_record(path, record)
+                self.queue.fail(path)
+                return True
+            manifest["not_before"] = time.time() + self.backoff * 2 ** (manifest["attempts"] - 1)
+            write_record(path, record)
+            self.queue.release(path)
+            return False
+
+        self.queue.done(path)
+        return True
+
+    def run_once(self):
+        """
+        Process every manifest that is due.
+
+        Returns:
+            int: number of finished manifests.
+        """
+        finished = 0
+        for path in self.queue.claim():
+            try:
+                finished += self.process(path)
+            except Exception as err:
+                # e.g. the manifest was requeued and picked up by another
+                # uploader meanwhile; the others are still due
+                logger.warning("Processing {} failed: {}".format(path, err))
+        return finished
+
+    def run(self, interval=30, stale=3600):
+        while True:
+            self.queue.requeue_stale(stale)
+            n = self.run_once()
+            logger.info("{} transfers finished, {} queued".format(n, len(self.queue.pending())))
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queue_dir")
+    parser.add_argument("-d", "--db_file", default=None, help="database for manifests queued without one")
+    parser.add_argument("-w", "--watch", action="store_true", help="keep draining every --interval seconds")
+    parser.add_argument("-i", "--interval", type=float, default=30)
+    parser.add_argument("-m", "--max_attempts", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=60, help="seconds before the first retry")
+    parser.add_argument("--stale", type=float, default=3600,
+                        help="requeue manifests claimed longer than this many seconds ago")
+    args = parser.parse_args()
+
+    uploader = Uploader(args.queue_dir, max_attempts=args.max_attempts, backoff=args.backoff, db_file=args.db_file)
+    if args.watch:
+        uploader.run(args.interval, args.stale)
+    else:
+        uploader.queue.requeue_stale(args.stale)
+        logger.info("{} transfers finished".format(uploader.run_once()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Memory-mapped access to VASP WAVECAR files and extraction of band/k-point/spin
+subsets.
+
+A WAVECAR is a direct-access file of fixed-length records, the record length
+being the first number in the file:
+
+    record 0            RECL, ISPIN, RTAG (precision tag)
+    record 1            NKPTS, NBANDS, ENCUT, lattice vectors (9), EFERMI (VASP 6)
+    per spin and k-point:
+      header record     NPLW, k-point (3), (Re eigenvalue, Im eigenvalue, occupation) per band
+      NBANDS records    the NPLW plane-wave coefficients of one band
+
+write_wavecar_subset copies only the records of the selected bands, k-points
+and spins from the memory map into a new WAVECAR with the same layout, so
+irvsp, pyzfs or pymatgen read it like the original. Nothing but the header
+records is ever loaded into memory. Band and k-point indices of the subset
+count from its first band and k-point.
+"""
+
+import os
+
+import numpy as np
+
+__author__ = "Jeng-Yuan Tsai"
+__email__ = "tsaie79@gmail.com"
+
+# RTAG -> coefficient type
+PRECISION_TAGS = {45200: np.complex64, 45210: np.complex128, 53300: np.complex64, 53310: np.complex128}
+
+
+class MappedWavecar:
+    """
+    Read-only memory map of a WAVECAR.
+
+    Args:
+        filename (str): path to the WAVECAR.
+
+    Attributes:
+        recl (int): record length in bytes.
+        nspin, nkpts, nbands (int)
+        encut (float)
+        lattice (np.array): 3x3 real-space lattice vectors.
+        efermi (float): Fermi level written by VASP 6, else None.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mm = np.memmap(filename, dtype=np.uint8, mode="r")
+        recl, nspin, rtag = np.frombuffer(self._mm[:24], dtype=np.float64)
+        if int(rtag) not in PRECISION_TAGS:
+            raise ValueError("Unknown WAVECAR precision tag {} in {}".format(int(rtag), filename))
+        self.recl, self.nspin, self.rtag = int(recl), int(nspin), int(rtag)
+        self.dtype = PRECISION_TAGS[self.rtag]
+        rec1 = np.frombuffer(self.record(1), dtype=np.float64)
+        self.nkpts, self.nbands, self.encut = int(rec1[0]), int(rec1[1]), rec1[2]
+        self.lattice = rec1[3:12].reshape(3, 3).copy()
+        self.efermi = float(rec1[12]) if self.rtag in (53300, 53310) else None
+        expected = (2 + self.nspin * self.nkpts * (self.nbands + 1)) * self.recl
+        if len(self._mm) < expected:
+            raise ValueError("{} is truncated: {} bytes, expected {}".format(filename, len(self._mm), expected))
+
+    def record(self, irec):
+        """
+        Returns:
+            np.memmap: the raw bytes of record irec.
+        """
+        return self._mm[irec * self.recl:(irec + 1) * self.recl]
+
+    def header_index(self, ispin, ik):
+        return 2 + (ispin * self.nkpts + ik) * (self.nbands + 1)
+
+    def kpoint_header(self, ispin, ik):
+        """
+        Returns:
+            (int, np.array, np.array, np.array): number of plane waves,
+            k-point, eigenvalues and occupations of the bands.
+        """
+        h = np.frombuffer(self.record(self.header_index(ispin, ik)), dtype=np.float64)
+        bands = h[4:4 + 3 * self.nbands].reshape(self.nbands, 3)
+        return int(h[0]), h[1:4].copy(), bands[:, 0].copy(), bands[:, 2].copy()
+
+    def eigenvalues(self):
+        """
+        Returns:
+            (np.array, np.array): eigenvalues and occupations, shape
+            (nspin, nkpts, nbands).
+        """
+        eigs = np.zeros((self.nspin, self.nkpts, self.nbands))
+        occs = np.zeros_like(eigs)
+        for ispin in range(self.nspin):
+            for ik in range(self.nkpts):
+                _, _, eigs[ispin, ik], occs[ispin, ik] = self.kpoint_header(ispin, ik)
+        return eigs, occs
+
+    def coefficients(self, ispin, ik, ib):
+        """
+        Returns:
+            np.array: plane-wave coefficients of band ib, a view on the file.
+        """
+        nplw = self.kpoint_header(ispin, ik)[0]
+        rec = self.record(self.header_index(ispin, ik) + 1 + ib)
+        return np.frombuffer(rec, dtype=self.dtype, count=nplw)
+
+    def close(self):
+        # the map is unmapped once the arrays returned by coefficients() are gone
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _expand_degenerate(eigs, lo, hi, tol):
+    while lo > 0 and np.any(np.abs(eigs[..., lo - 1] - eigs[..., lo]) < tol):
+        lo -= 1
+    while hi < eigs.shape[-1] - 1 and np.any(np.abs(eigs[..., hi + 1] - eigs[..., hi]) < tol):
+        hi += 1
+    return lo, hi
+
+
+def bands_in_window(wavecar, efermi, window, degeneracy_tol=1e-3):
+    """
+    The contiguous range of bands with an eigenvalue within efermi +- window
+    at any k-point and spin, widened so that no degenerate multiplet is cut
+    (irreps need complete multiplets).
+
+    Args:
+        wavecar (MappedWavecar)
+        efermi (float): Fermi level in eV.
+        window (float): half width in eV.
+        degeneracy_tol (float): eV.
+
+    Returns:
+        [int]: 0-based band indices.
+    """
+    eigs, _ = wavecar.eigenvalues()
+    inside = np.where(np.any(np.abs(eigs - efermi) <= window, axis=(0, 1)))[0]
+    if not len(inside):
+        raise ValueError("No band within {} eV of {} eV".format(window, efermi))
+    lo, hi = _expand_degenerate(eigs, inside[0], inside[-1], degeneracy_tol)
+    return list(range(lo, hi + 1))
+
+
+def occupied_bands(wavecar, threshold=1e-3, extra=0):
+    """
+    Bands up to the highest one occupied at any k-point and spin, plus extra
+    empty bands.
+
+    Returns:
+        [int]: 0-based band indices.
+    """
+    _, occs = wavecar.eigenvalues()
+    occupied = np.where(np.any(occs > threshold, axis=(0, 1)))[0]
+    highest = occupied[-1] if len(occupied) else -1
+    return list(range(min(highest + 1 + extra, wavecar.nbands)))
+
+
+def write_wavecar_subset(src, dest, bands=None, kpoints=None, spins=None):
+    """
+    Write the selected bands, k-points and spins of src as a new WAVECAR.
+
+    Args:
+        src (str or MappedWavecar): WAVECAR to read.
+        dest (str): WAVECAR to write, replaced atomically.
+        bands, kpoints, spins ([int]): 0-based indices. Default: all.
+
+    Returns:
+        dict: the selection and the sizes of both files in bytes.
+    """
+    wavecar = src if isinstance(src, MappedWavecar) else MappedWavecar(src)
+    bands = sorted(set(range(wavecar.nbands) if bands is None else bands))
+    kpoints = sorted(set(range(wavecar.nkpts) if kpoints is None else kpoints))
+    spins = sorted(set(range(wavecar.nspin) if spins is None else spins))
+    for name, sel, n in (("band", bands, wavecar.nbands), ("k-point", kpoints, wavecar.nkpts),
+                         ("spin", spins, wavecar.nspin)):
+        if not sel or sel[0] < 0 or sel[-1] >= n:
+            raise ValueError("{} indices {} out of range 0..{}".format(name, sel, n - 1))
+
+    recl = wavecar.recl
+    tmp = dest + ".part"
+    with open(tmp, "wb") as f:
+        def write_record(values):
+            out = np.zeros(recl, dtype=np.uint8)
+            raw = np.asarray(values, dtype=np.float64).view(np.uint8)
+            out[:len(raw)] = raw
+            f.write(out.tobytes())
+
+        rec0 = np.frombuffer(wavecar.record(0), dtype=np.float64).copy()
+        rec0[1] = len(spins)
+        f.write(rec0.tobytes())
+        rec1 = np.frombuffer(wavecar.record(1), dtype=np.float64).copy()
+        rec1[0], rec1[1] = len(kpoints), len(bands)
+        f.write(rec1.tobytes())
+
+        for ispin in spins:
+            for ik in kpoints:
+                irec = wavecar.header_index(ispin, ik)
+                h = np.frombuffer(wavecar.record(irec), dtype=np.float64)
+                triples = h[4:4 + 3 * wavecar.nbands].reshape(wavecar.nbands, 3)[bands]
+                write_record(np.concatenate([h[:4], triples.ravel()]))
+                for ib in bands:
+                    f.write(wavecar.record(irec + 1 + ib).tobytes())
+    os.replace(tmp, dest)
+
+    info = {"bands": bands, "kpoints": kpoints, "spins": spins,
+            "bytes_in": os.path.getsize(wavecar.filename), "bytes_out": os.path.getsize(dest)}
+    if wavecar is not src:
+        wavecar.close()
+    return info
@@ -8,6 +8,7 @@ from atomate.vasp.powerups import *
 from atomate.vasp.workflows.base.core import get_wf
 
 from ..fireworks.fireworks import *
+from ..potcar_metadata import max_enmax, get_nelect
 
 from fireworks import Workflow
 
@@ -16,7 +17,7 @@ import numpy as np
 def get_wf_full_hse(structure, charge_states, gamma_only, gamma_mesh, nupdowns, task,
                     vasptodb=None, wf_addition_name=None, task_arg=None, double_relax_ediffg=-0.01):
 
-    encut = 1.3*max([potcar.enmax for potcar in MPHSERelaxSet(structure).potcar])
+    encut = 1.3*max_enmax(structure, MPHSERelaxSet)
 
     print("SET ENCUT:{}".format(encut))
 
@@ -29,7 +30,7 @@ def get_wf_full_hse(structure, charge_states, gamma_only, gamma_mesh, nupdowns,
         if structure.site_properties.get("magmom", None):
             structure.remove_site_property("magmom")
         structure.set_charge(cs)
-        nelect = MPHSERelaxSet(structure, use_structure_charge=True).nelect
+        nelect = get_nelect(structure, MPHSERelaxSet)
         user_incar_settings = {
             "ENCUT": encut,
             "ISIF": 2,
@@ -282,7 +283,7 @@ def get_wf_full_hse(structure, charge_states, gamma_only, gamma_mesh, nupdowns,
 def get_wf_full_scan(structure, charge_states, gamma_only, dos, nupdowns,
                      vasptodb=None, wf_addition_name=None, wf_yaml=None, update_fws_params=None):
 
-    encut = 1.3*max([potcar.enmax for potcar in MPScanRelaxSet(structure).potcar])
+    encut = 1.3*max_enmax(structure, MPScanRelaxSet)
     print("SET ENCUT:{}".format(encut))
 
     vasptodb = vasptodb or {}
@@ -293,7 +294,7 @@ def get_wf_full_scan(structure, charge_states, gamma_only, dos, nupdowns,
         if structure.site_properties.get("magmom", None):
             structure.remove_site_property("magmom")
         structure.set_charge(cs)
-        nelect = MPRelaxSet(structure, use_structure_charge=True).nelect
+        nelect = get_nelect(structure, MPRelaxSet)
 
         if gamma_only is True:
             kpt = Kpoints.gamma_automatic()